@@ -1,14 +1,349 @@
-from fastapi import FastAPI, Query, HTTPException
+from fastapi import FastAPI, Header, Query, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List, Optional
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import FileResponse, JSONResponse, ORJSONResponse, PlainTextResponse, StreamingResponse
+from typing import Dict, List, Optional
 from pydantic import BaseModel
 from enum import Enum
 import dataset
+from sqlalchemy import text
 from datetime import datetime, date, timezone
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import argparse
+import asyncio
+import csv
+import hashlib
+import heapq
+import hmac
+import io
 import json
+import math
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, the standard library encoder is the fallback
+    orjson = None
+
+try:
+    import httpx
+except ImportError:  # httpx is only needed by the webhook dispatcher, which stays off without it
+    httpx = None
+
+# connecting to a SQLite database, sqlitefile.db for the default tenant and one file per named tenant
+tenant_data_path = os.environ.get('TENANT_DATA_PATH', 'tenants')
+tenant_cache_size = int(os.environ.get('TENANT_CACHE_SIZE', '128'))
+tenant_name_pattern = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_-]{0,63}$')
+# tenant of the current request or job, None for the default database
+current_tenant = ContextVar('current_tenant', default=None)
+# schema functions, run on the default database at import and on each tenant database when it is first opened
+database_open_functions = []
+# reports and read-only /query requests go to a separate read-only connection pool: a WAL reader on the database
+# file, or for the default database a replica file restored by litestream while it is within the staleness bound
+read_replica_path = os.environ.get('READ_REPLICA_PATH')
+read_max_staleness = float(os.environ.get('READ_MAX_STALENESS', '5'))
+# READ_ROUTING=primary serves every read from the writer connection
+read_routing = os.environ.get('READ_ROUTING', 'replica')
+# read-only database chosen for the current request, None means the primary connection
+current_reader = ContextVar('current_reader', default=None)
+
+
+class TenantDatabases:
+    """
+        Bounded LRU cache of tenant databases, opened lazily on first use and closed when evicted:
+
+    """
+    def __init__(self, default_url, data_path, max_open):
+        self.default_entry = self.new_entry(dataset.connect(default_url))
+        self.default_entry['ready'].set()
+        self.data_path = data_path
+        self.template_path = os.path.join(data_path, '.template.db')
+        self.max_open = max_open
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def new_entry(database):
+        return {'database': database, 'readers': {}, 'users': 0, 'cache': {}, 'ready': threading.Event(),
+                'opener': None}
+
+    def entry(self, tenant, acquire=False):
+        if tenant is None:
+            return self.default_entry
+        entry = self.entries.get(tenant)
+        if entry is not None and not acquire and entry['ready'].is_set():
+            return entry
+        with self.lock:
+            entry = self.entries.get(tenant)
+            opening = entry is None
+            if opening:
+                os.makedirs(self.data_path, exist_ok=True)
+                database_path = os.path.join(self.data_path, f"{tenant}.db")
+                build_template = not os.path.exists(database_path)
+                if build_template and os.path.exists(self.template_path):
+                    # start new tenants from an empty copy of the schema instead of creating it column by column
+                    shutil.copyfile(self.template_path, database_path)
+                    build_template = False
+                entry = self.new_entry(dataset.connect(f"sqlite:///{database_path}"))
+                entry['opener'] = threading.get_ident()
+                self.entries[tenant] = entry
+            elif acquire:
+                self.entries.move_to_end(tenant)
+            if acquire:
+                entry['users'] += 1
+        if opening:
+            self.open(tenant, entry, build_template)
+        elif not entry['ready'].is_set() and entry['opener'] != threading.get_ident():
+            entry['ready'].wait()
+        return entry
+
+    def open(self, tenant, entry, build_template):
+        token = current_tenant.set(tenant)
+        try:
+            for function in database_open_functions:
+                function()
+            if build_template:
+                template_build_path = f"{self.template_path}.{os.getpid()}.{threading.get_ident()}"
+                entry['database'].executable.exec_driver_sql(f"VACUUM INTO '{template_build_path}'")
+                os.replace(template_build_path, self.template_path)
+        except Exception:
+            with self.lock:
+                self.entries.pop(tenant, None)
+            self.close(entry)
+            raise
+        finally:
+            current_tenant.reset(token)
+            entry['ready'].set()
+        print(f"opened database of tenant {tenant}")
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            idle_tenants = [tenant for tenant, entry in self.entries.items()
+                            if entry['users'] == 0 and entry['ready'].is_set()]
+            evicted = [self.entries.pop(tenant) for tenant in idle_tenants[:max(len(self.entries) - self.max_open, 0)]]
+        for entry in evicted:
+            self.close(entry)
+
+    @staticmethod
+    def close(entry):
+        for reader in entry['readers'].values():
+            reader['database'].close()
+        entry['database'].close()
+
+    def stored_tenants(self):
+        """
+            Tenants with a database file, opened or not:
+
+        """
+        if not os.path.isdir(self.data_path):
+            return []
+        return sorted(name[:-len('.db')] for name in os.listdir(self.data_path)
+                      if name.endswith('.db') and not name.startswith('.'))
+
+    def release(self, tenant):
+        if tenant is not None:
+            with self.lock:
+                self.entries[tenant]['users'] -= 1
+
+    @contextmanager
+    def use(self, tenant):
+        """
+            Route db to a tenant for the duration of a request or job, keeping its database open meanwhile:
+
+        """
+        token = current_tenant.set(tenant)
+        self.entry(tenant, acquire=True)
+        try:
+            yield
+        finally:
+            self.release(tenant)
+            current_tenant.reset(token)
+
+    def reader(self, tenant, max_staleness):
+        """
+            Read-only connection pool of a tenant database, on the litestream replica while it is fresh enough:
+
+        """
+        entry = self.entry(tenant)
+        primary_path = entry['database'].engine.url.database
+        path = primary_path
+        replica_path = read_replica_path if entry is self.default_entry else None
+        if replica_path and os.path.exists(replica_path):
+            # the replica lags by the primary writes it has not seen yet, an idle primary means a fresh replica
+            lag = database_change_time(primary_path) - database_change_time(replica_path)
+            if lag <= max_staleness:
+                path = replica_path
+            else:
+                print(f"replica {replica_path} is {lag:.1f}s behind, reading from {primary_path}")
+        inode = os.stat(path).st_ino
+        with self.lock:
+            reader = entry['readers'].get(path)
+            if reader is not None and reader['inode'] != inode:
+                # litestream restore replaced the file, connections on the old one would never see new data
+                entry['readers'].pop(path)['database'].close()
+                reader = None
+            if reader is None:
+                database = dataset.connect(f"sqlite:///file:{path}?mode=ro&uri=true", ensure_schema=False,
+                                           sqlite_wal_mode=False)
+                reader = entry['readers'][path] = {'database': database, 'inode': inode}
+        return reader['database']
+
+    @contextmanager
+    def reading(self, max_staleness=None, force_primary=False):
+        """
+            Serve the reads of a request or job from the read-only pool, unless primary reads are forced:
+
+        """
+        if force_primary or read_routing == 'primary':
+            yield
+            return
+        max_staleness = read_max_staleness if max_staleness is None else max_staleness
+        token = current_reader.set(self.reader(current_tenant.get(), max_staleness))
+        try:
+            yield
+        finally:
+            current_reader.reset(token)
+
+    def database(self):
+        return current_reader.get() or self.entry(current_tenant.get())['database']
+
+
+def database_change_time(path):
+    """
+        Last time a SQLite database file or its write-ahead log was written:
+
+    """
+    return max(os.path.getmtime(file_path) for file_path in (path, f"{path}-wal") if os.path.exists(file_path))
+
+
+class TableProxy:
+    """
+        Stand-in for a dataset table that resolves to the table of the current tenant on every use:
+
+    """
+    def __init__(self, table_name):
+        self.table_name = table_name
+
+    def __getattr__(self, attribute):
+        return getattr(tenant_databases.database()[self.table_name], attribute)
+
+
+class DatabaseProxy:
+    """
+        Stand-in for the dataset database of the current tenant, so module level code keeps using `db`:
+
+    """
+    def __getattr__(self, attribute):
+        return getattr(tenant_databases.database(), attribute)
+
+    def __getitem__(self, table_name):
+        return TableProxy(table_name)
+
+    def __contains__(self, table_name):
+        return table_name in tenant_databases.database()
+
+    def __enter__(self):
+        return tenant_databases.database().__enter__()
+
+    def __exit__(self, error_type, error_value, traceback):
+        return tenant_databases.database().__exit__(error_type, error_value, traceback)
+
+
+def tenant_cache(name):
+    """
+        In-memory cache dict of the current tenant, dropped together with its database:
+
+    """
+    return tenant_databases.entry(current_tenant.get())['cache'].setdefault(name, {})
+
+
+def on_database_open(function):
+    """
+        Run a schema function on the default database now and on every tenant database when it is opened:
+
+    """
+    database_open_functions.append(function)
+    function()
+
+
+tenant_databases = TenantDatabases('sqlite:///sqlitefile.db', tenant_data_path, tenant_cache_size)
+db = DatabaseProxy()
+# background loops look up the tenants they have work in here, in the default database, instead of opening them all
+tenant_work_table = tenant_databases.default_entry['database']['tenant_work']
+
+
+def ensure_tenant_work():
+    """
+        Create the tenant_work table, when each tenant next has work for a background loop:
+
+    """
+    for column in ['tenant', 'work', 'due']:
+        tenant_work_table.create_column(column, tenant_work_table.db.types.string)
+    tenant_work_table.create_index(['work', 'tenant'])
+
+
+ensure_tenant_work()
+
+
+def schedule_tenant_work(work, due):
+    """
+        Record when a background loop next has work in the current tenant database, None when it has none:
+
+    """
+    tenant = current_tenant.get()
+    if tenant is not None:
+        tenant_work_table.upsert({'tenant': tenant, 'work': work, 'due': due}, ['tenant', 'work'])
+
+
+def tenants_with_work(work, due_by):
+    """
+        The default database, every tenant with work due by due_by and the tenants not scheduled yet, which are
+        opened once so their schema functions schedule them:
+
+    """
+    scheduled = {row['tenant']: row['due'] for row in tenant_work_table.find(work=work)}
+    return [None] + [tenant for tenant in tenant_databases.stored_tenants()
+                     if tenant not in scheduled or (scheduled[tenant] is not None and scheduled[tenant] <= due_by)]
+
+
+@contextmanager
+def scratch_tenant(name):
+    """
+        Route db to a throwaway tenant in a scratch directory, for command line checks that must leave the real
+        databases alone:
+
+    """
+    tenant = f"{name}-{os.getpid()}"
+    data_path, template_path = tenant_databases.data_path, tenant_databases.template_path
+    tenant_databases.data_path = tempfile.mkdtemp(prefix=f"{name}-")
+    tenant_databases.template_path = os.path.join(tenant_databases.data_path, '.template.db')
+    try:
+        with tenant_databases.use(tenant):
+            yield tenant
+    finally:
+        max_open, tenant_databases.max_open = tenant_databases.max_open, 0
+        tenant_databases.evict()
+        tenant_databases.max_open = max_open
+        shutil.rmtree(tenant_databases.data_path, ignore_errors=True)
+        tenant_databases.data_path, tenant_databases.template_path = data_path, template_path
+        tenant_work_table.delete(tenant=tenant)
 
-# connecting to a SQLite database
-db = dataset.connect('sqlite:///sqlitefile.db')
 
 # get a reference to the object tables
 owner_info_table = db['owner_info']
@@ -28,8 +363,902 @@ credit_memo_table = db['credit_memo']
 vendor_credit_memo_table = db['vendor_credit_memo']
 quote_table = db['quote']
 connection_table = db['connection']
+journal_line_table = db['journal_line']
+journal_line_dimension_table = db['journal_line_dimension']
+journal_tax_line_table = db['journal_tax_line']
+tax_code_table = db['tax_code']
+bank_statement_table = db['bank_statement']
+bank_statement_line_table = db['bank_statement_line']
+job_table = db['job']
+stock_movement_table = db['stock_movement']
+cost_layer_table = db['cost_layer']
+
+class Histogram:
+    """
+        Prometheus-style cumulative histogram with labels, safe to observe from worker threads:
+
+    """
+    def __init__(self, name, documentation, label_names,
+                 buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(label_name, '')) for label_name in self.label_names)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for index, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    series['buckets'][index] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, series in sorted(self.series.items()):
+                labels = [f'{label_name}="{value}"' for label_name, value in zip(self.label_names, key)]
+                bucket_counts = list(zip(self.buckets, series['buckets'])) + [('+Inf', series['count'])]
+                for upper_bound, count in bucket_counts:
+                    bucket_labels = ",".join(labels + [f'le="{upper_bound}"'])
+                    lines.append(f"{self.name}_bucket{{{bucket_labels}}} {count}")
+                lines.append(f"{self.name}_sum{{{','.join(labels)}}} {series['sum']}")
+                lines.append(f"{self.name}_count{{{','.join(labels)}}} {series['count']}")
+        return "\n".join(lines)
+
+
+class StageTimer:
+    """
+        Lap timer that attributes elapsed time to the current stage, summed across loops and observed once:
+
+    """
+    def __init__(self, histogram, **labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.totals = {}
+        self.current_stage = None
+        self.stage_start = None
+
+    def switch(self, stage):
+        now = time.perf_counter()
+        if self.current_stage is not None:
+            self.totals[self.current_stage] = self.totals.get(self.current_stage, 0.0) + now - self.stage_start
+        self.current_stage = stage
+        self.stage_start = now
+
+    def observe(self):
+        self.switch(None)
+        for stage, total in self.totals.items():
+            self.histogram.observe(total, stage=stage, **self.labels)
+
+
+http_request_seconds = Histogram('http_request_duration_seconds', 'Time spent handling HTTP requests.',
+                                 ['method', 'route', 'status'])
+db_query_seconds = Histogram('db_query_duration_seconds', 'Time spent executing SQL statements.', ['statement'])
+db_queries_per_request = Histogram('db_queries_per_request', 'SQL statements executed per HTTP request.',
+                                   ['route'], buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250, 1000))
+journal_lines_json_seconds = Histogram('journal_lines_json_seconds', 'Time spent encoding or decoding journal_lines.',
+                                       ['operation'])
+report_stage_seconds = Histogram('report_stage_seconds', 'Time spent per report stage.', ['report', 'stage'])
+admission_wait_seconds = Histogram('admission_wait_seconds', 'Time requests waited for admission, by outcome.',
+                                   ['gate', 'outcome'])
+webhook_delivery_seconds = Histogram('webhook_delivery_seconds', 'Time spent posting a webhook batch, by outcome.',
+                                     ['outcome'])
+metrics = [http_request_seconds, db_query_seconds, db_queries_per_request, journal_lines_json_seconds,
+           report_stage_seconds, admission_wait_seconds, webhook_delivery_seconds]
+
+# number of SQL statements run by the current request, None outside of a request
+request_query_count = ContextVar('request_query_count', default=None)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start_time'].pop()
+    db_query_seconds.observe(elapsed, statement=statement.split(None, 1)[0].upper())
+    query_count = request_query_count.get()
+    if query_count is not None:
+        query_count[0] += 1
+    if elapsed >= slow_query_seconds:
+        record_slow_query(statement, parameters, elapsed)
+
+
+# slow query log: SELECT shapes slower than SLOW_QUERY_SECONDS, explained in the background with index suggestions
+slow_query_seconds = float(os.environ.get('SLOW_QUERY_SECONDS', '0.1'))
+slow_query_log_size = int(os.environ.get('SLOW_QUERY_LOG_SIZE', '200'))
+# AUTO_CREATE_INDEXES=1 creates the suggested indexes as soon as a slow query has been explained
+auto_create_indexes = os.environ.get('AUTO_CREATE_INDEXES', '0') == '1'
+slow_query_log = OrderedDict()
+slow_query_lock = threading.Lock()
+slow_query_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='slow-query-advisor')
+sql_normalizers = [
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r':\w+'), '?'),
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)'), '(?)'),
+    (re.compile(r'\s+'), ' '),
+]
+
+
+def normalize_sql(statement):
+    """
+        Reduce a SQL statement to its shape, literals and parameters become ? and IN lists collapse to (?):
+
+    """
+    for pattern, replacement in sql_normalizers:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip().rstrip(';').lower()
+
+
+def record_slow_query(statement, parameters, elapsed):
+    """
+        Count a slow SELECT under its normalized shape, queueing the first sample of a new shape for EXPLAIN:
+
+    """
+    if not re.match(r'\s*(select|with)\b', statement, re.IGNORECASE):
+        return
+    tenant = current_tenant.get()
+    normalized = normalize_sql(statement)
+    key = (tenant, normalized)
+    with slow_query_lock:
+        record = slow_query_log.get(key)
+        is_new = record is None
+        if is_new:
+            record = slow_query_log[key] = {
+                'id': format(zlib.crc32(normalized.encode()), '08x'),
+                'tenant': tenant,
+                'sql': normalized,
+                'calls': 0,
+                'total_seconds': 0.0,
+                'max_seconds': 0.0,
+                'last_seen': None,
+                'plan': None,
+                'full_scans': [],
+                'temp_b_tree': False,
+                'suggested_indexes': [],
+                'created_indexes': [],
+                # sample values stay in memory for EXPLAIN and are never returned by the admin endpoint
+                'sample': (statement, parameters),
+            }
+            while len(slow_query_log) > slow_query_log_size:
+                slow_query_log.popitem(last=False)
+        else:
+            slow_query_log.move_to_end(key)
+        record['calls'] += 1
+        record['total_seconds'] += elapsed
+        record['max_seconds'] = max(record['max_seconds'], elapsed)
+        record['last_seen'] = datetime.now(timezone.utc).isoformat()
+    if is_new:
+        slow_query_executor.submit(advise_slow_query, record)
+
+
+sql_table_reference = re.compile(r'\b(?:from|join)\s+"?(\w+)"?(?:\s+(?:as\s+)?(\w+))?')
+sql_predicate = re.compile(r'(?:(\w+)\.)?(\w+)\s*(==|=|<=|>=|<|>|\bin\b|\bbetween\b|\blike\b|\bis\b)')
+sql_column_reference = re.compile(r'(?:(\w+)\.)?(\w+)')
+plan_table_scan = re.compile(r'^scan (?:table )?(\w+)(?: as (\w+))?(.*)$')
+sql_keywords = {'where', 'join', 'inner', 'left', 'right', 'full', 'cross', 'natural', 'outer', 'on', 'using',
+                'group', 'order', 'limit', 'union', 'except', 'intersect', 'having', 'window'}
+equality_operators = {'=', '==', 'in', 'is'}
+# wider covering indexes cost more on every write than they save on reads
+covering_index_max_columns = 6
+
+
+def sql_clause(sql, keyword, terminators):
+    """
+        Text of the first clause starting with keyword, up to the next terminating keyword:
+
+    """
+    match = re.search(rf'\b{keyword}\b(.*?)(?:\b(?:{"|".join(terminators)})\b|$)', sql)
+    return match.group(1) if match else ''
+
+
+def referenced_columns(clause_text, references, columns):
+    """
+        Columns of one table named by plain comma separated column references, None when any item is something else:
+
+    """
+    found = []
+    for item in clause_text.split(','):
+        item = re.sub(r'\s+(asc|desc)$', '', item.strip())
+        match = sql_column_reference.fullmatch(item)
+        if not match:
+            return None
+        qualifier, column = match.groups()
+        if qualifier not in references or column not in columns:
+            return None
+        found.append(column)
+    return found
+
+
+def suggest_index(sql, table, references):
+    """
+        Suggest an index for a table scanned by a query: equality columns, then one range or the sort columns,
+        then the selected columns while the index stays narrow enough to cover the query:
+
+    """
+    columns = [row[1] for row in fetch_rows(f'PRAGMA table_info("{table}")')]
+    references = references | {table, None}
+    where_text = sql_clause(sql, 'where', ['group', 'order', 'limit', 'having', 'union'])
+    equality_columns, range_columns = [], []
+    for qualifier, column, operator in sql_predicate.findall(where_text):
+        if (qualifier or None) in references and column in columns:
+            target = equality_columns if operator in equality_operators else range_columns
+            if column not in equality_columns + range_columns:
+                target.append(column)
+    index_columns = list(equality_columns)
+    if range_columns:
+        index_columns.append(range_columns[0])
+    else:
+        sort_text = sql_clause(sql, 'group by', ['having', 'order', 'limit']) or \
+            sql_clause(sql, 'order by', ['limit'])
+        sort_columns = referenced_columns(sort_text, references, columns) if sort_text else []
+        index_columns.extend(column for column in sort_columns or [] if column not in index_columns)
+    if not index_columns:
+        return None
+    selected = sql_clause(sql.replace('select distinct', 'select'), 'select', ['from'])
+    selected_columns = referenced_columns(selected, references, columns) if '*' not in selected else None
+    if selected_columns is not None:
+        covering_columns = index_columns + [column for column in selected_columns if column not in index_columns]
+        if len(covering_columns) <= covering_index_max_columns:
+            index_columns = covering_columns
+    for index in fetch_rows(f'PRAGMA index_list("{table}")'):
+        indexed = [row[2] for row in fetch_rows(f'PRAGMA index_info("{index[1]}")')]
+        if indexed[:len(index_columns)] == index_columns:
+            return None
+    index_name = f"ix_{table}_{'_'.join(index_columns)}"
+    return f'CREATE INDEX IF NOT EXISTS "{index_name}" ON "{table}" ({", ".join(index_columns)})'
+
+
+def explain_slow_query(record):
+    """
+        Store the EXPLAIN QUERY PLAN of a slow query shape, the tables it fully scans and the indexes to add:
+
+    """
+    statement, parameters = record['sample']
+    plan = [row[3] for row in db.executable.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters)]
+    sql = record['sql']
+    aliases = {}
+    for table, alias in sql_table_reference.findall(sql):
+        if alias and alias not in sql_keywords:
+            aliases[alias] = table
+    full_scans, suggested_indexes = [], []
+    for detail in plan:
+        match = plan_table_scan.match(detail.lower())
+        if not match or 'using' in match.group(3) or 'virtual table' in match.group(3):
+            continue
+        name = match.group(2) or match.group(1)
+        table = aliases.get(name, match.group(1))
+        if not fetch_rows("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name", name=table):
+            # scans of subqueries and common table expressions have no table to index
+            continue
+        full_scans.append(table)
+        references = {alias for alias, aliased_table in aliases.items() if aliased_table == table}
+        index = suggest_index(sql, table, references)
+        if index and index not in suggested_indexes:
+            suggested_indexes.append(index)
+    record['plan'] = plan
+    record['full_scans'] = full_scans
+    record['temp_b_tree'] = any(detail.startswith('USE TEMP B-TREE') for detail in plan)
+    record['suggested_indexes'] = suggested_indexes
+
+
+def create_suggested_indexes(record):
+    """
+        Create the suggested indexes of a slow query shape and explain it again:
+
+    """
+    with db:
+        for index in record['suggested_indexes']:
+            print(f"creating index for slow query {record['id']}: {index}")
+            db.query(index)
+            record['created_indexes'].append(index)
+    explain_slow_query(record)
+
+
+def advise_slow_query(record):
+    """
+        Explain a new slow query shape on its tenant database, creating the indexes when AUTO_CREATE_INDEXES is on:
+
+    """
+    try:
+        with tenant_databases.use(record['tenant']):
+            explain_slow_query(record)
+            if auto_create_indexes and record['suggested_indexes']:
+                create_suggested_indexes(record)
+    except Exception as error:
+        print(f"could not explain slow query {record['id']}: {error}")
+
+
+# columns covered by the FTS5 full-text search indexes, per content table
+search_index_columns = {
+    'journal_entry': ['description'],
+    'account': ['display_name', 'description'],
+    'contact': ['display_name', 'company_name', 'email_address', 'description'],
+}
+
+
+def ensure_search_indexes():
+    """
+        Create the FTS5 search indexes and the triggers that keep them in sync:
+
+    """
+    for table_name, columns in search_index_columns.items():
+        table = db[table_name]
+        for column in columns:
+            table.create_column(column, db.types.text)
+
+        fts_table_name = f"{table_name}_fts"
+        fts_exists = list(db.query("SELECT name FROM sqlite_master WHERE type = 'table' AND name = :name",
+                                   name=fts_table_name))
+        column_list = ", ".join(columns)
+        new_column_list = ", ".join(f"new.{column}" for column in columns)
+        old_column_list = ", ".join(f"old.{column}" for column in columns)
+        with db:
+            db.query(f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table_name} "
+                     f"USING fts5({column_list}, content='{table_name}', content_rowid='id')")
+            db.query(f"CREATE TRIGGER IF NOT EXISTS {fts_table_name}_ai AFTER INSERT ON {table_name} BEGIN "
+                     f"INSERT INTO {fts_table_name}(rowid, {column_list}) VALUES (new.id, {new_column_list}); "
+                     f"END")
+            db.query(f"CREATE TRIGGER IF NOT EXISTS {fts_table_name}_ad AFTER DELETE ON {table_name} BEGIN "
+                     f"INSERT INTO {fts_table_name}({fts_table_name}, rowid, {column_list}) "
+                     f"VALUES ('delete', old.id, {old_column_list}); "
+                     f"END")
+            db.query(f"CREATE TRIGGER IF NOT EXISTS {fts_table_name}_au AFTER UPDATE OF {column_list} "
+                     f"ON {table_name} BEGIN "
+                     f"INSERT INTO {fts_table_name}({fts_table_name}, rowid, {column_list}) "
+                     f"VALUES ('delete', old.id, {old_column_list}); "
+                     f"INSERT INTO {fts_table_name}(rowid, {column_list}) VALUES (new.id, {new_column_list}); "
+                     f"END")
+            if not fts_exists:
+                # index the rows that were written before the search index existed
+                db.query(f"INSERT INTO {fts_table_name}({fts_table_name}) VALUES ('rebuild')")
+
+
+on_database_open(ensure_search_indexes)
+
+
+def fetch_rows(statement, **params):
+    """
+        Run a read-only statement and return plain tuples, skipping the per-row dict conversion of db.query:
+
+    """
+    return db.executable.execute(text(statement), params).fetchall()
+
+
+def dump_json(value):
+    return orjson.dumps(value).decode() if orjson else json.dumps(value)
+
+
+def load_json(value):
+    return orjson.loads(value) if orjson else json.loads(value)
+
+
+def fast_json_response(content):
+    """
+        Render plain dicts straight to a response, skipping FastAPI's jsonable_encoder pass:
+
+    """
+    if orjson:
+        return ORJSONResponse(content)
+    return JSONResponse(jsonable_encoder(content))
+
+
+def execute_many(statement, parameters):
+    """
+        Run one statement for many parameter tuples straight through the sqlite driver (call inside `with db:`):
+
+    """
+    if parameters:
+        db.executable.exec_driver_sql(statement, parameters)
+
+
+# exchange rates: units of the base currency per unit of a foreign currency, cached in memory per currency
+base_currency = os.environ.get('BASE_CURRENCY', 'USD').upper()
+fx_rate_table = db['fx_rate']
+
+
+def ensure_fx_rates():
+    """
+        Create the fx_rate table, import FX_RATES_PATH when set and load every rate into memory:
+
+    """
+    fx_rate_table.create_column('currency', db.types.string)
+    fx_rate_table.create_column('date', db.types.string)
+    fx_rate_table.create_column('rate', db.types.float)
+    with db:
+        db.query("CREATE UNIQUE INDEX IF NOT EXISTS ix_fx_rate_currency_date ON fx_rate (currency, date)")
+    fx_rates_path = os.environ.get('FX_RATES_PATH')
+    if fx_rates_path and os.path.exists(fx_rates_path):
+        with open(fx_rates_path, encoding='utf-8-sig') as fx_rates_file:
+            save_fx_rates(parse_fx_rates_csv(fx_rates_file.read()))
+    load_fx_rates()
+
+
+def parse_fx_rates_csv(content):
+    """
+        Parse date,currency,rate CSV rows into (currency, date, rate) tuples:
+
+    """
+    fx_rate_rows = []
+    # line 1 is the header
+    for line_number, row in enumerate(csv.DictReader(io.StringIO(content)), start=2):
+        row = {str(key).strip().lower(): value for key, value in row.items() if key}
+        try:
+            fx_rate_rows.append((str(row['currency']).strip().upper(),
+                                 date.fromisoformat(row['date'].strip()).isoformat(), float(row['rate'])))
+        except KeyError as error:
+            raise HTTPException(status_code=400, detail=f"Line {line_number} has no {error} column")
+        except (AttributeError, TypeError, ValueError):
+            raise HTTPException(status_code=400,
+                                detail=f"Line {line_number} needs a YYYY-MM-DD date and a number rate, "
+                                       f"not {row.get('date')!r} and {row.get('rate')!r}")
+    return fx_rate_rows
+
+
+def save_fx_rates(fx_rate_rows):
+    with db:
+        execute_many("INSERT INTO fx_rate (currency, date, rate) VALUES (?, ?, ?) "
+                     "ON CONFLICT (currency, date) DO UPDATE SET rate = excluded.rate", fx_rate_rows)
+    load_fx_rates({currency for currency, fx_date, rate in fx_rate_rows})
+
+
+def load_fx_rates(currencies=None):
+    """
+        Rebuild the sorted (dates, rates) arrays of the given currencies, or of all of them:
+
+    """
+    fx_rates = tenant_cache('fx_rates')
+    loaded = {}
+    for currency, fx_date, rate in fetch_rows("SELECT currency, date, rate FROM fx_rate ORDER BY currency, date"):
+        if currencies is None or currency in currencies:
+            dates, rates = loaded.setdefault(currency, ([], []))
+            dates.append(fx_date)
+            rates.append(rate)
+    if currencies is None:
+        fx_rates.clear()
+    for currency in currencies or []:
+        fx_rates.pop(currency, None)
+    # swap whole entries so concurrent lookups never see half-built arrays
+    fx_rates.update(loaded)
+
+
+def fx_rate_for(currency, on_date):
+    """
+        Look up the latest rate on or before on_date, or None when there is none:
+
+    """
+    if not currency or currency == base_currency:
+        return 1.0
+    fx_rates = tenant_cache('fx_rates')
+    if currency not in fx_rates:
+        return None
+    dates, rates = fx_rates[currency]
+    index = bisect_right(dates, str(on_date)) - 1
+    return rates[index] if index >= 0 else None
+
+
+def convert_journal_lines(journal_lines, on_date):
+    """
+        Fill in currency and exchange_rate on every line and return the entry total in the base currency:
+
+    """
+    base_total = 0.0
+    for line in journal_lines:
+        currency = str(line.get('currency') or base_currency).upper()
+        exchange_rate = line.get('exchange_rate') or fx_rate_for(currency, on_date)
+        if not exchange_rate:
+            raise HTTPException(status_code=400, detail=f"No exchange rate for {currency} on {on_date}")
+        line['currency'] = currency
+        line['exchange_rate'] = exchange_rate
+        base_total += line['amount'] if currency == base_currency else round(line['amount'] * exchange_rate, 2)
+    return base_total
+
+
+def base_amount(line, on_date):
+    """
+        Convert a journal line amount to the base currency using its own rate, falling back to the FX table:
+
+    """
+    if line.get('base_amount') is not None:
+        # revaluation lines move only the base currency value of a foreign balance
+        return line['base_amount']
+    currency = line.get('currency')
+    if not currency or currency == base_currency:
+        return line['amount']
+    exchange_rate = line.get('exchange_rate') or fx_rate_for(currency, on_date) or 1.0
+    return round(line['amount'] * exchange_rate, 2)
+
+
+def explode_journal_lines(journal_entry_id, journal_entry_dict, journal_lines):
+    """
+        Flatten the journal_lines of a journal entry into journal_line rows:
+
+    """
+    return [
+        {
+            'journal_entry_id': journal_entry_id,
+            'line_number': line_number,
+            'date': journal_entry_dict.get('date'),
+            'description': line.get('description') or journal_entry_dict.get('description'),
+            'account_code': line.get('account_code'),
+            'account_type': line.get('account_type'),
+            'amount': line.get('amount'),
+            'currency': line.get('currency') or base_currency,
+            'exchange_rate': line.get('exchange_rate') or 1.0,
+            'base_amount': base_amount(line, journal_entry_dict.get('date')) if line.get('amount') is not None
+            else None,
+            'posting_type': line.get('posting_type'),
+            'reconciled': False,
+            'statement_line_id': None,
+            'last_updated_time': journal_entry_dict.get('last_updated_time'),
+        }
+        for line_number, line in enumerate(journal_lines or [])
+    ]
+
+
+def ensure_journal_lines():
+    """
+        Create the indexed journal_line table and backfill it from existing journal entries:
+
+    """
+    journal_line_columns = {
+        'journal_entry_id': db.types.integer,
+        'line_number': db.types.integer,
+        'date': db.types.string,
+        'description': db.types.text,
+        'account_code': db.types.string,
+        'account_type': db.types.string,
+        'amount': db.types.float,
+        'currency': db.types.string,
+        'exchange_rate': db.types.float,
+        'base_amount': db.types.float,
+        'posting_type': db.types.string,
+        'reconciled': db.types.boolean,
+        'statement_line_id': db.types.integer,
+        'last_updated_time': db.types.string,
+    }
+    for column, column_type in journal_line_columns.items():
+        journal_line_table.create_column(column, column_type)
+    journal_line_table.create_index(['journal_entry_id'])
+    journal_line_table.create_index(['account_code', 'reconciled', 'date'])
+    journal_line_table.create_index(['account_type', 'date'])
+    with db:
+        # lines written before multi-currency support are in the base currency
+        db.query("UPDATE journal_line SET currency = :currency, exchange_rate = 1.0, base_amount = amount "
+                 "WHERE currency IS NULL", currency=base_currency)
+
+    if journal_line_table.count() == 0 and journal_entry_table.count() > 0:
+        journal_lines = []
+        for row in journal_entry_table.find(order_by='id'):
+            journal_lines.extend(explode_journal_lines(row['id'], row, load_json(row['journal_lines'] or 'null')))
+        print(f"backfilling {len(journal_lines)} journal lines")
+        with db:
+            journal_line_table.insert_many(journal_lines)
+
+
+on_database_open(ensure_fx_rates)
+on_database_open(ensure_journal_lines)
+
+
+def explode_line_dimensions(journal_entry_id, journal_lines):
+    """
+        Flatten the dimension tags of journal lines into journal_line_dimension rows, names are case insensitive
+        and the last tag wins when a line spells one name twice:
+
+    """
+    dimension_rows = []
+    for line_number, line in enumerate(journal_lines or []):
+        tags = {str(dimension).strip().lower(): str(value)
+                for dimension, value in (line.get('dimensions') or {}).items()
+                if str(dimension).strip() and value is not None and str(value) != ''}
+        dimension_rows.extend({'journal_entry_id': journal_entry_id, 'line_number': line_number,
+                               'dimension': dimension, 'value': value}
+                              for dimension, value in tags.items())
+    return dimension_rows
+
+
+def ensure_line_dimensions():
+    """
+        Create the journal_line_dimension table holding the tracking tags (class, department, project) of lines:
+
+    """
+    journal_line_dimension_columns = {
+        'journal_entry_id': db.types.integer,
+        'line_number': db.types.integer,
+        'dimension': db.types.string,
+        'value': db.types.string,
+    }
+    for column, column_type in journal_line_dimension_columns.items():
+        journal_line_dimension_table.create_column(column, column_type)
+    # joins from journal_line and slicing by one dimension value both stay on an index
+    line_columns = ['journal_entry_id', 'line_number', 'dimension']
+    indexes = [row[1] for row in fetch_rows('PRAGMA index_list("journal_line_dimension")')]
+    if 'ix_journal_line_dimension_line' not in indexes:
+        with db:
+            # older databases may repeat a dimension on a line under a plain index, keep the last tag
+            db.query("DELETE FROM journal_line_dimension WHERE id NOT IN "
+                     "(SELECT MAX(id) FROM journal_line_dimension GROUP BY journal_entry_id, line_number, dimension)")
+            for index_name in indexes:
+                if [row[2] for row in fetch_rows(f'PRAGMA index_info("{index_name}")')] == line_columns:
+                    db.query(f'DROP INDEX "{index_name}"')
+            db.query("CREATE UNIQUE INDEX ix_journal_line_dimension_line "
+                     "ON journal_line_dimension (journal_entry_id, line_number, dimension)")
+    journal_line_dimension_table.create_index(['dimension', 'value'])
+
+
+on_database_open(ensure_line_dimensions)
+
+
+def explode_tax_lines(journal_entry_id, journal_entry_dict, journal_lines):
+    """
+        Flatten the taxed journal lines into journal_tax_line rows, amounts in the base currency:
+
+    """
+    if not journal_lines:
+        return []
+    on_date = journal_entry_dict.get('date')
+    return [
+        {'journal_entry_id': journal_entry_id, 'line_number': line_number, 'date': on_date,
+         'tax_code': line['tax_code'], 'tax_rate': line.get('tax_rate'), 'taxable_amount': base_amount(line, on_date),
+         'tax_amount': base_amount(dict(line, amount=line['tax_amount']), on_date)}
+        for line_number, line in enumerate(journal_lines or [])
+        if line.get('tax_code') and not line.get('tax_line') and line.get('tax_amount') is not None
+        and line.get('amount') is not None
+    ]
+
+
+def ensure_tax_lines():
+    """
+        Create the tax_code table and the journal_tax_line table the tax summary report aggregates:
+
+    """
+    tax_code_columns = {
+        'code': db.types.string,
+        'name': db.types.string,
+        'rate': db.types.float,
+        'tax_type': db.types.string,
+        'tax_account_code': db.types.string,
+        'active': db.types.boolean,
+        'last_updated_time': db.types.string,
+    }
+    for column, column_type in tax_code_columns.items():
+        tax_code_table.create_column(column, column_type)
+    tax_code_table.create_index(['code'])
+    journal_tax_line_columns = {
+        'journal_entry_id': db.types.integer,
+        'line_number': db.types.integer,
+        'date': db.types.string,
+        'tax_code': db.types.string,
+        'tax_rate': db.types.float,
+        'taxable_amount': db.types.float,
+        'tax_amount': db.types.float,
+    }
+    for column, column_type in journal_tax_line_columns.items():
+        journal_tax_line_table.create_column(column, column_type)
+    journal_tax_line_table.create_index(['journal_entry_id'])
+    # the tax summary filters on a period, one code at a time or all of them
+    journal_tax_line_table.create_index(['tax_code', 'date'])
+    journal_tax_line_table.create_index(['date'])
+
+
+on_database_open(ensure_tax_lines)
+
+
+def ensure_bank_statements():
+    """
+        Create the bank statement tables used by reconciliation:
+
+    """
+    bank_statement_columns = {
+        'account_code': db.types.string,
+        'file_format': db.types.string,
+        'imported_time': db.types.string,
+        'line_count': db.types.integer,
+    }
+    for column, column_type in bank_statement_columns.items():
+        bank_statement_table.create_column(column, column_type)
+
+    bank_statement_line_columns = {
+        'bank_statement_id': db.types.integer,
+        'account_code': db.types.string,
+        'date': db.types.string,
+        'amount': db.types.float,
+        'description': db.types.text,
+        'reference': db.types.string,
+        'reconciled': db.types.boolean,
+        'journal_line_id': db.types.integer,
+        'match_score': db.types.float,
+    }
+    for column, column_type in bank_statement_line_columns.items():
+        bank_statement_line_table.create_column(column, column_type)
+    bank_statement_line_table.create_index(['bank_statement_id', 'reconciled'])
+
+
+on_database_open(ensure_bank_statements)
+
+
+def insert_journal_entries(journal_entry_dicts):
+    """
+        Insert many journal entries and all of their journal_line rows in one transaction, returning the new ids:
+
+    """
+    check_open_fiscal_years({journal_entry_dict['date'] for journal_entry_dict in journal_entry_dicts})
+    last_updated_time = datetime.now(timezone.utc).isoformat()
+    json_journal_entry_dicts = []
+    for journal_entry_dict in journal_entry_dicts:
+        journal_entry_dict['last_updated_time'] = last_updated_time
+        json_journal_entry_dict = dict(journal_entry_dict)
+        with journal_lines_json_seconds.time(operation='encode'):
+            json_journal_entry_dict['journal_lines'] = dump_json(journal_entry_dict['journal_lines'])
+        json_journal_entry_dicts.append(json_journal_entry_dict)
+        for column, value in json_journal_entry_dict.items():
+            if not journal_entry_table.has_column(column):
+                journal_entry_table.create_column_by_example(column, value)
+
+    journal_entry_ids = []
+    journal_lines = []
+    line_dimensions = []
+    tax_lines = []
+    insert_statement = journal_entry_table.table.insert()
+    with db:
+        keep_archived_ids('journal_entry', json_journal_entry_dicts)
+        for journal_entry_dict, json_journal_entry_dict in zip(journal_entry_dicts, json_journal_entry_dicts):
+            journal_entry_id = db.executable.execute(insert_statement, json_journal_entry_dict).inserted_primary_key[0]
+            journal_entry_ids.append(journal_entry_id)
+            journal_lines.extend(explode_journal_lines(journal_entry_id, journal_entry_dict,
+                                                       journal_entry_dict['journal_lines']))
+            line_dimensions.extend(explode_line_dimensions(journal_entry_id, journal_entry_dict['journal_lines']))
+            tax_lines.extend(explode_tax_lines(journal_entry_id, journal_entry_dict,
+                                               journal_entry_dict['journal_lines']))
+        keep_archived_ids('journal_line', journal_lines)
+        journal_line_table.insert_many(journal_lines)
+        keep_archived_ids('journal_line_dimension', line_dimensions)
+        journal_line_dimension_table.insert_many(line_dimensions)
+        keep_archived_ids('journal_tax_line', tax_lines)
+        journal_tax_line_table.insert_many(tax_lines)
+        enqueue_events([('journal_entry.created', dict(journal_entry_dict, id=journal_entry_id))
+                        for journal_entry_dict, journal_entry_id in zip(journal_entry_dicts, journal_entry_ids)])
+    return journal_entry_ids
+
+
+def insert_journal_entry(journal_entry_dict):
+    """
+        Insert a journal entry and its journal_line rows in one transaction:
+
+    """
+    return insert_journal_entries([journal_entry_dict])[0]
+
+
+def replace_journal_lines(journal_entry_id, journal_entry_dict, journal_lines):
+    """
+        Rewrite the journal_line rows of an updated journal entry, keeping reconciliation of unchanged lines.
+        Lines are updated in place by line number so they keep their row id, an export since_id does not
+        receive an edited line a second time as a new row, a since timestamp export receives the update:
+
+    """
+    existing_lines = {line['line_number']: line for line in journal_line_table.find(journal_entry_id=journal_entry_id)}
+    new_lines = explode_journal_lines(journal_entry_id, journal_entry_dict, journal_lines)
+    for line in new_lines:
+        existing_line = existing_lines.get(line['line_number'])
+        if not existing_line:
+            continue
+        line['id'] = existing_line['id']
+        if existing_line['reconciled'] and \
+                existing_line['account_code'] == line['account_code'] and existing_line['amount'] == line['amount']:
+            # the matched bank_statement_line still points at this row
+            line['reconciled'] = True
+            line['statement_line_id'] = existing_line['statement_line_id']
+    kept_statement_lines = {line['statement_line_id'] for line in new_lines if line['statement_line_id']}
+    released_statement_lines = [
+        {'id': line['statement_line_id'], 'journal_line_id': None, 'reconciled': False, 'match_score': None}
+        for line in existing_lines.values()
+        if line['statement_line_id'] and line['statement_line_id'] not in kept_statement_lines
+    ]
+    line_dimensions = explode_line_dimensions(journal_entry_id, journal_lines)
+    tax_lines = explode_tax_lines(journal_entry_id, journal_entry_dict, journal_lines)
+    kept_line_numbers = {line['line_number'] for line in new_lines}
+    removed_line_ids = [line['id'] for line in existing_lines.values() if line['line_number'] not in kept_line_numbers]
+    if removed_line_ids:
+        journal_line_table.delete(id=removed_line_ids)
+    journal_line_table.update_many([line for line in new_lines if 'id' in line], ['id'])
+    added_lines = [line for line in new_lines if 'id' not in line]
+    keep_archived_ids('journal_line', added_lines)
+    journal_line_table.insert_many(added_lines)
+    journal_line_dimension_table.delete(journal_entry_id=journal_entry_id)
+    keep_archived_ids('journal_line_dimension', line_dimensions)
+    journal_line_dimension_table.insert_many(line_dimensions)
+    journal_tax_line_table.delete(journal_entry_id=journal_entry_id)
+    keep_archived_ids('journal_tax_line', tax_lines)
+    journal_tax_line_table.insert_many(tax_lines)
+    bank_statement_line_table.update_many(released_statement_lines, ['id'])
+
+
+versioned_tables = [account_table, crypto_wallet_table, journal_entry_table]
+
+
+def ensure_row_versions():
+    """
+        Add the version column used for optimistic concurrency, existing rows start at version 1:
+
+    """
+    for table in versioned_tables:
+        table.create_column('version', db.types.integer, nullable=False, server_default=text('1'))
 
-app = FastAPI()
+
+on_database_open(ensure_row_versions)
+
+
+def entity_tag(version):
+    """
+        Format a row version as an ETag header value:
+
+    """
+    return f'"{version}"'
+
+
+def parse_if_match(if_match):
+    """
+        Read the expected row version from an If-Match header, None means update unconditionally:
+
+    """
+    if if_match is None or if_match.strip() == '*':
+        return None
+    tag = if_match.split(',')[0].strip()
+    if tag.startswith('W/'):
+        tag = tag[2:]
+    try:
+        return int(tag.strip('"'))
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"If-Match must be an ETag returned by this API, not {if_match}")
+
+
+def update_versioned_row(table, row_id, values, expected_version=None):
+    """
+        Update a row and bump its version with a single UPDATE ... WHERE id = ? AND version = ?, returning the new version:
+
+    """
+    for column, value in values.items():
+        if not table.has_column(column):
+            table.create_column_by_example(column, value)
+    sqlalchemy_table = table.table
+    statement = sqlalchemy_table.update().where(sqlalchemy_table.c.id == row_id)
+    if expected_version is not None:
+        statement = statement.where(sqlalchemy_table.c.version == expected_version)
+    statement = statement.values(**{column: value for column, value in values.items() if column != 'id'},
+                                 version=sqlalchemy_table.c.version + 1)
+    with db:
+        updated = db.executable.execute(statement).rowcount
+    if updated:
+        if expected_version is not None:
+            return expected_version + 1
+        return fetch_rows(f"SELECT version FROM {table.name} WHERE id = :id", id=row_id)[0][0]
+    # only a failed update pays for the read telling a missing row from a stale version
+    current = fetch_rows(f"SELECT version FROM {table.name} WHERE id = :id", id=row_id)
+    if not current:
+        return None
+    raise HTTPException(status_code=412, headers={'ETag': entity_tag(current[0][0])},
+                        detail=f"{table.name} {row_id} was modified, it is at version {current[0][0]} "
+                               f"not {expected_version}")
+
+app = FastAPI(default_response_class=ORJSONResponse if orjson else JSONResponse)
 
 origins = [
     "http://localhost",
@@ -46,6 +1275,75 @@ app.add_middleware(
 )
 
 
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    query_count = [0]
+    token = request_query_count.set(query_count)
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get('route')
+        route_path = route.path if route else 'unmatched'
+        http_request_seconds.observe(time.perf_counter() - start, method=request.method, route=route_path,
+                                     status=status)
+        db_queries_per_request.observe(query_count[0], route=route_path)
+        request_query_count.reset(token)
+
+
+read_only_statement = re.compile(r'^\s*(select|with)\b', re.IGNORECASE)
+
+
+@app.middleware("http")
+async def route_reads(request: Request, call_next):
+    """
+        Send reports and read-only /query statements to the read-only pool, X-Read-Consistency: primary forces the
+        writer connection and X-Max-Staleness overrides the replica staleness bound in seconds:
+
+    """
+    path = request.scope['path']
+    routed = request.method == 'GET' and (
+        path.startswith('/reports/') or
+        (path.endswith('/query') and read_only_statement.match(request.query_params.get('query') or '')))
+    if not routed:
+        return await call_next(request)
+    max_staleness = request.headers.get('x-max-staleness')
+    try:
+        max_staleness = float(max_staleness) if max_staleness is not None else None
+    except ValueError:
+        return JSONResponse(status_code=400, content={'detail': 'X-Max-Staleness must be a number of seconds'})
+    force_primary = request.headers.get('x-read-consistency', '').lower() == 'primary'
+    with tenant_databases.reading(max_staleness, force_primary):
+        return await call_next(request)
+
+
+tenant_path_prefix = re.compile(r'^/tenants/([^/]+)(/.*)?$')
+
+
+@app.middleware("http")
+async def route_tenant(request: Request, call_next):
+    """
+        Serve a request from the tenant named by the X-Tenant-ID header or a /tenants/{tenant} path prefix:
+
+    """
+    tenant = request.headers.get('x-tenant-id')
+    path_match = tenant_path_prefix.match(request.scope['path'])
+    if path_match:
+        tenant = path_match.group(1)
+        request.scope['path'] = path_match.group(2) or '/'
+        request.scope['raw_path'] = request.scope['path'].encode()
+    if tenant is not None and not tenant_name_pattern.match(tenant):
+        return JSONResponse(status_code=400, content={'detail': 'Invalid tenant'})
+    if tenant is not None and tenant not in tenant_databases.entries:
+        # creating the schema of a new tenant database is blocking work, keep it off the event loop
+        await asyncio.get_running_loop().run_in_executor(None, copy_context().run, tenant_databases.entry, tenant)
+    with tenant_databases.use(tenant):
+        return await call_next(request)
+
+
 class TaxType(str, Enum):
     NONE = "NONE"
     INPUT = "INPUT"
@@ -88,6 +1386,13 @@ class AccountType(str, Enum):
     OTHER_INCOME = "OTHER_INCOME"
 
 
+class ContactType(str, Enum):
+    CUSTOMER = "CUSTOMER"
+    VENDOR = "VENDOR"
+    CUSTOMER_AND_VENDOR = "CUSTOMER_AND_VENDOR"
+    OTHER = "OTHER"
+
+
 class AccountGroup(str, Enum):
     REVENUE = "REVENUE"
     EXPENSE = "EXPENSE"
@@ -275,950 +1580,6396 @@ class UpdateCryptoWalletResponse(BaseModel):
     meta_data: Optional[MetaDataResponse] = None
 
 
-class JournalLineItems(BaseModel):
-    account_code: str = None
-    account_type: str = None
-    amount: float = None
-    posting_type: str = None
-
-
-class JournalEntry(BaseModel):
-    date: str = None
-    journal_lines: List[JournalLineItems] = None
+class Contact(BaseModel):
+    display_name: str = Query(..., title="Display Name",
+                              description="User recognizable display name for the Contact.",
+                              max_length=100)
+    contact_type: Optional[ContactType] = ContactType.CUSTOMER
+    company_name: Optional[str] = None
+    email_address: Optional[str] = None
+    telephone: Optional[str] = None
     description: Optional[str] = None
-    posted: Optional[bool] = True
-    journal_type: Optional[JournalType] = None
-    validate_journal_type: Optional[bool] = False
+    inactive: Optional[bool] = False
 
     class Config:
         schema_extra = {
             "example": {
-                "date": "2022-06-22",
-                "journal_lines": [
-                    {
-                        "account_code": "101",
-                        "account_type": "BANK",
-                        "amount": 1000.0,
-                        "posting_type": "Debit",
-                    },
-                    {
-                        "account_code": "400",
-                        "account_type": "REVENUE",
-                        "amount": 1000.0,
-                        "posting_type": "Credit",
-                    }
-                ],
-                "description": "Revenue from garage sale",
-                "posted": True,
-                "journal_type": "CASH_RECEIPTS",
-                "validate_journal_type": False
+                "display_name": "Jane Smith",
+                "contact_type": "CUSTOMER",
+                "company_name": "Smith Landscaping",
+                "email_address": "jane@smithlandscaping.com",
+                "telephone": "555-0100",
+                "description": "Monthly lawn care customer",
+                "inactive": False,
             }
         }
 
 
-class JournalEntryResponse(BaseModel):
-    id: str = None
-    date: str = None
-    journal_lines: List[JournalLineItems] = None
+class ContactResponse(BaseModel):
+    id: Optional[str] = None
+    display_name: Optional[str] = None
+    contact_type: Optional[ContactType] = None
+    company_name: Optional[str] = None
+    email_address: Optional[str] = None
+    telephone: Optional[str] = None
     description: Optional[str] = None
-    posted: Optional[bool] = True
-    journal_type: Optional[JournalType] = None
-    validate_journal_type: Optional[bool] = False
+    inactive: Optional[bool] = False
 
 
-class UpdateJournalEntry(BaseModel):
-    id: str = None
-    date: Optional[str] = None
-    journal_lines: Optional[List[JournalLineItems]] = None
+class UpdateContact(BaseModel):
+    display_name: Optional[str] = None
+    contact_type: Optional[ContactType] = None
+    company_name: Optional[str] = None
+    email_address: Optional[str] = None
+    telephone: Optional[str] = None
     description: Optional[str] = None
-    posted: Optional[bool] = True
-    journal_type: Optional[JournalType] = None
-    validate_journal_type: Optional[bool] = False
+    inactive: Optional[bool] = False
 
     class Config:
         schema_extra = {
             "example": {
-                "id": "1",
-                "date": "2022-06-22",
-                "journal_lines": [
-                    {
-                        "account_code": "101",
-                        "account_type": "BANK",
-                        "amount": 1000.0,
-                        "posting_type": "Debit",
-                    },
-                    {
-                        "account_code": "400",
-                        "account_type": "REVENUE",
-                        "amount": 1000.0,
-                        "posting_type": "Credit",
-                    }
-                ],
-                "description": "Revenue from garage sale",
-                "posted": True,
-                "journal_type": "CASH_RECEIPTS",
-                "validate_journal_type": False
+                "display_name": "Jane Smith",
+                "contact_type": "CUSTOMER",
+                "company_name": "Smith Landscaping",
+                "email_address": "jane@smithlandscaping.com",
+                "telephone": "555-0100",
+                "description": "Monthly lawn care customer",
+                "inactive": False,
             }
         }
 
-@app.get("/")
-def healthcheck():
-    return "200"
-
-@app.get("/owner_info/", response_model=OwnerInfoResponse, tags=["Owner Info"])
-async def read_owner_info():
-    """
-        Read owner_info:
-
-    """
-    owner_info = owner_info_table.find_one(id=1)
-    if owner_info:
-        return owner_info
-    else:
-        raise HTTPException(status_code=404, detail="OwnerInfo not found")
 
+class SearchResult(BaseModel):
+    type: str = None
+    id: int = None
+    snippet: Optional[str] = None
+    rank: Optional[float] = None
 
-@app.get("/owner_info/query", tags=["Owner Info"])
-async def query_owner_info(query: Optional[str] = None):
-    """
-        Query owner_info using a sql statement:
 
-    """
-    if query:
-        final_results = []
-        print(f"The query is {query}")
-        # result = db.query('select * from owner_info')
-        result = db.query(query)
-        if result:
-            for row in result:
-                print(f"The row is {row}")
-                final_results.append(row)
-            print(f"final results are {final_results}")
-            return final_results
-        else:
-            raise HTTPException(status_code=404, detail="OwnerInfo not found")
+class StatementFormat(str, Enum):
+    CSV = "CSV"
+    OFX = "OFX"
 
 
-@app.put("/owner_info/", response_model=UpdateOwnerInfo, tags=["Owner Info"])
-async def update_owner_info(owner_info: UpdateOwnerInfo):
-    """
-        Update owner_info with new information:
+class StatementLineMatch(BaseModel):
+    journal_line_id: Optional[int] = None
 
-    """
-    owner_info_to_update = owner_info_table.find_one(id=1)
-    if owner_info_to_update:
-        print(f"the owner_info to update is: {owner_info_to_update}")
-        owner_info_dict = owner_info.dict()
-        print(f"the owner_info_dict is: {owner_info_dict}")
-        owner_info_dict['id'] = 1
-        print(f"the updated owner_info_dict is: {owner_info_dict}")
-        owner_info_table.update(owner_info_dict, ['id'])
-        return owner_info_dict
-    else:
-        raise HTTPException(status_code=404, detail="OwnerInfo not found")
+    class Config:
+        schema_extra = {
+            "example": {
+                "journal_line_id": 42,
+            }
+        }
 
 
-@app.post("/owner_info/", tags=["Owner Info"], include_in_schema=False)
-async def create_owner_info(owner_info: OwnerInfo):
-    """
-        Create owner_info using required information:
+class JobStatus(str, Enum):
+    QUEUED = "QUEUED"
+    RUNNING = "RUNNING"
+    SUCCEEDED = "SUCCEEDED"
+    FAILED = "FAILED"
 
-    """
-    owner_info_dict = owner_info.dict()
 
-    db_insert = owner_info_table.insert(owner_info_dict)
-    print(f"db_insert is {db_insert}")
-    owner_info_dict['id'] = db_insert
-    return owner_info_dict
+class JobResponse(BaseModel):
+    id: int = None
+    job_type: Optional[str] = None
+    parameters: Optional[str] = None
+    status: Optional[JobStatus] = None
+    submitted_time: Optional[str] = None
+    started_time: Optional[str] = None
+    finished_time: Optional[str] = None
+    error: Optional[str] = None
 
 
-@app.post("/account/", tags=["Account"])
-async def create_account(account: Account):
-    """
-        Create a ledger account using required information:
+class ExportFormat(str, Enum):
+    PARQUET = "PARQUET"
+    ARROW = "ARROW"
 
-    """
-    account_dict = account.dict()
 
-    db_insert = account_table.insert(account_dict)
-    print(f"db_insert is {db_insert}")
-    account_dict['id'] = db_insert
-    return account_dict
+class CostingMethod(str, Enum):
+    FIFO = "FIFO"
+    WEIGHTED_AVERAGE = "WEIGHTED_AVERAGE"
 
 
-@app.get("/account/query", tags=["Account"])
-async def query_account(query: Optional[str] = None, skip: int = 0, limit: int = 10):
-    """
-        Query a ledger account using a sql statement:
+class StockMovementType(str, Enum):
+    RECEIPT = "RECEIPT"
+    SALE = "SALE"
 
-    """
-    if query:
-        final_results = []
-        print(f"The query is {query}")
-        # result = db.query('select * from account')
-        result = db.query(query)
-        if result:
-            for row in result:
-                print(f"The row is {row}")
-                final_results.append(row)
-            print(f"final results are {final_results}")
-            return final_results[skip: skip + limit]
-        else:
-            raise HTTPException(status_code=404, detail="Account not found")
 
+class Item(BaseModel):
+    display_name: str = Query(..., title="Display Name",
+                              description="User recognizable display name for the Item.",
+                              max_length=100)
+    item_code: str
+    description: Optional[str] = None
+    costing_method: Optional[CostingMethod] = CostingMethod.FIFO
+    inventory_account_code: str
+    cogs_account_code: str
+    inactive: Optional[bool] = False
 
-@app.get("/account/{account_id}", tags=["Account"])
-async def read_account(account_id: int):
-    """
-        Read a ledger account using account_id:
+    class Config:
+        schema_extra = {
+            "example": {
+                "display_name": "Garden Hose 50ft",
+                "item_code": "HOSE-50",
+                "description": "50 foot rubber garden hose",
+                "costing_method": "FIFO",
+                "inventory_account_code": "130",
+                "cogs_account_code": "500",
+                "inactive": False,
+            }
+        }
 
-    """
-    account = account_table.find_one(id=account_id)
-    if account:
-        return account
-    else:
-        raise HTTPException(status_code=404, detail="Account not found")
 
+class UpdateItem(BaseModel):
+    display_name: Optional[str] = None
+    description: Optional[str] = None
+    inventory_account_code: Optional[str] = None
+    cogs_account_code: Optional[str] = None
+    inactive: Optional[bool] = False
 
-@app.put("/account/{account_id}", tags=["Account"])
-async def update_account(account_id: int, account: UpdateAccount):
-    """
-        Update a ledger account with new information:
+    class Config:
+        schema_extra = {
+            "example": {
+                "display_name": "Garden Hose 50ft",
+                "description": "50 foot rubber garden hose",
+                "inventory_account_code": "130",
+                "cogs_account_code": "500",
+                "inactive": False,
+            }
+        }
 
-    """
-    account_to_update = account_table.find_one(id=account_id)
-    if account_to_update:
-        print(f"the account to update is: {account_to_update}")
-        account_dict = account.dict()
-        print(f"the account_dict is: {account_dict}")
-        account_dict['id'] = account_id
-        print(f"the updated account_dict is: {account_dict}")
-        account_table.update(account_dict, ['id'])
-        return account_dict
-    else:
-        raise HTTPException(status_code=404, detail="Account not found")
 
+class StockReceipt(BaseModel):
+    quantity: float
+    unit_cost: float
+    date: Optional[str] = None
+    description: Optional[str] = None
+    offset_account_code: Optional[str] = None
+    offset_account_type: Optional[AccountType] = AccountType.ACCOUNTS_PAYABLE
 
-@app.delete("/account/{account_id}", tags=["Account"])
-async def delete_account(account_id: int):
-    """
-        Delete a Ledger Account:
+    class Config:
+        schema_extra = {
+            "example": {
+                "quantity": 20,
+                "unit_cost": 12.5,
+                "date": "2022-06-22",
+                "description": "Hoses from supplier invoice 1041",
+                "offset_account_code": "200",
+                "offset_account_type": "ACCOUNTS_PAYABLE",
+            }
+        }
 
-    """
-    account_to_delete = account_table.find_one(id=account_id)
-    if account_to_delete:
-        print(f"the account to delete is: {account_to_delete}")
-        account_table.delete(id=account_id)
-        return {"message": f"Account with id {account_id} has been deleted"}
-    else:
-        raise HTTPException(status_code=404, detail="Account not found")
 
+class StockSale(BaseModel):
+    quantity: float
+    date: Optional[str] = None
+    description: Optional[str] = None
+    unit_price: Optional[float] = None
+    revenue_account_code: Optional[str] = None
+    receivable_account_code: Optional[str] = None
+    receivable_account_type: Optional[AccountType] = AccountType.ACCOUNTS_RECEIVABLE
 
-@app.post("/crypto_wallet/", tags=["Crypto Wallet"])
-async def create_crypto_wallet(crypto_wallet: CryptoWallet):
-    """
-        Create a ledger crypto_wallet using required information:
+    class Config:
+        schema_extra = {
+            "example": {
+                "quantity": 3,
+                "date": "2022-06-23",
+                "description": "Hose sale to Jane Smith",
+                "unit_price": 29.99,
+                "revenue_account_code": "400",
+                "receivable_account_code": "120",
+                "receivable_account_type": "ACCOUNTS_RECEIVABLE",
+            }
+        }
 
-    """
-    crypto_wallet_dict = crypto_wallet.dict()
 
-    db_insert = crypto_wallet_table.insert(crypto_wallet_dict)
-    print(f"db_insert is {db_insert}")
-    crypto_wallet_dict['id'] = db_insert
-    return crypto_wallet_dict
+class QuoteStatus(str, Enum):
+    DRAFT = "DRAFT"
+    SENT = "SENT"
+    ACCEPTED = "ACCEPTED"
+    DECLINED = "DECLINED"
+    CONVERTED = "CONVERTED"
 
 
-@app.get("/crypto_wallet/query", tags=["Crypto Wallet"])
-async def query_crypto_wallet(query: Optional[str] = None, skip: int = 0, limit: int = 10):
-    """
-        Query a ledger crypto_wallet using a sql statement:
+class OrderStatus(str, Enum):
+    OPEN = "OPEN"
+    INVOICED = "INVOICED"
+    CANCELLED = "CANCELLED"
 
-    """
-    if query:
-        final_results = []
-        print(f"The query is {query}")
-        # result = db.query('select * from crypto_wallet')
-        result = db.query(query)
-        if result:
-            for row in result:
-                print(f"The row is {row}")
-                final_results.append(row)
-            print(f"final results are {final_results}")
-            return final_results[skip: skip + limit]
-        else:
-            raise HTTPException(status_code=404, detail="Crypto Wallet not found")
 
+class InvoiceStatus(str, Enum):
+    OPEN = "OPEN"
+    PAID = "PAID"
 
-@app.get("/crypto_wallet/{crypto_wallet_id}", tags=["Crypto Wallet"])
-async def read_crypto_wallet(crypto_wallet_id: int):
-    """
-        Read a ledger crypto_wallet using crypto_wallet_id:
 
-    """
-    crypto_wallet = crypto_wallet_table.find_one(id=crypto_wallet_id)
-    if crypto_wallet:
-        return crypto_wallet
-    else:
-        raise HTTPException(status_code=404, detail="Crypto Wallet not found")
+class DocumentLine(BaseModel):
+    description: Optional[str] = None
+    quantity: float = 1
+    unit_price: float
+    account_code: str
+    account_type: Optional[AccountType] = None
 
 
-@app.put("/crypto_wallet/{crypto_wallet_id}", tags=["Crypto Wallet"])
-async def update_crypto_wallet(crypto_wallet_id: int, crypto_wallet: UpdateCryptoWallet):
-    """
-        Update a ledger crypto_wallet with new information:
+class Document(BaseModel):
+    contact_id: int
+    date: Optional[str] = None
+    description: Optional[str] = None
+    lines: List[DocumentLine]
 
-    """
-    crypto_wallet_to_update = crypto_wallet_table.find_one(id=crypto_wallet_id)
-    if crypto_wallet_to_update:
-        print(f"the crypto_wallet to update is: {crypto_wallet_to_update}")
-        crypto_wallet_dict = crypto_wallet.dict()
-        print(f"the crypto_wallet_dict is: {crypto_wallet_dict}")
-        crypto_wallet_dict['id'] = crypto_wallet_id
-        print(f"the updated crypto_wallet_dict is: {crypto_wallet_dict}")
-        crypto_wallet_table.update(crypto_wallet_dict, ['id'])
-        return crypto_wallet_dict
-    else:
-        raise HTTPException(status_code=404, detail="Crypto Wallet not found")
+    class Config:
+        schema_extra = {
+            "example": {
+                "contact_id": 1,
+                "date": "2022-06-22",
+                "description": "Spring landscaping package",
+                "lines": [
+                    {
+                        "description": "Lawn care, monthly",
+                        "quantity": 3,
+                        "unit_price": 120.0,
+                        "account_code": "400",
+                        "account_type": "REVENUE",
+                    }
+                ],
+            }
+        }
 
 
-@app.delete("/crypto_wallet/{crypto_wallet_id}", tags=["Crypto Wallet"])
-async def delete_crypto_wallet(crypto_wallet_id: int):
-    """
-        Delete a Ledger Crypto Wallet:
+class UpdateDocument(BaseModel):
+    date: Optional[str] = None
+    description: Optional[str] = None
+    lines: Optional[List[DocumentLine]] = None
+    status: Optional[str] = None
 
-    """
-    crypto_wallet_to_delete = crypto_wallet_table.find_one(id=crypto_wallet_id)
-    if crypto_wallet_to_delete:
-        print(f"the crypto_wallet to delete is: {crypto_wallet_to_delete}")
-        crypto_wallet_table.delete(id=crypto_wallet_id)
-        return {"message": f"Crypto Wallet with id {crypto_wallet_id} has been deleted"}
-    else:
-        raise HTTPException(status_code=404, detail="Crypto Wallet not found")
+    class Config:
+        schema_extra = {
+            "example": {
+                "description": "Spring landscaping package",
+                "status": "ACCEPTED",
+            }
+        }
 
 
-@app.post("/journalentry/", tags=["Journal Entry"])
-async def create_journal_entry(journal_entry: JournalEntry):
-    """
-        Create a journal entry using required information:
+class DocumentConversion(BaseModel):
+    ids: Optional[List[int]] = None
+    date: Optional[str] = None
+    due_days: Optional[int] = 30
+    account_code: Optional[str] = None
 
-    """
+    class Config:
+        schema_extra = {
+            "example": {
+                "ids": [1, 2, 3],
+                "date": "2022-06-30",
+                "due_days": 30,
+                "account_code": "120",
+            }
+        }
 
-    current_date = datetime.now(timezone.utc).astimezone().strftime('%Y-%m-%d')
-    journal_entry_dict = journal_entry.dict()
-    json_journal_entry_dict = journal_entry.dict()
-    journal_lines = journal_entry_dict['journal_lines']
-    journal_entry_date = journal_entry_dict['date']
 
-    if not journal_entry_date:
-        json_journal_entry_dict['date'] = current_date
-        journal_entry_dict['date'] = current_date
+class CreditMemo(Document):
+    account_code: str
 
-    if not journal_lines:
-        raise HTTPException(status_code=404, detail="Cannot Record An Empty Journal Entry")
+    class Config:
+        schema_extra = {
+            "example": {
+                "contact_id": 1,
+                "account_code": "120",
+                "date": "2022-07-02",
+                "description": "Refund for cancelled lawn care",
+                "lines": [
+                    {
+                        "description": "Lawn care, one month",
+                        "quantity": 1,
+                        "unit_price": 120.0,
+                        "account_code": "400",
+                        "account_type": "REVENUE",
+                    }
+                ],
+            }
+        }
 
-    for line in journal_lines:
-        print(f"line in journal_lines: is {line}")
-        account_code = line['account_code']
-        amount = line['amount']
-        if not account_code:
-            raise HTTPException(status_code=404, detail="All Journal Lines Must Contain account_code")
-        if not amount:
-            raise HTTPException(status_code=404, detail="All Journal Lines Must Contain amount")
 
-        if line['posting_type'] == 'Credit' and line['amount'] > 0:
-            line['amount'] = -line["amount"]
+class AllocationStrategy(str, Enum):
+    OLDEST_FIRST = "OLDEST_FIRST"
+    LARGEST_FIRST = "LARGEST_FIRST"
 
-    print(f"Updated journal_lines are: {journal_lines}")
 
-    code_amount = [[line['account_code'], line['amount']] for line in journal_lines]
-    print(f"code_amount is: {code_amount}")
+class CreditApplication(BaseModel):
+    invoice_ids: Optional[List[int]] = None
+    strategy: AllocationStrategy = AllocationStrategy.OLDEST_FIRST
+    amount: Optional[float] = None
+    date: Optional[str] = None
 
-    if sum(line[1] for line in code_amount) != 0:
-        raise HTTPException(status_code=404, detail="Unbalanced Journal Lines")
+    class Config:
+        schema_extra = {
+            "example": {
+                "strategy": "OLDEST_FIRST",
+                "date": "2022-07-05",
+            }
+        }
 
-    print(f"journal_lines in journal_entry_dict is {journal_lines}")
-    json_compatible_journal_lines = json.dumps(journal_lines)
-    print(f"json_compatible_journal_lines in journal_entry_dict is {json_compatible_journal_lines}")
-    json_journal_entry_dict["journal_lines"] = json_compatible_journal_lines
-    db_insert = journal_entry_table.insert(json_journal_entry_dict)
-    print(f"db_insert is {db_insert}")
-    journal_entry_dict['id'] = db_insert
-    return journal_entry_dict
 
+class PayType(str, Enum):
+    SALARY = "SALARY"
+    HOURLY = "HOURLY"
 
-@app.get("/journalentry/query", tags=["Journal Entry"])
-async def query_journal_entry(query: Optional[str] = None, skip: int = 0, limit: int = 10):
-    """
-           Query a journal entry using a sql statement:
 
-    """
-    if query:
-        final_results = []
-        print(f"The query is {query}")
-        # result = db.query('select * from journal_entry')
-        result = db.query(query)
-        if result:
-            for row in result:
-                print(f"The row is {row['journal_lines']}")
-                journal_lines = json.loads(row['journal_lines'])
-                row['journal_lines'] = journal_lines
-                final_results.append(row)
-            print(f"final results are {final_results}")
-            return final_results[skip: skip + limit]
-        else:
-            raise HTTPException(status_code=404, detail="Journal Entry not found")
+class Employee(BaseModel):
+    first_name: str
+    last_name: str
+    email_address: Optional[str] = None
+    pay_type: PayType = PayType.SALARY
+    annual_salary: Optional[float] = 0
+    hourly_rate: Optional[float] = 0
+    standard_hours: Optional[float] = 80
+    tax_rate: Optional[float] = 0
+    deduction_amount: Optional[float] = 0
+    inactive: Optional[bool] = False
 
+    class Config:
+        schema_extra = {
+            "example": {
+                "first_name": "Jane",
+                "last_name": "Smith",
+                "email_address": "jane@smithlandscaping.com",
+                "pay_type": "HOURLY",
+                "hourly_rate": 22.5,
+                "standard_hours": 80,
+                "tax_rate": 0.18,
+                "deduction_amount": 45.0,
+                "inactive": False,
+            }
+        }
 
-@app.get("/journalentry/{journal_entry_id}", tags=["Journal Entry"])
-async def read_journal_entry(journal_entry_id: str):
-    """
-        Read a journal_entry using journal_entry_id:
 
-    """
-    journal_entry = journal_entry_table.find_one(id=journal_entry_id)
-    if journal_entry:
-        journal_lines = journal_entry['journal_lines']
-        json_compatible_line_items = json.loads(journal_lines)
-        journal_entry['journal_lines'] = json_compatible_line_items
-        return journal_entry
-    else:
-        raise HTTPException(status_code=404, detail="Journal Entry not found")
+class UpdateEmployee(BaseModel):
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
+    email_address: Optional[str] = None
+    pay_type: Optional[PayType] = None
+    annual_salary: Optional[float] = None
+    hourly_rate: Optional[float] = None
+    standard_hours: Optional[float] = None
+    tax_rate: Optional[float] = None
+    deduction_amount: Optional[float] = None
+    inactive: Optional[bool] = None
+
+
+class PayrollRun(BaseModel):
+    period_start: str
+    period_end: str
+    pay_date: Optional[str] = None
+    pay_periods_per_year: int = 26
+    hours: Optional[Dict[int, float]] = None
+    wages_expense_account_code: str
+    wages_payable_account_code: str
+    tax_payable_account_code: str
+    deductions_payable_account_code: Optional[str] = None
+    per_employee_lines: bool = False
 
+    class Config:
+        schema_extra = {
+            "example": {
+                "period_start": "2022-06-01",
+                "period_end": "2022-06-14",
+                "pay_date": "2022-06-17",
+                "pay_periods_per_year": 26,
+                "hours": {"1": 76.5},
+                "wages_expense_account_code": "477",
+                "wages_payable_account_code": "814",
+                "tax_payable_account_code": "825",
+                "deductions_payable_account_code": "826",
+                "per_employee_lines": False,
+            }
+        }
 
-@app.put("/journalentry/{journal_entry_id}", tags=["Journal Entry"])
-async def update_journal_entry(journal_entry_id: str, journal_entry: UpdateJournalEntry):
-    """
-        Update a journal_entry with new information:
 
-    """
-    journal_entry_to_update = journal_entry_table.find_one(id=journal_entry_id)
-    if journal_entry_to_update:
-        journal_entry_dict = journal_entry.dict()
-        json_journal_entry_dict = journal_entry.dict()
-        line_items = journal_entry_dict['journal_lines']
-        print(f"line_items in journal_entry_dict is {line_items}")
-        json_compatible_line_items = json.dumps(line_items)
-        print(f"json_compatible_line_items in journal_entry_dict is {json_compatible_line_items}")
-        json_journal_entry_dict["journal_lines"] = json_compatible_line_items
-        journal_entry_dict['id'] = journal_entry_id
-        json_journal_entry_dict['id'] = journal_entry_id
-        print(f"the updated journal_entry_dict is: {journal_entry_dict}")
-        journal_entry_table.update(json_journal_entry_dict, ['id'])
-
-        return journal_entry_dict
-    else:
-        raise HTTPException(status_code=404, detail="Journal Entry not found")
+class LotMethod(str, Enum):
+    FIFO = "FIFO"
+    LIFO = "LIFO"
+    HIFO = "HIFO"
 
 
-@app.delete("/journalentry/{journal_entry_id}", tags=["Journal Entry"])
-async def delete_journal_entry(journal_entry_id: str):
-    """
-        Delete a Journal Entry:
+class CryptoImportFormat(str, Enum):
+    CSV = "CSV"
+    JSON = "JSON"
 
-    """
-    journal_entry_to_delete = journal_entry_table.find_one(id=journal_entry_id)
-    if journal_entry_to_delete:
-        print(f"the journal_entry to delete is: {journal_entry_to_delete}")
-        journal_entry_table.delete(id=journal_entry_id)
-        return {"message": f"Journal Entry with id {journal_entry_id} has been deleted"}
-    else:
-        raise HTTPException(status_code=404, detail="Journal Entry not found")
 
+class CryptoTransactionType(str, Enum):
+    BUY = "BUY"
+    SELL = "SELL"
 
-@app.get("/reports/profit_and_loss", tags=["Reports"])
-async def get_profit_and_loss(start_date: Optional[date] = None, end_date: Optional[date] = None):
-    """
-        Query a journal entry using a sql statement:
 
-    """
+class FxRate(BaseModel):
+    currency: str
+    date: str
+    rate: float
 
-    result = journal_entry_table.find(date={'between': [start_date, end_date]})
-    print(f"The result is {result}")
-    accounts_by_type = {'revenue': {}, 'cogs': {}, 'expense': {}, 'other_income': {}, 'other_expenses': {}}
-    if result:
-        for row in result:
-            print(f"The row is {row['journal_lines']}")
-            journal_lines = json.loads(row['journal_lines'])
-            for each in journal_lines:
-                print(f"each in journal_lines is {each}")
+    class Config:
+        schema_extra = {
+            "example": {
+                "currency": "EUR",
+                "date": "2022-06-30",
+                "rate": 1.0484,
+            }
+        }
 
-                if str(each['account_type']).lower() in ["revenue", "cogs", "expense", "other_income",
-                                                         "other_expenses"]:
-                    key = str(each['account_type']).lower()
-                    print(f"Key is {key}")
-                    try:
-                        accounts_by_type[f"{key}"][f"account_code_{each['account_code']}"].append(each['amount'])
-                    except KeyError:
-                        accounts_by_type[f"{key}"][f"account_code_{each['account_code']}"] = []
-                        accounts_by_type[f"{key}"][
-                            f"account_code_{each['account_code']}"].append(each['amount'])
-    else:
-        raise HTTPException(status_code=404, detail="Journal Entry not found")
 
-    print(f"accounts by type are {accounts_by_type}")
+class FxRevaluation(BaseModel):
+    as_of: str
+    gain_account_code: str
+    loss_account_code: Optional[str] = None
+    reverse: bool = True
 
-    for account in accounts_by_type['revenue']:
-        print(f"account in ACCOUNTS BY TYPE is {account}")
-        accounts_by_type['revenue'][f'{account}'] = sum(accounts_by_type['revenue'][f'{account}'])
+    class Config:
+        schema_extra = {
+            "example": {
+                "as_of": "2022-06-30",
+                "gain_account_code": "495",
+                "loss_account_code": "497",
+                "reverse": True,
+            }
+        }
 
-    for account in accounts_by_type['cogs']:
-        print(f"account in ACCOUNTS BY TYPE is {account}")
-        accounts_by_type['cogs'][f'{account}'] = sum(accounts_by_type['cogs'][f'{account}'])
 
-    for account in accounts_by_type['expense']:
-        print(f"account in ACCOUNTS BY TYPE is {account}")
-        accounts_by_type['expense'][f'{account}'] = sum(accounts_by_type['expense'][f'{account}'])
+class Connection(BaseModel):
+    display_name: Optional[str] = None
+    url: str
+    event_types: Optional[List[str]] = None
+    secret: Optional[str] = None
+    batch_size: Optional[int] = None
+    active: Optional[bool] = True
 
-    for account in accounts_by_type['other_income']:
-        print(f"account in ACCOUNTS BY TYPE is {account}")
-        accounts_by_type['other_income'][f'{account}'] = sum(accounts_by_type['other_income'][f'{account}'])
+    class Config:
+        schema_extra = {
+            "example": {
+                "display_name": "Data warehouse",
+                "url": "https://example.com/ledger-events",
+                "event_types": ["journal_entry.*"],
+                "secret": "change-me",
+                "batch_size": 100,
+                "active": True,
+            }
+        }
 
-    for account in accounts_by_type['other_expenses']:
-        print(f"account in ACCOUNTS BY TYPE is {account}")
-        accounts_by_type['other_expenses'][f'{account}'] = sum(accounts_by_type['other_expenses'][f'{account}'])
 
-    print(f"UPDATED accounts by type are {accounts_by_type}")
+class UpdateConnection(BaseModel):
+    display_name: Optional[str] = None
+    url: Optional[str] = None
+    event_types: Optional[List[str]] = None
+    secret: Optional[str] = None
+    batch_size: Optional[int] = None
+    active: Optional[bool] = None
 
-    income_rows = []
-    cogs_rows = []
-    expense_rows = []
-    other_income_rows = []
-    other_expenses_rows = []
+    class Config:
+        schema_extra = {
+            "example": {
+                "event_types": ["journal_entry.created"],
+            }
+        }
 
-    total_income = 0
-    print(f"TOTAL INCOME is {total_income}")
 
-    absolute_total_income = 0
-    print(f"ABSOLUTE TOTAL INCOME is {absolute_total_income}")
+class OutboxStatus(str, Enum):
+    PENDING = "PENDING"
+    DELIVERED = "DELIVERED"
+    DEAD = "DEAD"
 
-    absolute_total_other_income = 0
-    print(f"ABSOLUTE TOTAL OTHER INCOME is {absolute_total_other_income}")
 
-    total_cogs = 0
-    print(f"TOTAL COSTS OF GOODS SOLD is {total_cogs}")
+class JournalEntryExpansion(str, Enum):
+    ACCOUNTS = "ACCOUNTS"
 
-    gross_profit = 0
-    print(f"GROSS PROFIT is {gross_profit}")
 
-    total_expenses = 0
-    print(f"TOTAL EXPENSES is {total_expenses}")
+class JournalEntryBatchGet(BaseModel):
+    ids: List[int]
+    expand: Optional[List[JournalEntryExpansion]] = None
 
-    net_operating_income = 0
-    print(f"NET OPERATING INCOME is {net_operating_income}")
+    class Config:
+        schema_extra = {
+            "example": {
+                "ids": [1, 2, 3],
+                "expand": ["ACCOUNTS"],
+            }
+        }
 
-    total_other_income = 0
-    print(f"TOTAL OTHER INCOME is {total_other_income}")
 
-    total_other_expenses = 0
-    print(f"TOTAL OTHER EXPENSES is {total_other_expenses}")
+class LineAmountTypes(str, Enum):
+    EXCLUSIVE = "EXCLUSIVE"
+    INCLUSIVE = "INCLUSIVE"
+    NO_TAX = "NO_TAX"
 
-    net_other_income = 0
-    print(f"NET OTHER INCOME is {net_other_income}")
 
-    net_income = 0
-    print(f"NET INCOME is {net_income}")
+class TaxPeriod(str, Enum):
+    MONTH = "MONTH"
+    QUARTER = "QUARTER"
+    YEAR = "YEAR"
 
-    for account, balance in accounts_by_type['revenue'].items():
-        total_income += balance
-        absolute_total_income += abs(balance)
-        print(f"Account is {account} and balance is {balance}")
-        account_id = str(account).split("_")[-1]
-        print(f"Account ID is {account_id}")
-        column_data_id_value = {"id": account_id, "value": str(account).capitalize()}
-        print(f"ColData ID VALUE is {column_data_id_value}")
-        column_data_value = {"value": str(balance * -1)}
-        print(f"ColData VALUE is {column_data_value}")
-        column_data = {"ColData": [column_data_id_value, column_data_value], "type": "Data"}
-        print(f"ColData is {column_data}")
-        income_rows.append(column_data)
 
-    print(f"INCOME_ROWS is {income_rows}")
-    print(f"TOTAL_INCOME is {total_income}")
-    print(f"ABSOLUTE_TOTAL_INCOME is {absolute_total_income}")
+class TaxCode(BaseModel):
+    code: str
+    name: Optional[str] = None
+    rate: float = 0.0
+    tax_type: Optional[TaxType] = None
+    tax_account_code: Optional[str] = None
+    active: Optional[bool] = True
 
-    for account, balance in accounts_by_type['cogs'].items():
-        total_cogs += balance
-        print(f"Account is {account} and balance is {balance}")
-        account_id = str(account).split("_")[-1]
-        print(f"Account ID is {account_id}")
-        column_data_id_value = {"id": account_id, "value": str(account).capitalize()}
-        print(f"ColData ID VALUE is {column_data_id_value}")
-        column_data_value = {"value": str(balance)}
-        print(f"ColData VALUE is {column_data_value}")
-        column_data = {"ColData": [column_data_id_value, column_data_value], "type": "Data"}
-        print(f"ColData is {column_data}")
-        cogs_rows.append(column_data)
+    class Config:
+        schema_extra = {
+            "example": {
+                "code": "OUTPUT",
+                "name": "GST on Income",
+                "rate": 10.0,
+                "tax_type": "OUTPUT",
+                "tax_account_code": "820",
+                "active": True,
+            }
+        }
 
-    print(f"COGS_ROWS is {cogs_rows}")
-    print(f"TOTAL_COGS is {total_cogs}")
 
-    for account, balance in accounts_by_type['expense'].items():
-        total_expenses += balance
-        print(f"Account is {account} and balance is {balance}")
-        account_id = str(account).split("_")[-1]
-        print(f"Account ID is {account_id}")
-        column_data_id_value = {"id": account_id, "value": str(account).capitalize()}
-        print(f"ColData ID VALUE is {column_data_id_value}")
-        column_data_value = {"value": str(balance)}
-        print(f"ColData VALUE is {column_data_value}")
-        column_data = {"ColData": [column_data_id_value, column_data_value], "type": "Data"}
-        print(f"ColData is {column_data}")
-        expense_rows.append(column_data)
+class UpdateTaxCode(BaseModel):
+    name: Optional[str] = None
+    rate: Optional[float] = None
+    tax_type: Optional[TaxType] = None
+    tax_account_code: Optional[str] = None
+    active: Optional[bool] = None
 
-    print(f"EXPENSE_ROWS is {expense_rows}")
-    print(f"TOTAL_EXPENSES is {total_expenses}")
+    class Config:
+        schema_extra = {
+            "example": {
+                "rate": 15.0,
+            }
+        }
 
-    for account, balance in accounts_by_type['other_income'].items():
-        total_other_income += balance
-        absolute_total_other_income += abs(balance)
-        print(f"Account is {account} and balance is {balance}")
-        account_id = str(account).split("_")[-1]
-        print(f"Account ID is {account_id}")
-        column_data_id_value = {"id": account_id, "value": str(account).capitalize()}
-        print(f"ColData ID VALUE is {column_data_id_value}")
-        column_data_value = {"value": str(balance * -1)}
-        print(f"ColData VALUE is {column_data_value}")
-        column_data = {"ColData": [column_data_id_value, column_data_value], "type": "Data"}
-        print(f"ColData is {column_data}")
-        other_income_rows.append(column_data)
 
-    print(f"OTHER_INCOME_ROWS is {other_income_rows}")
-    print(f"TOTAL_OTHER_INCOME is {total_other_income}")
-    print(f"ABSOLUTE_TOTAL_OTHER_INCOME is {absolute_total_other_income}")
+class JournalLineItems(BaseModel):
+    account_code: str = None
+    account_type: str = None
+    amount: float = None
+    posting_type: str = None
+    currency: Optional[str] = None
+    exchange_rate: Optional[float] = None
+    dimensions: Optional[Dict[str, str]] = None
+    tax_code: Optional[str] = None
+    tax_rate: Optional[float] = None
+    tax_amount: Optional[float] = None
+    tax_line: Optional[bool] = None
 
-    for account, balance in accounts_by_type['other_expenses'].items():
-        total_other_expenses += balance
-        print(f"Account is {account} and balance is {balance}")
-        account_id = str(account).split("_")[-1]
-        print(f"Account ID is {account_id}")
-        column_data_id_value = {"id": account_id, "value": str(account).capitalize()}
-        print(f"ColData ID VALUE is {column_data_id_value}")
-        column_data_value = {"value": str(balance)}
-        print(f"ColData VALUE is {column_data_value}")
-        column_data = {"ColData": [column_data_id_value, column_data_value], "type": "Data"}
-        print(f"ColData is {column_data}")
-        other_expenses_rows.append(column_data)
 
-    print(f"OTHER_EXPENSES_ROWS is {other_expenses_rows}")
-    print(f"TOTAL_OTHER_EXPENSES is {total_other_expenses}")
+class JournalEntry(BaseModel):
+    date: str = None
+    journal_lines: List[JournalLineItems] = None
+    description: Optional[str] = None
+    posted: Optional[bool] = True
+    journal_type: Optional[JournalType] = None
+    validate_journal_type: Optional[bool] = False
+    line_amount_types: Optional[LineAmountTypes] = None
 
-    gross_profit = absolute_total_income - total_cogs
-    print(f"GROSS PROFIT is {gross_profit}")
+    class Config:
+        schema_extra = {
+            "example": {
+                "date": "2022-06-22",
+                "journal_lines": [
+                    {
+                        "account_code": "101",
+                        "account_type": "BANK",
+                        "amount": 1000.0,
+                        "posting_type": "Debit",
+                    },
+                    {
+                        "account_code": "400",
+                        "account_type": "REVENUE",
+                        "amount": 1000.0,
+                        "posting_type": "Credit",
+                    }
+                ],
+                "description": "Revenue from garage sale",
+                "posted": True,
+                "journal_type": "CASH_RECEIPTS",
+                "validate_journal_type": False
+            }
+        }
 
-    net_operating_income = gross_profit - total_expenses
-    print(f"NET OPERATING INCOME is {net_operating_income}")
 
-    net_income = net_operating_income + net_other_income
-    print(f"NET INCOME is {net_income}")
+class JournalEntryResponse(BaseModel):
+    id: str = None
+    date: str = None
+    journal_lines: List[JournalLineItems] = None
+    description: Optional[str] = None
+    posted: Optional[bool] = True
+    journal_type: Optional[JournalType] = None
+    validate_journal_type: Optional[bool] = False
+    line_amount_types: Optional[LineAmountTypes] = None
 
-    net_other_income = absolute_total_other_income - total_other_expenses
-    print(f"NET OTHER INCOME is {net_other_income}")
 
-    income_group = {
-        "Header": {
-            "ColData": [
-                {
-                    "value": "Income"
-                },
-                {
-                    "value": ""
-                }
-            ]
-        },
-        "Rows": {
-            "Row": []
+class UpdateJournalEntry(BaseModel):
+    id: str = None
+    date: Optional[str] = None
+    journal_lines: Optional[List[JournalLineItems]] = None
+    description: Optional[str] = None
+    posted: Optional[bool] = True
+    journal_type: Optional[JournalType] = None
+    validate_journal_type: Optional[bool] = False
+    line_amount_types: Optional[LineAmountTypes] = None
 
-        },
-        "type": "Section",
-        "group": "Income",
-        "Summary": {
-            "ColData": []
+    class Config:
+        schema_extra = {
+            "example": {
+                "id": "1",
+                "date": "2022-06-22",
+                "journal_lines": [
+                    {
+                        "account_code": "101",
+                        "account_type": "BANK",
+                        "amount": 1000.0,
+                        "posting_type": "Debit",
+                    },
+                    {
+                        "account_code": "400",
+                        "account_type": "REVENUE",
+                        "amount": 1000.0,
+                        "posting_type": "Credit",
+                    }
+                ],
+                "description": "Revenue from garage sale",
+                "posted": True,
+                "journal_type": "CASH_RECEIPTS",
+                "validate_journal_type": False
+            }
         }
-    }
-    income_group['Rows']['Row'] = income_rows
-    income_group['Summary']['ColData'] = [
-        {"value": "Total Income"},
-        {"value": f"{absolute_total_income}"}
-    ]
-    print(f"DYNAMIC INCOME_GROUP is {income_group}")
 
-    cogs_group = {
-        "Header": {
-            "ColData": [
-                {
-                    "value": "Cost of Goods Sold"
-                },
-                {
-                    "value": ""
-                }
-            ]
-        },
-        "Rows": {
-            "Row": []
 
-        },
-        "type": "Section",
-        "group": "COGS",
-        "Summary": {
-            "ColData": []
-        }
-    }
-    cogs_group['Rows']['Row'] = cogs_rows
-    cogs_group['Summary']['ColData'] = [
-        {"value": "Total Cost of Goods Sold"},
-        {"value": f"{total_cogs}"}
-    ]
-    print(f"DYNAMIC COGS GROUP is {cogs_group}")
+class RecurringJournalEntry(BaseModel):
+    description: Optional[str] = None
+    journal_lines: List[JournalLineItems]
+    journal_type: Optional[JournalType] = None
+    schedule: str = Query(..., title="Schedule",
+                          description="Cron-like day schedule 'day-of-month month day-of-week' (a five field cron "
+                                      "expression keeps its last three fields, L is the last day of the month) or "
+                                      "@daily, @weekly, @monthly, @month_end, @quarterly, @yearly")
+    start_date: Optional[str] = None
+    end_date: Optional[str] = None
+    active: Optional[bool] = True
 
-    gross_profit_group = {
-        "type": "Section",
-        "group": "Gross Profit",
-        "Summary": {
-            "ColData": []
+    class Config:
+        schema_extra = {
+            "example": {
+                "description": "Office rent",
+                "journal_lines": [
+                    {
+                        "account_code": "610",
+                        "account_type": "EXPENSE",
+                        "amount": 1500.0,
+                        "posting_type": "Debit",
+                    },
+                    {
+                        "account_code": "101",
+                        "account_type": "BANK",
+                        "amount": 1500.0,
+                        "posting_type": "Credit",
+                    }
+                ],
+                "journal_type": "CASH_DISBURSEMENTS",
+                "schedule": "1 * *",
+                "start_date": "2022-01-01",
+                "end_date": None,
+                "active": True
+            }
         }
-    }
-    gross_profit_group['Summary']['ColData'] = [
-        {"value": "Gross Profit"},
-        {"value": f"{gross_profit}"}
-    ]
-    print(f"DYNAMIC GROSS PROFIT GROUP is {gross_profit_group}")
 
-    expense_group = {
-        "Header": {
-            "ColData": [
-                {
-                    "value": "Expenses"
-                },
-                {
-                    "value": ""
-                }
-            ]
-        },
-        "Rows": {
-            "Row": []
 
-        },
-        "type": "Section",
-        "group": "Expense",
-        "Summary": {
-            "ColData": []
+class UpdateRecurringJournalEntry(BaseModel):
+    description: Optional[str] = None
+    journal_lines: Optional[List[JournalLineItems]] = None
+    journal_type: Optional[JournalType] = None
+    schedule: Optional[str] = None
+    end_date: Optional[str] = None
+    active: Optional[bool] = None
+
+
+@app.get("/")
+def healthcheck():
+    return "200"
+
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+def read_metrics():
+    return PlainTextResponse("\n".join(metric.render() for metric in metrics) + "\n",
+                             media_type="text/plain; version=0.0.4")
+
+
+def find_slow_query(query_id):
+    tenant = current_tenant.get()
+    with slow_query_lock:
+        records = [record for record in slow_query_log.values()
+                   if record['tenant'] == tenant and (query_id is None or record['id'] == query_id)]
+    return records
+
+
+def slow_query_summary(record):
+    summary = {key: value for key, value in record.items() if key != 'sample'}
+    summary['total_seconds'] = round(record['total_seconds'], 6)
+    summary['max_seconds'] = round(record['max_seconds'], 6)
+    summary['average_seconds'] = round(record['total_seconds'] / record['calls'], 6)
+    return summary
+
+
+@app.get("/admin/slow_queries", tags=["Admin"])
+async def read_slow_queries(full_scans_only: bool = False, skip: int = 0, limit: int = 20):
+    """
+        List the slow query shapes of the tenant by total time, with their query plan, full table scans and
+        suggested indexes:
+
+    """
+    records = sorted(find_slow_query(None), key=lambda record: record['total_seconds'], reverse=True)
+    if full_scans_only:
+        records = [record for record in records if record['full_scans']]
+    return [slow_query_summary(record) for record in records[skip: skip + limit]]
+
+
+@app.post("/admin/slow_queries/{query_id}/indexes", tags=["Admin"])
+async def create_slow_query_indexes(query_id: str):
+    """
+        Create the indexes suggested for a slow query shape:
+
+    """
+    records = find_slow_query(query_id)
+    if not records:
+        raise HTTPException(status_code=404, detail="Slow query not found")
+    record = records[0]
+    if record['plan'] is None:
+        explain_slow_query(record)
+    if not record['suggested_indexes']:
+        raise HTTPException(status_code=409, detail="No index to create for this query")
+    create_suggested_indexes(record)
+    return slow_query_summary(record)
+
+
+@app.delete("/admin/slow_queries", tags=["Admin"])
+async def clear_slow_queries():
+    """
+        Clear the slow query log of the tenant:
+
+    """
+    tenant = current_tenant.get()
+    with slow_query_lock:
+        for key in [key for key in slow_query_log if key[0] == tenant]:
+            del slow_query_log[key]
+    return {"message": "Slow query log cleared"}
+
+@app.get("/owner_info/", response_model=OwnerInfoResponse, tags=["Owner Info"])
+async def read_owner_info():
+    """
+        Read owner_info:
+
+    """
+    owner_info = owner_info_table.find_one(id=1)
+    if owner_info:
+        return owner_info
+    else:
+        raise HTTPException(status_code=404, detail="OwnerInfo not found")
+
+
+@app.get("/owner_info/query", tags=["Owner Info"])
+async def query_owner_info(query: Optional[str] = None):
+    """
+        Query owner_info using a sql statement:
+
+    """
+    if query:
+        final_results = []
+        print(f"The query is {query}")
+        # result = db.query('select * from owner_info')
+        result = db.query(query)
+        if result:
+            for row in result:
+                print(f"The row is {row}")
+                final_results.append(row)
+            print(f"final results are {final_results}")
+            return final_results
+        else:
+            raise HTTPException(status_code=404, detail="OwnerInfo not found")
+
+
+@app.put("/owner_info/", response_model=UpdateOwnerInfo, tags=["Owner Info"])
+async def update_owner_info(owner_info: UpdateOwnerInfo):
+    """
+        Update owner_info with new information:
+
+    """
+    owner_info_to_update = owner_info_table.find_one(id=1)
+    if owner_info_to_update:
+        print(f"the owner_info to update is: {owner_info_to_update}")
+        owner_info_dict = owner_info.dict()
+        print(f"the owner_info_dict is: {owner_info_dict}")
+        owner_info_dict['id'] = 1
+        print(f"the updated owner_info_dict is: {owner_info_dict}")
+        owner_info_table.update(owner_info_dict, ['id'])
+        return owner_info_dict
+    else:
+        raise HTTPException(status_code=404, detail="OwnerInfo not found")
+
+
+@app.post("/owner_info/", tags=["Owner Info"], include_in_schema=False)
+async def create_owner_info(owner_info: OwnerInfo):
+    """
+        Create owner_info using required information:
+
+    """
+    owner_info_dict = owner_info.dict()
+
+    db_insert = owner_info_table.insert(owner_info_dict)
+    print(f"db_insert is {db_insert}")
+    owner_info_dict['id'] = db_insert
+    return owner_info_dict
+
+
+@app.post("/account/", tags=["Account"])
+async def create_account(account: Account):
+    """
+        Create a ledger account using required information:
+
+    """
+    account_dict = account.dict()
+    account_dict['last_updated_time'] = datetime.now(timezone.utc).isoformat()
+
+    db_insert = account_table.insert(account_dict)
+    print(f"db_insert is {db_insert}")
+    account_dict['id'] = db_insert
+    return account_dict
+
+
+@app.get("/account/query", tags=["Account"])
+async def query_account(query: Optional[str] = None, skip: int = 0, limit: int = 10):
+    """
+        Query a ledger account using a sql statement:
+
+    """
+    if query:
+        final_results = []
+        print(f"The query is {query}")
+        # result = db.query('select * from account')
+        result = db.query(query)
+        if result:
+            for row in result:
+                print(f"The row is {row}")
+                final_results.append(row)
+            print(f"final results are {final_results}")
+            return final_results[skip: skip + limit]
+        else:
+            raise HTTPException(status_code=404, detail="Account not found")
+
+
+# batch reads: one IN (...) query for the ids a screen needs instead of one request and one find_one per row
+batch_read_max_ids = int(os.environ.get('BATCH_READ_MAX_IDS', '500'))
+
+
+def parse_id_list(values, field):
+    """
+        Turn comma separated or repeated values into distinct ints, in the order they were asked for:
+
+    """
+    ids = []
+    for value in values:
+        for part in str(value).split(','):
+            if not part.strip():
+                continue
+            try:
+                ids.append(int(part))
+            except ValueError:
+                raise HTTPException(status_code=400, detail=f"{field} must be integers, not {part.strip()}")
+    ids = list(dict.fromkeys(ids))
+    if len(ids) > batch_read_max_ids:
+        raise HTTPException(status_code=400, detail=f"At most {batch_read_max_ids} {field} per request")
+    return ids
+
+
+def find_rows_in(table_name, column, values):
+    """
+        Rows of a table whose column is one of values, in one query:
+
+    """
+    if not values:
+        return []
+    params = {f"value_{index}": value for index, value in enumerate(values)}
+    return list(db.query(f"SELECT * FROM {table_name} WHERE {column} IN "
+                         f"({', '.join(f':{name}' for name in params)}) ORDER BY id", **params))
+
+
+@app.get("/account/batch", tags=["Account"])
+async def read_account_batch(ids: List[str] = Query([]), account_codes: List[str] = Query([])):
+    """
+        Read many ledger accounts in one request, by ids and/or account_codes (comma separated or repeated),
+        accounts come back in the order asked for and the ones not found are listed in missing:
+
+    """
+    account_ids = parse_id_list(ids, 'ids')
+    codes = list(dict.fromkeys(code.strip() for value in account_codes for code in value.split(',') if code.strip()))
+    if not account_ids and not codes:
+        raise HTTPException(status_code=400, detail="Pass ids or account_codes")
+    if len(codes) > batch_read_max_ids:
+        raise HTTPException(status_code=400, detail=f"At most {batch_read_max_ids} account_codes per request")
+    accounts_by_id = {account['id']: account for account in find_rows_in('account', 'id', account_ids)}
+    accounts_by_code = {}
+    for account in find_rows_in('account', 'account_code', codes):
+        accounts_by_code.setdefault(account['account_code'], account)
+    accounts = [accounts_by_id[account_id] for account_id in account_ids if account_id in accounts_by_id]
+    accounts.extend(accounts_by_code[code] for code in codes
+                    if code in accounts_by_code and accounts_by_code[code]['id'] not in accounts_by_id)
+    return {'accounts': accounts,
+            'missing': [account_id for account_id in account_ids if account_id not in accounts_by_id] +
+            [code for code in codes if code not in accounts_by_code]}
+
+
+@app.get("/account/{account_id}", tags=["Account"])
+async def read_account(account_id: int, response: Response):
+    """
+        Read a ledger account using account_id, the ETag header carries the row version:
+
+    """
+    account = account_table.find_one(id=account_id)
+    if account:
+        response.headers['ETag'] = entity_tag(account['version'])
+        return account
+    else:
+        raise HTTPException(status_code=404, detail="Account not found")
+
+
+@app.put("/account/{account_id}", tags=["Account"])
+async def update_account(account_id: int, account: UpdateAccount, response: Response,
+                         if_match: Optional[str] = Header(None)):
+    """
+        Update a ledger account with new information, send If-Match with the ETag you read to get 412 on a
+        concurrent edit instead of overwriting it:
+
+    """
+    account_dict = account.dict()
+    print(f"the account_dict is: {account_dict}")
+    account_dict['id'] = account_id
+    account_dict['last_updated_time'] = datetime.now(timezone.utc).isoformat()
+    version = update_versioned_row(account_table, account_id, account_dict, parse_if_match(if_match))
+    if version:
+        account_dict['version'] = version
+        print(f"the updated account_dict is: {account_dict}")
+        response.headers['ETag'] = entity_tag(version)
+        return account_dict
+    else:
+        raise HTTPException(status_code=404, detail="Account not found")
+
+
+@app.delete("/account/{account_id}", tags=["Account"])
+async def delete_account(account_id: int):
+    """
+        Delete a Ledger Account:
+
+    """
+    account_to_delete = account_table.find_one(id=account_id)
+    if account_to_delete:
+        print(f"the account to delete is: {account_to_delete}")
+        account_table.delete(id=account_id)
+        return {"message": f"Account with id {account_id} has been deleted"}
+    else:
+        raise HTTPException(status_code=404, detail="Account not found")
+
+
+@app.post("/crypto_wallet/", tags=["Crypto Wallet"])
+async def create_crypto_wallet(crypto_wallet: CryptoWallet):
+    """
+        Create a ledger crypto_wallet using required information:
+
+    """
+    crypto_wallet_dict = crypto_wallet.dict()
+
+    db_insert = crypto_wallet_table.insert(crypto_wallet_dict)
+    print(f"db_insert is {db_insert}")
+    crypto_wallet_dict['id'] = db_insert
+    return crypto_wallet_dict
+
+
+@app.get("/crypto_wallet/query", tags=["Crypto Wallet"])
+async def query_crypto_wallet(query: Optional[str] = None, skip: int = 0, limit: int = 10):
+    """
+        Query a ledger crypto_wallet using a sql statement:
+
+    """
+    if query:
+        final_results = []
+        print(f"The query is {query}")
+        # result = db.query('select * from crypto_wallet')
+        result = db.query(query)
+        if result:
+            for row in result:
+                print(f"The row is {row}")
+                final_results.append(row)
+            print(f"final results are {final_results}")
+            return final_results[skip: skip + limit]
+        else:
+            raise HTTPException(status_code=404, detail="Crypto Wallet not found")
+
+
+@app.get("/crypto_wallet/{crypto_wallet_id}", tags=["Crypto Wallet"])
+async def read_crypto_wallet(crypto_wallet_id: int, response: Response):
+    """
+        Read a ledger crypto_wallet using crypto_wallet_id, the ETag header carries the row version:
+
+    """
+    crypto_wallet = crypto_wallet_table.find_one(id=crypto_wallet_id)
+    if crypto_wallet:
+        response.headers['ETag'] = entity_tag(crypto_wallet['version'])
+        return crypto_wallet
+    else:
+        raise HTTPException(status_code=404, detail="Crypto Wallet not found")
+
+
+@app.put("/crypto_wallet/{crypto_wallet_id}", tags=["Crypto Wallet"])
+async def update_crypto_wallet(crypto_wallet_id: int, crypto_wallet: UpdateCryptoWallet, response: Response,
+                               if_match: Optional[str] = Header(None)):
+    """
+        Update a ledger crypto_wallet with new information, send If-Match with the ETag you read to get 412 on a
+        concurrent edit instead of overwriting it:
+
+    """
+    crypto_wallet_dict = crypto_wallet.dict()
+    print(f"the crypto_wallet_dict is: {crypto_wallet_dict}")
+    crypto_wallet_dict['id'] = crypto_wallet_id
+    version = update_versioned_row(crypto_wallet_table, crypto_wallet_id, crypto_wallet_dict,
+                                   parse_if_match(if_match))
+    if version:
+        crypto_wallet_dict['version'] = version
+        print(f"the updated crypto_wallet_dict is: {crypto_wallet_dict}")
+        response.headers['ETag'] = entity_tag(version)
+        return crypto_wallet_dict
+    else:
+        raise HTTPException(status_code=404, detail="Crypto Wallet not found")
+
+
+@app.delete("/crypto_wallet/{crypto_wallet_id}", tags=["Crypto Wallet"])
+async def delete_crypto_wallet(crypto_wallet_id: int):
+    """
+        Delete a Ledger Crypto Wallet:
+
+    """
+    crypto_wallet_to_delete = crypto_wallet_table.find_one(id=crypto_wallet_id)
+    if crypto_wallet_to_delete:
+        print(f"the crypto_wallet to delete is: {crypto_wallet_to_delete}")
+        crypto_wallet_table.delete(id=crypto_wallet_id)
+        return {"message": f"Crypto Wallet with id {crypto_wallet_id} has been deleted"}
+    else:
+        raise HTTPException(status_code=404, detail="Crypto Wallet not found")
+
+
+@app.post("/contact/", tags=["Contact"])
+async def create_contact(contact: Contact):
+    """
+        Create a contact using required information:
+
+    """
+    contact_dict = contact.dict()
+
+    db_insert = contact_table.insert(contact_dict)
+    print(f"db_insert is {db_insert}")
+    contact_dict['id'] = db_insert
+    return contact_dict
+
+
+@app.get("/contact/query", tags=["Contact"])
+async def query_contact(query: Optional[str] = None, skip: int = 0, limit: int = 10):
+    """
+        Query a contact using a sql statement:
+
+    """
+    if query:
+        final_results = []
+        print(f"The query is {query}")
+        # result = db.query('select * from contact')
+        result = db.query(query)
+        if result:
+            for row in result:
+                print(f"The row is {row}")
+                final_results.append(row)
+            print(f"final results are {final_results}")
+            return final_results[skip: skip + limit]
+        else:
+            raise HTTPException(status_code=404, detail="Contact not found")
+
+
+@app.get("/contact/{contact_id}", tags=["Contact"])
+async def read_contact(contact_id: int):
+    """
+        Read a contact using contact_id:
+
+    """
+    contact = contact_table.find_one(id=contact_id)
+    if contact:
+        return contact
+    else:
+        raise HTTPException(status_code=404, detail="Contact not found")
+
+
+@app.put("/contact/{contact_id}", tags=["Contact"])
+async def update_contact(contact_id: int, contact: UpdateContact):
+    """
+        Update a contact with new information:
+
+    """
+    contact_to_update = contact_table.find_one(id=contact_id)
+    if contact_to_update:
+        print(f"the contact to update is: {contact_to_update}")
+        contact_dict = contact.dict(exclude_unset=True)
+        print(f"the contact_dict is: {contact_dict}")
+        contact_dict['id'] = contact_id
+        contact_table.update(contact_dict, ['id'])
+        return contact_dict
+    else:
+        raise HTTPException(status_code=404, detail="Contact not found")
+
+
+@app.delete("/contact/{contact_id}", tags=["Contact"])
+async def delete_contact(contact_id: int):
+    """
+        Delete a Contact:
+
+    """
+    contact_to_delete = contact_table.find_one(id=contact_id)
+    if contact_to_delete:
+        print(f"the contact to delete is: {contact_to_delete}")
+        contact_table.delete(id=contact_id)
+        return {"message": f"Contact with id {contact_id} has been deleted"}
+    else:
+        raise HTTPException(status_code=404, detail="Contact not found")
+
+
+def validate_journal_lines(journal_lines, on_date, line_amount_types=None):
+    """
+        Check the lines of a journal entry, turn credits negative, add the tax lines, fill in currencies and check
+        that it balances:
+
+    """
+    if not journal_lines:
+        raise HTTPException(status_code=404, detail="Cannot Record An Empty Journal Entry")
+
+    for line in journal_lines:
+        print(f"line in journal_lines: is {line}")
+        account_code = line['account_code']
+        amount = line['amount']
+        if not account_code:
+            raise HTTPException(status_code=404, detail="All Journal Lines Must Contain account_code")
+        if not amount:
+            raise HTTPException(status_code=404, detail="All Journal Lines Must Contain amount")
+
+        if line['posting_type'] == 'Credit' and line['amount'] > 0:
+            line['amount'] = -line["amount"]
+
+    apply_tax_codes(journal_lines, line_amount_types)
+    print(f"Updated journal_lines are: {journal_lines}")
+
+    code_amount = [[line['account_code'], line['amount']] for line in journal_lines]
+    print(f"code_amount is: {code_amount}")
+
+    base_total = convert_journal_lines(journal_lines, on_date)
+    if {line['currency'] for line in journal_lines} == {base_currency}:
+        # tax split off a line leaves float cents that only add up to zero once rounded
+        if round(sum(line[1] for line in code_amount), 2) != 0:
+            raise HTTPException(status_code=404, detail="Unbalanced Journal Lines")
+    elif abs(base_total) > 0.005:
+        raise HTTPException(status_code=404, detail=f"Unbalanced Journal Lines in {base_currency}")
+
+
+@app.post("/journalentry/", tags=["Journal Entry"])
+async def create_journal_entry(journal_entry: JournalEntry):
+    """
+        Create a journal entry using required information:
+
+    """
+
+    current_date = datetime.now(timezone.utc).astimezone().strftime('%Y-%m-%d')
+    journal_entry_dict = journal_entry.dict()
+    journal_lines = journal_entry_dict['journal_lines']
+    journal_entry_date = journal_entry_dict['date']
+
+    if not journal_entry_date:
+        journal_entry_dict['date'] = current_date
+
+    validate_journal_lines(journal_lines, journal_entry_dict['date'], journal_entry.line_amount_types)
+
+    print(f"journal_lines in journal_entry_dict is {journal_lines}")
+    db_insert = insert_journal_entry(journal_entry_dict)
+    print(f"db_insert is {db_insert}")
+    journal_entry_dict['id'] = db_insert
+    return fast_json_response(journal_entry_dict)
+
+
+@app.get("/journalentry/query", tags=["Journal Entry"])
+async def query_journal_entry(query: Optional[str] = None, skip: int = 0, limit: int = 10):
+    """
+           Query a journal entry using a sql statement:
+
+    """
+    if query:
+        final_results = []
+        print(f"The query is {query}")
+        # result = db.query('select * from journal_entry')
+        result = db.query(query)
+        if result:
+            for row in result:
+                print(f"The row is {row['journal_lines']}")
+                with journal_lines_json_seconds.time(operation='decode'):
+                    journal_lines = load_json(row['journal_lines'])
+                row['journal_lines'] = journal_lines
+                final_results.append(row)
+            return fast_json_response(final_results[skip: skip + limit])
+        else:
+            raise HTTPException(status_code=404, detail="Journal Entry not found")
+
+
+@app.post("/journalentry/batch-get", tags=["Journal Entry"])
+async def read_journal_entry_batch(batch_get: JournalEntryBatchGet):
+    """
+        Read many journal entries in one request, expand ACCOUNTS adds the account record to each journal line,
+        entries of archived fiscal years are read from their archive:
+
+    """
+    journal_entry_ids = parse_id_list(batch_get.ids, 'ids')
+    journal_entries = {row['id']: row for row in find_rows_in('journal_entry', 'id', journal_entry_ids)}
+    missing_ids = [journal_entry_id for journal_entry_id in journal_entry_ids
+                   if journal_entry_id not in journal_entries]
+    if missing_ids:
+        journal_entries.update(read_archived_journal_entries(missing_ids))
+    with journal_lines_json_seconds.time(operation='decode'):
+        for journal_entry in journal_entries.values():
+            journal_entry['journal_lines'] = load_json(journal_entry['journal_lines'])
+    if JournalEntryExpansion.ACCOUNTS in (batch_get.expand or []):
+        codes = sorted({str(line['account_code']) for journal_entry in journal_entries.values()
+                        for line in journal_entry['journal_lines'] if line.get('account_code') is not None})
+        accounts_by_code = {}
+        for account in find_rows_in('account', 'account_code', codes):
+            accounts_by_code.setdefault(account['account_code'], account)
+        for journal_entry in journal_entries.values():
+            for line in journal_entry['journal_lines']:
+                line['account'] = accounts_by_code.get(str(line.get('account_code')))
+    return fast_json_response({
+        'journal_entries': [journal_entries[journal_entry_id] for journal_entry_id in journal_entry_ids
+                            if journal_entry_id in journal_entries],
+        'missing': [journal_entry_id for journal_entry_id in journal_entry_ids
+                    if journal_entry_id not in journal_entries],
+    })
+
+
+@app.get("/journalentry/{journal_entry_id}", tags=["Journal Entry"])
+async def read_journal_entry(journal_entry_id: str):
+    """
+        Read a journal_entry using journal_entry_id, falling back to the archive of its closed fiscal year:
+
+    """
+    journal_entry = journal_entry_table.find_one(id=journal_entry_id) or read_archived_journal_entry(journal_entry_id)
+    if journal_entry:
+        journal_lines = journal_entry['journal_lines']
+        with journal_lines_json_seconds.time(operation='decode'):
+            json_compatible_line_items = load_json(journal_lines)
+        journal_entry['journal_lines'] = json_compatible_line_items
+        response = fast_json_response(journal_entry)
+        response.headers['ETag'] = entity_tag(journal_entry['version'])
+        return response
+    else:
+        raise HTTPException(status_code=404, detail="Journal Entry not found")
+
+
+@app.put("/journalentry/{journal_entry_id}", tags=["Journal Entry"])
+async def update_journal_entry(journal_entry_id: str, journal_entry: UpdateJournalEntry,
+                               if_match: Optional[str] = Header(None)):
+    """
+        Update a journal_entry with new information, send If-Match with the ETag you read to get 412 on a
+        concurrent edit instead of overwriting it:
+
+    """
+    journal_entry_dict = journal_entry.dict()
+    line_items = journal_entry_dict['journal_lines']
+    print(f"line_items in journal_entry_dict is {line_items}")
+    stored_date = fetch_rows("SELECT date FROM journal_entry WHERE id = :id", id=journal_entry_id)
+    check_open_fiscal_years({journal_entry_dict.get('date'), stored_date[0][0] if stored_date else None})
+    if line_items:
+        # the same checks as a new entry: credits negative, tax lines, currencies and balance
+        rate_date = journal_entry_dict.get('date')
+        if not rate_date:
+            rate_date = stored_date[0][0] if stored_date else None
+        validate_journal_lines(line_items, rate_date, journal_entry.line_amount_types)
+    journal_entry_dict['id'] = journal_entry_id
+    journal_entry_dict['last_updated_time'] = datetime.now(timezone.utc).isoformat()
+    # the stored row is the same dict with journal_lines as JSON text, no second model dump
+    json_journal_entry_dict = dict(journal_entry_dict)
+    with journal_lines_json_seconds.time(operation='encode'):
+        json_journal_entry_dict["journal_lines"] = dump_json(line_items)
+    with db:
+        version = update_versioned_row(journal_entry_table, journal_entry_id, json_journal_entry_dict,
+                                       parse_if_match(if_match))
+        if not version:
+            raise HTTPException(status_code=404, detail="Journal Entry not found")
+        replace_journal_lines(journal_entry_id, journal_entry_dict, line_items)
+        enqueue_events([('journal_entry.updated', dict(journal_entry_dict, version=version))])
+
+    journal_entry_dict['version'] = version
+    response = fast_json_response(journal_entry_dict)
+    response.headers['ETag'] = entity_tag(version)
+    return response
+
+
+@app.delete("/journalentry/{journal_entry_id}", tags=["Journal Entry"])
+async def delete_journal_entry(journal_entry_id: str):
+    """
+        Delete a Journal Entry:
+
+    """
+    journal_entry_to_delete = journal_entry_table.find_one(id=journal_entry_id)
+    if journal_entry_to_delete:
+        print(f"the journal_entry to delete is: {journal_entry_to_delete}")
+        check_open_fiscal_years({journal_entry_to_delete['date']})
+        with db:
+            journal_entry_table.delete(id=journal_entry_id)
+            replace_journal_lines(journal_entry_to_delete['id'], journal_entry_to_delete, [])
+            enqueue_events([('journal_entry.deleted', {'id': journal_entry_to_delete['id']})])
+        return {"message": f"Journal Entry with id {journal_entry_id} has been deleted"}
+    else:
+        raise HTTPException(status_code=404, detail="Journal Entry not found")
+
+
+def build_search_match(q):
+    """
+        Turn free text into an FTS5 match expression of quoted prefix terms:
+
+    """
+    terms = [term.replace('"', '""') for term in q.split()]
+    return " ".join(f'"{term}"*' for term in terms if term)
+
+
+@app.get("/search", response_model=List[SearchResult], tags=["Search"])
+async def search(q: str = Query(..., min_length=1),
+                 types: Optional[List[str]] = Query(None),
+                 skip: int = 0,
+                 limit: int = 10):
+    """
+        Search journal entries, accounts and contacts by keyword, best matches first:
+
+    """
+    searched_tables = types or list(search_index_columns)
+    unknown_types = [table_name for table_name in searched_tables if table_name not in search_index_columns]
+    if unknown_types:
+        raise HTTPException(status_code=400, detail=f"Cannot search unknown types {unknown_types}")
+
+    match = build_search_match(q)
+    if not match:
+        raise HTTPException(status_code=400, detail="Search query must contain at least one term")
+
+    selects = [
+        f"SELECT '{table_name}' AS type, {table_name}_fts.rowid AS id, "
+        f"snippet({table_name}_fts, -1, '[', ']', '...', 12) AS snippet, "
+        f"bm25({table_name}_fts) AS rank "
+        f"FROM {table_name}_fts WHERE {table_name}_fts MATCH :match"
+        for table_name in searched_tables
+    ]
+    statement = " UNION ALL ".join(selects) + " ORDER BY rank LIMIT :limit OFFSET :skip"
+    print(f"The search statement is {statement}")
+    return [dict(row) for row in db.query(statement, match=match, limit=limit, skip=skip)]
+
+
+statement_date_formats = ['%Y-%m-%d', '%m/%d/%Y', '%m/%d/%y', '%Y%m%d', '%d %b %Y']
+
+
+def parse_statement_date(value):
+    """
+        Parse a bank statement date into an ISO date string:
+
+    """
+    value = str(value or '').strip()
+    try:
+        return date.fromisoformat(value).isoformat()
+    except ValueError:
+        pass
+    for date_format in statement_date_formats:
+        try:
+            return datetime.strptime(value, date_format).date().isoformat()
+        except ValueError:
+            continue
+    raise HTTPException(status_code=400, detail=f"Unrecognized statement date {value!r}")
+
+
+def parse_statement_amount(value):
+    """
+        Parse a bank statement amount, allowing currency symbols, separators and (negative) notation:
+
+    """
+    if isinstance(value, (int, float)):
+        return float(value)
+    value = str(value or '').strip().replace('$', '').replace(',', '')
+    if value.startswith('(') and value.endswith(')'):
+        value = '-' + value[1:-1]
+    try:
+        return float(value) if value else 0.0
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Unrecognized statement amount {value!r}")
+
+
+def first_present(row, names):
+    for name in names:
+        if row.get(name) not in (None, ''):
+            return row[name]
+    return None
+
+
+def parse_statement_csv(content):
+    """
+        Parse CSV bank statement lines with either an amount column or deposit/withdrawal columns:
+
+    """
+    reader = csv.DictReader(io.StringIO(content))
+    statement_lines = []
+    for row in reader:
+        row = {str(key).strip().lower(): value for key, value in row.items() if key}
+        amount = first_present(row, ['amount', 'transaction amount'])
+        if amount is None:
+            deposit = parse_statement_amount(first_present(row, ['deposit', 'credit']))
+            withdrawal = parse_statement_amount(first_present(row, ['withdrawal', 'debit']))
+            amount = deposit - abs(withdrawal)
+        else:
+            amount = parse_statement_amount(amount)
+        statement_lines.append({
+            'date': parse_statement_date(first_present(row, ['date', 'posted date', 'transaction date'])),
+            'amount': amount,
+            'description': first_present(row, ['description', 'memo', 'payee', 'name']),
+            'reference': first_present(row, ['reference', 'id', 'fitid', 'check number']),
+        })
+    return statement_lines
+
+
+def parse_statement_ofx(content):
+    """
+        Parse the STMTTRN blocks of an OFX (SGML or XML) bank statement:
+
+    """
+    statement_lines = []
+    for transaction in re.findall(r'<STMTTRN>(.*?)(?:</STMTTRN>|(?=<STMTTRN>)|</BANKTRANLIST>)', content,
+                                  re.DOTALL | re.IGNORECASE):
+        fields = {
+            tag.upper(): value.strip()
+            for tag, value in re.findall(r'<(\w+)>([^<\r\n]*)', transaction)
+        }
+        statement_lines.append({
+            'date': parse_statement_date(fields.get('DTPOSTED', '')[:8]),
+            'amount': parse_statement_amount(fields.get('TRNAMT')),
+            'description': fields.get('NAME') or fields.get('MEMO'),
+            'reference': fields.get('FITID') or fields.get('CHECKNUM'),
+        })
+    return statement_lines
+
+
+def description_tokens(description):
+    return frozenset(re.findall(r'[a-z0-9]+', str(description or '').lower()))
+
+
+def description_similarity(first_tokens, second_tokens):
+    """
+        Fuzzy description score: the overlap of the word sets, independent of word order:
+
+    """
+    if not first_tokens or not second_tokens:
+        return 0.0
+    return len(first_tokens & second_tokens) / len(first_tokens | second_tokens)
+
+
+def match_statement_lines(statement_lines, journal_lines, date_window_days=3, min_score=0.0):
+    """
+        Pair (id, date, amount, description) statement lines with journal lines of the same amount in the date window:
+
+    """
+    # hash index on amount in cents, each bucket sorted by date so the window is a bisect away
+    buckets = {}
+    for journal_line_id, journal_line_date, amount, description in journal_lines:
+        try:
+            day = date.fromisoformat(journal_line_date).toordinal()
+        except (TypeError, ValueError):
+            continue
+        buckets.setdefault(round(amount * 100), []).append((day, journal_line_id, description_tokens(description)))
+    bucket_days = {}
+    for key, bucket in buckets.items():
+        bucket.sort(key=lambda candidate: candidate[0])
+        bucket_days[key] = [candidate[0] for candidate in bucket]
+
+    claimed = set()
+    matches = []
+    for statement_line_id, statement_line_date, amount, description in statement_lines:
+        key = round(amount * 100)
+        bucket = buckets.get(key)
+        if not bucket:
+            continue
+        day = date.fromisoformat(statement_line_date).toordinal()
+        statement_tokens = description_tokens(description)
+        low = bisect_left(bucket_days[key], day - date_window_days)
+        high = bisect_right(bucket_days[key], day + date_window_days)
+        best_id = None
+        best_score = -1.0
+        for candidate_day, journal_line_id, tokens in bucket[low:high]:
+            if journal_line_id in claimed:
+                continue
+            date_score = 1 - abs(candidate_day - day) / (date_window_days + 1)
+            score = 0.5 * date_score + 0.5 * description_similarity(statement_tokens, tokens)
+            if score > best_score:
+                best_id = journal_line_id
+                best_score = score
+        if best_id is not None and best_score >= min_score:
+            claimed.add(best_id)
+            matches.append((statement_line_id, best_id, round(best_score, 4)))
+    return matches
+
+
+def reconcile_bank_statement(bank_statement_id, date_window_days=3, min_score=0.0):
+    """
+        Match the unreconciled lines of a bank statement and record the reconciled status:
+
+    """
+    bank_statement = bank_statement_table.find_one(id=bank_statement_id)
+    statement_lines = fetch_rows("SELECT id, date, amount, description FROM bank_statement_line "
+                                 "WHERE bank_statement_id = :bank_statement_id AND reconciled = 0",
+                                 bank_statement_id=bank_statement_id)
+    if not statement_lines:
+        return []
+    statement_days = [date.fromisoformat(line[1]).toordinal() for line in statement_lines]
+    start_date = date.fromordinal(min(statement_days) - date_window_days).isoformat()
+    end_date = date.fromordinal(max(statement_days) + date_window_days).isoformat()
+    journal_lines = fetch_rows("SELECT id, date, amount, description FROM journal_line "
+                               "WHERE account_code = :account_code AND reconciled = 0 "
+                               "AND date BETWEEN :start_date AND :end_date",
+                               account_code=bank_statement['account_code'], start_date=start_date, end_date=end_date)
+    matches = match_statement_lines(statement_lines, journal_lines, date_window_days, min_score)
+    print(f"matched {len(matches)} of {len(statement_lines)} statement lines")
+    with db:
+        execute_many("UPDATE bank_statement_line SET reconciled = 1, journal_line_id = ?, match_score = ? "
+                     "WHERE id = ?",
+                     [(journal_line_id, score, statement_line_id)
+                      for statement_line_id, journal_line_id, score in matches])
+        execute_many("UPDATE journal_line SET reconciled = 1, statement_line_id = ? WHERE id = ?",
+                     [(statement_line_id, journal_line_id) for statement_line_id, journal_line_id, score in matches])
+    return matches
+
+
+@app.post("/reconciliation/import", tags=["Reconciliation"])
+async def import_bank_statement(request: Request,
+                                account_code: str,
+                                file_format: StatementFormat = StatementFormat.CSV,
+                                auto_match: bool = True,
+                                date_window_days: int = Query(3, ge=0, le=60),
+                                min_score: float = Query(0.0, ge=0.0, le=1.0)):
+    """
+        Import a CSV or OFX bank statement sent as the request body and match it to the ledger:
+
+    """
+    content = (await request.body()).decode('utf-8-sig')
+    if file_format == StatementFormat.OFX:
+        statement_lines = parse_statement_ofx(content)
+    else:
+        statement_lines = parse_statement_csv(content)
+    if not statement_lines:
+        raise HTTPException(status_code=400, detail="Bank statement contains no transactions")
+
+    bank_statement_dict = {
+        'account_code': account_code,
+        'file_format': file_format.value,
+        'imported_time': datetime.now(timezone.utc).isoformat(),
+        'line_count': len(statement_lines),
+    }
+    with db:
+        bank_statement_id = bank_statement_table.insert(bank_statement_dict)
+        execute_many("INSERT INTO bank_statement_line "
+                     "(bank_statement_id, account_code, date, amount, description, reference, reconciled) "
+                     "VALUES (?, ?, ?, ?, ?, ?, 0)",
+                     [(bank_statement_id, account_code, line['date'], line['amount'], line['description'],
+                       line['reference']) for line in statement_lines])
+    print(f"imported {len(statement_lines)} statement lines into bank_statement {bank_statement_id}")
+
+    matches = reconcile_bank_statement(bank_statement_id, date_window_days, min_score) if auto_match else []
+    bank_statement_dict['id'] = bank_statement_id
+    bank_statement_dict['matched'] = len(matches)
+    bank_statement_dict['unmatched'] = len(statement_lines) - len(matches)
+    return bank_statement_dict
+
+
+@app.post("/reconciliation/{bank_statement_id}/match", tags=["Reconciliation"])
+async def match_bank_statement(bank_statement_id: int,
+                               date_window_days: int = Query(3, ge=0, le=60),
+                               min_score: float = Query(0.0, ge=0.0, le=1.0)):
+    """
+        Re-run matching for the unreconciled lines of an imported bank statement:
+
+    """
+    bank_statement = bank_statement_table.find_one(id=bank_statement_id)
+    if not bank_statement:
+        raise HTTPException(status_code=404, detail="Bank Statement not found")
+    matches = reconcile_bank_statement(bank_statement_id, date_window_days, min_score)
+    bank_statement['matched'] = len(matches)
+    bank_statement['unmatched'] = bank_statement_line_table.count(bank_statement_id=bank_statement_id,
+                                                                  reconciled=False)
+    return bank_statement
+
+
+@app.get("/reconciliation/{bank_statement_id}", tags=["Reconciliation"])
+async def read_bank_statement(bank_statement_id: int, reconciled: Optional[bool] = None,
+                              skip: int = 0, limit: int = 100):
+    """
+        Read an imported bank statement and its lines:
+
+    """
+    bank_statement = bank_statement_table.find_one(id=bank_statement_id)
+    if not bank_statement:
+        raise HTTPException(status_code=404, detail="Bank Statement not found")
+    filters = {'bank_statement_id': bank_statement_id}
+    if reconciled is not None:
+        filters['reconciled'] = reconciled
+    bank_statement['lines'] = list(bank_statement_line_table.find(order_by='id', _offset=skip, _limit=limit,
+                                                                  **filters))
+    return bank_statement
+
+
+@app.put("/reconciliation/statement_line/{statement_line_id}", tags=["Reconciliation"])
+async def update_statement_line_match(statement_line_id: int, statement_line_match: StatementLineMatch):
+    """
+        Manually match a bank statement line to a journal line, or clear its match with a null journal_line_id:
+
+    """
+    statement_line = bank_statement_line_table.find_one(id=statement_line_id)
+    if not statement_line:
+        raise HTTPException(status_code=404, detail="Bank Statement Line not found")
+    journal_line_id = statement_line_match.journal_line_id
+    if journal_line_id is not None:
+        journal_line = journal_line_table.find_one(id=journal_line_id)
+        if not journal_line:
+            raise HTTPException(status_code=404, detail="Journal Line not found")
+        if journal_line['reconciled'] and journal_line['statement_line_id'] != statement_line_id:
+            raise HTTPException(status_code=409, detail="Journal Line is already reconciled")
+
+    with db:
+        if statement_line['journal_line_id']:
+            journal_line_table.update({'id': statement_line['journal_line_id'], 'reconciled': False,
+                                       'statement_line_id': None}, ['id'])
+        if journal_line_id is not None:
+            journal_line_table.update({'id': journal_line_id, 'reconciled': True,
+                                       'statement_line_id': statement_line_id}, ['id'])
+        statement_line.update({'journal_line_id': journal_line_id, 'reconciled': journal_line_id is not None,
+                               'match_score': None})
+        bank_statement_line_table.update(statement_line, ['id'])
+    return statement_line
+
+
+class AdmissionGate:
+    """
+        Weighted concurrency limit of an endpoint class with a bounded FIFO queue, shedding requests it cannot serve:
+
+    """
+    def __init__(self, name, capacity, max_queue, max_wait):
+        self.name = name
+        self.capacity = capacity
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.in_use = 0
+        self.waiters = deque()
+        # moving average of the run time of one unit of cost, used for Retry-After
+        self.seconds_per_cost = 1.0
+
+    def retry_after(self, cost):
+        queued_cost = self.in_use + sum(waiter_cost for waiter_cost, _ in self.waiters) + cost
+        return str(max(1, math.ceil(self.seconds_per_cost * queued_cost / self.capacity)))
+
+    async def acquire(self, cost):
+        cost = min(max(cost, 1), self.capacity)
+        if not self.waiters and self.in_use + cost <= self.capacity:
+            self.in_use += cost
+            admission_wait_seconds.observe(0, gate=self.name, outcome='admitted')
+            return cost
+        if len(self.waiters) >= self.max_queue:
+            admission_wait_seconds.observe(0, gate=self.name, outcome='shed')
+            raise HTTPException(status_code=429, headers={'Retry-After': self.retry_after(cost)},
+                                detail=f"Too many {self.name} requests, retry later")
+        start = time.perf_counter()
+        waiter = (cost, asyncio.get_running_loop().create_future())
+        self.waiters.append(waiter)
+        try:
+            await asyncio.wait({waiter[1]}, timeout=self.max_wait)
+        except BaseException:
+            if waiter[1].done():
+                # cancelled right after being admitted, hand the capacity on
+                self.release(cost, 0)
+            else:
+                self.waiters.remove(waiter)
+            raise
+        if not waiter[1].done():
+            self.waiters.remove(waiter)
+            admission_wait_seconds.observe(time.perf_counter() - start, gate=self.name, outcome='timeout')
+            raise HTTPException(status_code=503, headers={'Retry-After': self.retry_after(cost)},
+                                detail=f"{self.name} capacity is busy, retry later")
+        admission_wait_seconds.observe(time.perf_counter() - start, gate=self.name, outcome='admitted')
+        return cost
+
+    def release(self, cost, seconds):
+        self.in_use -= cost
+        if seconds:
+            self.seconds_per_cost = 0.8 * self.seconds_per_cost + 0.2 * seconds / cost
+        while self.waiters and self.in_use + self.waiters[0][0] <= self.capacity:
+            waiter_cost, future = self.waiters.popleft()
+            self.in_use += waiter_cost
+            future.set_result(True)
+
+
+# reports may use REPORT_CONCURRENCY cost units at once, a report costs one unit per REPORT_COST_DAYS of its range
+admission_gates = {
+    'reports': AdmissionGate('reports', int(os.environ.get('REPORT_CONCURRENCY', '4')),
+                             int(os.environ.get('REPORT_QUEUE_SIZE', '16')),
+                             float(os.environ.get('REPORT_QUEUE_SECONDS', '10'))),
+}
+report_cost_days = int(os.environ.get('REPORT_COST_DAYS', '366'))
+in_flight_reports = {}
+
+
+def report_cost(start_date, end_date, capacity):
+    """
+        Estimate the cost of a report from the span of its date range, an open range costs the whole capacity:
+
+    """
+    if start_date is None or end_date is None:
+        return capacity
+    return max(1, math.ceil(((end_date - start_date).days + 1) / report_cost_days))
+
+
+def compute_report(tenant, build_report, parameters):
+    with tenant_databases.use(tenant):
+        return build_report(**parameters)
+
+
+async def run_report(report, build_report, **parameters):
+    """
+        Run a report on a worker thread once admitted, identical in-flight requests share a single computation:
+
+    """
+    tenant = current_tenant.get()
+    key = (tenant, id(current_reader.get()), report, tuple(sorted(parameters.items())))
+    shared = in_flight_reports.get(key)
+    if shared is None:
+        shared = in_flight_reports[key] = asyncio.ensure_future(
+            admit_report(build_report, tenant, parameters))
+        shared.add_done_callback(lambda task: in_flight_reports.pop(key, None))
+    else:
+        print(f"sharing the in-flight {report} report computation")
+    # shielded so a disconnecting client does not cancel the computation other requests are waiting on
+    return await asyncio.shield(shared)
+
+
+async def admit_report(build_report, tenant, parameters):
+    gate = admission_gates['reports']
+    cost = await gate.acquire(report_cost(parameters.get('start_date'), parameters.get('end_date'), gate.capacity))
+    start = time.perf_counter()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            None, copy_context().run, compute_report, tenant, build_report, parameters)
+    finally:
+        gate.release(cost, time.perf_counter() - start)
+
+
+def profit_and_loss_report(start_date: Optional[date] = None, end_date: Optional[date] = None):
+    """
+        Build the profit and loss report of the journal entries dated between start_date and end_date:
+
+    """
+
+    report_timer = StageTimer(report_stage_seconds, report='profit_and_loss')
+    report_timer.switch('fetch')
+    result = journal_entries_between(start_date, end_date)
+    print(f"The result is {result}")
+    accounts_by_type = {'revenue': {}, 'cogs': {}, 'expense': {}, 'other_income': {}, 'other_expenses': {}}
+    if result:
+        for row in result:
+            print(f"The row is {row['journal_lines']}")
+            report_timer.switch('decode')
+            journal_lines = load_json(row['journal_lines'])
+            report_timer.switch('aggregate')
+            for each in journal_lines:
+                print(f"each in journal_lines is {each}")
+
+                if str(each['account_type']).lower() in ["revenue", "cogs", "expense", "other_income",
+                                                         "other_expenses"]:
+                    key = str(each['account_type']).lower()
+                    print(f"Key is {key}")
+                    try:
+                        accounts_by_type[f"{key}"][f"account_code_{each['account_code']}"].append(
+                            base_amount(each, row['date']))
+                    except KeyError:
+                        accounts_by_type[f"{key}"][f"account_code_{each['account_code']}"] = []
+                        accounts_by_type[f"{key}"][
+                            f"account_code_{each['account_code']}"].append(base_amount(each, row['date']))
+            report_timer.switch('fetch')
+    else:
+        raise HTTPException(status_code=404, detail="Journal Entry not found")
+
+    report_timer.switch('aggregate')
+    print(f"accounts by type are {accounts_by_type}")
+
+    for account in accounts_by_type['revenue']:
+        print(f"account in ACCOUNTS BY TYPE is {account}")
+        accounts_by_type['revenue'][f'{account}'] = sum(accounts_by_type['revenue'][f'{account}'])
+
+    for account in accounts_by_type['cogs']:
+        print(f"account in ACCOUNTS BY TYPE is {account}")
+        accounts_by_type['cogs'][f'{account}'] = sum(accounts_by_type['cogs'][f'{account}'])
+
+    for account in accounts_by_type['expense']:
+        print(f"account in ACCOUNTS BY TYPE is {account}")
+        accounts_by_type['expense'][f'{account}'] = sum(accounts_by_type['expense'][f'{account}'])
+
+    for account in accounts_by_type['other_income']:
+        print(f"account in ACCOUNTS BY TYPE is {account}")
+        accounts_by_type['other_income'][f'{account}'] = sum(accounts_by_type['other_income'][f'{account}'])
+
+    for account in accounts_by_type['other_expenses']:
+        print(f"account in ACCOUNTS BY TYPE is {account}")
+        accounts_by_type['other_expenses'][f'{account}'] = sum(accounts_by_type['other_expenses'][f'{account}'])
+
+    print(f"UPDATED accounts by type are {accounts_by_type}")
+
+    report_timer.switch('render')
+    income_rows = []
+    cogs_rows = []
+    expense_rows = []
+    other_income_rows = []
+    other_expenses_rows = []
+
+    total_income = 0
+    print(f"TOTAL INCOME is {total_income}")
+
+    absolute_total_income = 0
+    print(f"ABSOLUTE TOTAL INCOME is {absolute_total_income}")
+
+    absolute_total_other_income = 0
+    print(f"ABSOLUTE TOTAL OTHER INCOME is {absolute_total_other_income}")
+
+    total_cogs = 0
+    print(f"TOTAL COSTS OF GOODS SOLD is {total_cogs}")
+
+    gross_profit = 0
+    print(f"GROSS PROFIT is {gross_profit}")
+
+    total_expenses = 0
+    print(f"TOTAL EXPENSES is {total_expenses}")
+
+    net_operating_income = 0
+    print(f"NET OPERATING INCOME is {net_operating_income}")
+
+    total_other_income = 0
+    print(f"TOTAL OTHER INCOME is {total_other_income}")
+
+    total_other_expenses = 0
+    print(f"TOTAL OTHER EXPENSES is {total_other_expenses}")
+
+    net_other_income = 0
+    print(f"NET OTHER INCOME is {net_other_income}")
+
+    net_income = 0
+    print(f"NET INCOME is {net_income}")
+
+    for account, balance in accounts_by_type['revenue'].items():
+        total_income += balance
+        absolute_total_income += abs(balance)
+        print(f"Account is {account} and balance is {balance}")
+        account_id = str(account).split("_")[-1]
+        print(f"Account ID is {account_id}")
+        column_data_id_value = {"id": account_id, "value": str(account).capitalize()}
+        print(f"ColData ID VALUE is {column_data_id_value}")
+        column_data_value = {"value": str(balance * -1)}
+        print(f"ColData VALUE is {column_data_value}")
+        column_data = {"ColData": [column_data_id_value, column_data_value], "type": "Data"}
+        print(f"ColData is {column_data}")
+        income_rows.append(column_data)
+
+    print(f"INCOME_ROWS is {income_rows}")
+    print(f"TOTAL_INCOME is {total_income}")
+    print(f"ABSOLUTE_TOTAL_INCOME is {absolute_total_income}")
+
+    for account, balance in accounts_by_type['cogs'].items():
+        total_cogs += balance
+        print(f"Account is {account} and balance is {balance}")
+        account_id = str(account).split("_")[-1]
+        print(f"Account ID is {account_id}")
+        column_data_id_value = {"id": account_id, "value": str(account).capitalize()}
+        print(f"ColData ID VALUE is {column_data_id_value}")
+        column_data_value = {"value": str(balance)}
+        print(f"ColData VALUE is {column_data_value}")
+        column_data = {"ColData": [column_data_id_value, column_data_value], "type": "Data"}
+        print(f"ColData is {column_data}")
+        cogs_rows.append(column_data)
+
+    print(f"COGS_ROWS is {cogs_rows}")
+    print(f"TOTAL_COGS is {total_cogs}")
+
+    for account, balance in accounts_by_type['expense'].items():
+        total_expenses += balance
+        print(f"Account is {account} and balance is {balance}")
+        account_id = str(account).split("_")[-1]
+        print(f"Account ID is {account_id}")
+        column_data_id_value = {"id": account_id, "value": str(account).capitalize()}
+        print(f"ColData ID VALUE is {column_data_id_value}")
+        column_data_value = {"value": str(balance)}
+        print(f"ColData VALUE is {column_data_value}")
+        column_data = {"ColData": [column_data_id_value, column_data_value], "type": "Data"}
+        print(f"ColData is {column_data}")
+        expense_rows.append(column_data)
+
+    print(f"EXPENSE_ROWS is {expense_rows}")
+    print(f"TOTAL_EXPENSES is {total_expenses}")
+
+    for account, balance in accounts_by_type['other_income'].items():
+        total_other_income += balance
+        absolute_total_other_income += abs(balance)
+        print(f"Account is {account} and balance is {balance}")
+        account_id = str(account).split("_")[-1]
+        print(f"Account ID is {account_id}")
+        column_data_id_value = {"id": account_id, "value": str(account).capitalize()}
+        print(f"ColData ID VALUE is {column_data_id_value}")
+        column_data_value = {"value": str(balance * -1)}
+        print(f"ColData VALUE is {column_data_value}")
+        column_data = {"ColData": [column_data_id_value, column_data_value], "type": "Data"}
+        print(f"ColData is {column_data}")
+        other_income_rows.append(column_data)
+
+    print(f"OTHER_INCOME_ROWS is {other_income_rows}")
+    print(f"TOTAL_OTHER_INCOME is {total_other_income}")
+    print(f"ABSOLUTE_TOTAL_OTHER_INCOME is {absolute_total_other_income}")
+
+    for account, balance in accounts_by_type['other_expenses'].items():
+        total_other_expenses += balance
+        print(f"Account is {account} and balance is {balance}")
+        account_id = str(account).split("_")[-1]
+        print(f"Account ID is {account_id}")
+        column_data_id_value = {"id": account_id, "value": str(account).capitalize()}
+        print(f"ColData ID VALUE is {column_data_id_value}")
+        column_data_value = {"value": str(balance)}
+        print(f"ColData VALUE is {column_data_value}")
+        column_data = {"ColData": [column_data_id_value, column_data_value], "type": "Data"}
+        print(f"ColData is {column_data}")
+        other_expenses_rows.append(column_data)
+
+    print(f"OTHER_EXPENSES_ROWS is {other_expenses_rows}")
+    print(f"TOTAL_OTHER_EXPENSES is {total_other_expenses}")
+
+    gross_profit = absolute_total_income - total_cogs
+    print(f"GROSS PROFIT is {gross_profit}")
+
+    net_operating_income = gross_profit - total_expenses
+    print(f"NET OPERATING INCOME is {net_operating_income}")
+
+    net_income = net_operating_income + net_other_income
+    print(f"NET INCOME is {net_income}")
+
+    net_other_income = absolute_total_other_income - total_other_expenses
+    print(f"NET OTHER INCOME is {net_other_income}")
+
+    income_group = {
+        "Header": {
+            "ColData": [
+                {
+                    "value": "Income"
+                },
+                {
+                    "value": ""
+                }
+            ]
+        },
+        "Rows": {
+            "Row": []
+
+        },
+        "type": "Section",
+        "group": "Income",
+        "Summary": {
+            "ColData": []
+        }
+    }
+    income_group['Rows']['Row'] = income_rows
+    income_group['Summary']['ColData'] = [
+        {"value": "Total Income"},
+        {"value": f"{absolute_total_income}"}
+    ]
+    print(f"DYNAMIC INCOME_GROUP is {income_group}")
+
+    cogs_group = {
+        "Header": {
+            "ColData": [
+                {
+                    "value": "Cost of Goods Sold"
+                },
+                {
+                    "value": ""
+                }
+            ]
+        },
+        "Rows": {
+            "Row": []
+
+        },
+        "type": "Section",
+        "group": "COGS",
+        "Summary": {
+            "ColData": []
+        }
+    }
+    cogs_group['Rows']['Row'] = cogs_rows
+    cogs_group['Summary']['ColData'] = [
+        {"value": "Total Cost of Goods Sold"},
+        {"value": f"{total_cogs}"}
+    ]
+    print(f"DYNAMIC COGS GROUP is {cogs_group}")
+
+    gross_profit_group = {
+        "type": "Section",
+        "group": "Gross Profit",
+        "Summary": {
+            "ColData": []
+        }
+    }
+    gross_profit_group['Summary']['ColData'] = [
+        {"value": "Gross Profit"},
+        {"value": f"{gross_profit}"}
+    ]
+    print(f"DYNAMIC GROSS PROFIT GROUP is {gross_profit_group}")
+
+    expense_group = {
+        "Header": {
+            "ColData": [
+                {
+                    "value": "Expenses"
+                },
+                {
+                    "value": ""
+                }
+            ]
+        },
+        "Rows": {
+            "Row": []
+
+        },
+        "type": "Section",
+        "group": "Expense",
+        "Summary": {
+            "ColData": []
+        }
+    }
+    expense_group['Rows']['Row'] = expense_rows
+    expense_group['Summary']['ColData'] = [
+        {"value": "Total Expenses"},
+        {"value": f"{total_expenses}"}
+    ]
+    print(f"DYNAMIC EXPENSE GROUP is {expense_group}")
+
+    net_operating_income_group = {
+        "type": "Section",
+        "group": "Net Operating Income",
+        "Summary": {
+            "ColData": []
+        }
+    }
+    net_operating_income_group['Summary']['ColData'] = [
+        {"value": "Net Operating Income"},
+        {"value": f"{net_operating_income}"}
+    ]
+    print(f"NET OPERATING INCOME GROUP is {net_operating_income_group}")
+
+    net_income_group = {
+        "type": "Section",
+        "group": "Net Income",
+        "Summary": {
+            "ColData": []
+        }
+    }
+    net_income_group['Summary']['ColData'] = [
+        {"value": "Net Income"},
+        {"value": f"{net_income}"}
+    ]
+    print(f"NET INCOME GROUP is {net_income_group}")
+
+    net_other_income_group = {
+        "type": "Section",
+        "group": "Net Other Income",
+        "Summary": {
+            "ColData": []
+        }
+    }
+    net_other_income_group['Summary']['ColData'] = [
+        {"value": "Net Other Income"},
+        {"value": f"{net_other_income}"}
+    ]
+    print(f"NET OTHER INCOME GROUP is {net_other_income_group}")
+
+    other_income_group = {
+        "Header": {
+            "ColData": [
+                {
+                    "value": "Other Income"
+                },
+                {
+                    "value": ""
+                }
+            ]
+        },
+        "Rows": {
+            "Row": []
+
+        },
+        "type": "Section",
+        "group": "Other Income",
+        "Summary": {
+            "ColData": []
+        }
+    }
+
+    other_income_group['Rows']['Row'] = other_income_rows
+    other_income_group['Summary']['ColData'] = [
+        {"value": "Total Other Income"},
+        {"value": f"{total_other_income}"}
+    ]
+    print(f"OTHER INCOME GROUP is {other_income_group}")
+
+    other_expenses_group = {
+        "Header": {
+            "ColData": [
+                {
+                    "value": "Other Expenses"
+                },
+                {
+                    "value": ""
+                }
+            ]
+        },
+        "Rows": {
+            "Row": []
+
+        },
+        "type": "Section",
+        "group": "Other Expenses",
+        "Summary": {
+            "ColData": []
+        }
+    }
+    other_expenses_group['Rows']['Row'] = other_expenses_rows
+    other_expenses_group['Summary']['ColData'] = [
+        {"value": "Total Other Expenses"},
+        {"value": f"{total_other_expenses}"}
+    ]
+    print(f"OTHER EXPENSE GROUP is {other_expenses_group}")
+
+    profit_and_loss = {
+        "Header": {
+            "ReportName": "ProfitAndLoss",
+            "Option": [
+                {
+                    "Name": "AccountingStandard",
+                    "Value": "GAAP"
+                },
+                {
+                    "Name": "NoReportData",
+                    "Value": "false"
+                }
+            ],
+            "ReportBasis": "Accrual",
+            "StartPeriod": f'{start_date}',
+            "Currency": base_currency,
+            "EndPeriod": f'{end_date}',
+            "Time": f'{datetime.now()}',
+            "SummarizeColumnsBy": "Total"
+        },
+        "Rows": {
+            "Row": [income_group, cogs_group, gross_profit_group, expense_group, net_operating_income_group,
+                    other_income_group, other_expenses_group, net_other_income_group, net_income_group]
+        },
+        "Columns": {
+            "Column": [
+                {
+                    "ColType": "Account",
+                    "ColTitle": "",
+                    "MetaData": [
+                        {
+                            "Name": "ColKey",
+                            "Value": "account"
+                        }
+                    ]
+                },
+                {
+                    "ColType": "Money",
+                    "ColTitle": "Total",
+                    "MetaData": [
+                        {
+                            "Name": "ColKey",
+                            "Value": "total"
+                        }
+                    ]
+                }
+            ]
+        }
+    }
+
+    report_timer.observe()
+    return profit_and_loss
+
+
+@app.get("/reports/profit_and_loss", tags=["Reports"])
+async def get_profit_and_loss(start_date: Optional[date] = None, end_date: Optional[date] = None,
+                              group_by: Optional[str] = None):
+    """
+        Profit and loss report, group_by names a line dimension (class, department, project) to get one column per
+        value, over capacity it answers 429 or 503 with Retry-After:
+
+    """
+    if group_by:
+        return await run_report('profit_and_loss', profit_and_loss_by_dimension, start_date=start_date,
+                                end_date=end_date, group_by=group_by)
+    return await run_report('profit_and_loss', profit_and_loss_report, start_date=start_date, end_date=end_date)
+
+
+def balance_sheet_report(start_date: Optional[date] = None, end_date: Optional[date] = None):
+    """
+        Build the balance sheet of the journal entries dated between start_date and end_date:
+
+    """
+
+    report_timer = StageTimer(report_stage_seconds, report='balance_sheet')
+    report_timer.switch('fetch')
+    result = journal_entries_between(start_date, end_date)
+    print(f"The result is {result}")
+    accounts_by_type = {'asset': {}, 'liability': {}, 'equity': {}, 'revenue': {}, 'expense': {}}
+    retained_earnings = 0
+    if result:
+        for row in result:
+            print(f"The row is {row['journal_lines']}")
+            report_timer.switch('decode')
+            journal_lines = load_json(row['journal_lines'])
+            report_timer.switch('aggregate')
+            for each in journal_lines:
+                print(f"each in journal_lines is {each}")
+
+                if str(each['account_type']).lower() in ["asset", "liability", "equity", "revenue", "expense"]:
+                    key = str(each['account_type']).lower()
+                    print(f"Key is {key}")
+                    try:
+                        accounts_by_type[f"{key}"][f"account_code_{each['account_code']}"].append(
+                            base_amount(each, row['date']))
+                    except KeyError:
+                        accounts_by_type[f"{key}"][f"account_code_{each['account_code']}"] = []
+                        accounts_by_type[f"{key}"][
+                            f"account_code_{each['account_code']}"].append(base_amount(each, row['date']))
+            report_timer.switch('fetch')
+
+    else:
+        raise HTTPException(status_code=404, detail="Journal Entry not found")
+
+    report_timer.switch('aggregate')
+    print(f"accounts by type are {accounts_by_type}")
+
+    for account in accounts_by_type['asset']:
+        print(f"account in ACCOUNTS BY TYPE is {account}")
+        accounts_by_type['asset'][f'{account}'] = sum(accounts_by_type['asset'][f'{account}'])
+
+    for account in accounts_by_type['liability']:
+        print(f"account in ACCOUNTS BY TYPE is {account}")
+        accounts_by_type['liability'][f'{account}'] = sum(accounts_by_type['liability'][f'{account}'])
+
+    for account in accounts_by_type['equity']:
+        print(f"account in ACCOUNTS BY TYPE is {account}")
+        accounts_by_type['equity'][f'{account}'] = sum(accounts_by_type['equity'][f'{account}'])
+
+    for account in accounts_by_type['revenue']:
+        print(f"account in ACCOUNTS BY TYPE is {account}")
+        accounts_by_type['revenue'][f'{account}'] = sum(accounts_by_type['revenue'][f'{account}'])
+        retained_earnings -= accounts_by_type['revenue'][f'{account}']
+
+    for account in accounts_by_type['expense']:
+        print(f"account in ACCOUNTS BY TYPE is {account}")
+        accounts_by_type['expense'][f'{account}'] = sum(accounts_by_type['expense'][f'{account}'])
+        retained_earnings -= accounts_by_type['expense'][f'{account}']
+
+    print(f"UPDATED accounts by type are {accounts_by_type}")
+    print(f"RETAINED_EARNINGS is {retained_earnings}")
+
+    report_timer.switch('render')
+    balance_sheet = {}
+    report_timer.observe()
+    return balance_sheet
+
+
+@app.get("/reports/balance_sheet", tags=["Reports"])
+async def get_balance_sheet(start_date: Optional[date] = None, end_date: Optional[date] = None):
+    """
+        Balance sheet report, over capacity it answers 429 or 503 with Retry-After:
+
+    """
+    return await run_report('balance_sheet', balance_sheet_report, start_date=start_date, end_date=end_date)
+
+
+# profit and loss sections: account type, title, group and the sign that shows credit balances as positive income
+profit_and_loss_sections = [
+    ('REVENUE', 'Income', 'Income', -1),
+    ('COGS', 'Cost of Goods Sold', 'COGS', 1),
+    ('EXPENSE', 'Expenses', 'Expense', 1),
+    ('OTHER_INCOME', 'Other Income', 'Other Income', -1),
+    ('OTHER_EXPENSES', 'Other Expenses', 'Other Expenses', 1),
+]
+
+
+def aggregate_journal_lines(start_date, end_date, account_types=None, group_by=None):
+    """
+        Sum the base amounts of journal lines per account, and per value of the group_by dimension, in SQL:
+
+    """
+    conditions = []
+    params = {}
+    if start_date:
+        conditions.append("l.date >= :start_date")
+        params['start_date'] = str(start_date)
+    if end_date:
+        conditions.append("l.date <= :end_date")
+        params['end_date'] = str(end_date)
+    if account_types:
+        # account types are stored as sent, match both spellings and keep the (account_type, date) index usable
+        spellings = sorted({spelling for account_type in account_types
+                            for spelling in (account_type.upper(), account_type.lower())})
+        params.update({f"account_type_{index}": spelling for index, spelling in enumerate(spellings)})
+        placeholders = ", ".join(f":account_type_{index}" for index in range(len(spellings)))
+        conditions.append(f"l.account_type IN ({placeholders})")
+    dimension_join = ""
+    dimension_value = "NULL"
+    if group_by:
+        dimension_join = ("LEFT JOIN journal_line_dimension d ON d.journal_entry_id = l.journal_entry_id "
+                          "AND d.line_number = l.line_number AND d.dimension = :dimension ")
+        dimension_value = "d.value"
+        params['dimension'] = group_by.strip().lower()
+    where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+    totals = {}
+    for schema in journal_sources(start_date, end_date):
+        rows = fetch_rows(f"SELECT UPPER(l.account_type), l.account_code, {dimension_value} AS dimension_value, "
+                          f"SUM(l.base_amount) FROM {schema}.journal_line l "
+                          f"{dimension_join.replace('journal_line_dimension', f'{schema}.journal_line_dimension')}"
+                          f"{where}GROUP BY UPPER(l.account_type), l.account_code, dimension_value", **params)
+        for account_type, account_code, value, amount in rows:
+            key = (account_type, account_code, value)
+            totals[key] = amount if totals.get(key) is None else totals[key] + (amount or 0)
+    return sorted(((*key, amount) for key, amount in totals.items()),
+                  key=lambda row: (row[1] is not None, str(row[1])))
+
+
+def dimension_values(rows):
+    """
+        Distinct dimension values of aggregated rows, untagged lines last:
+
+    """
+    values = sorted({row[2] for row in rows if row[2] is not None})
+    if any(row[2] is None for row in rows):
+        values.append(None)
+    return values
+
+
+def report_header(report_name, start_date, end_date, summarize_columns_by='Total'):
+    return {
+        "ReportName": report_name,
+        "Option": [
+            {"Name": "AccountingStandard", "Value": "GAAP"},
+            {"Name": "NoReportData", "Value": "false"}
+        ],
+        "ReportBasis": "Accrual",
+        "StartPeriod": f'{start_date}',
+        "Currency": base_currency,
+        "EndPeriod": f'{end_date}',
+        "Time": f'{datetime.now()}',
+        "SummarizeColumnsBy": summarize_columns_by
+    }
+
+
+def report_column(col_type, title, key):
+    return {"ColType": col_type, "ColTitle": title, "MetaData": [{"Name": "ColKey", "Value": key}]}
+
+
+def profit_and_loss_by_dimension(start_date: Optional[date] = None, end_date: Optional[date] = None,
+                                 group_by: str = None):
+    """
+        Build the profit and loss report with one money column per value of a line dimension and a total column:
+
+    """
+    report_timer = StageTimer(report_stage_seconds, report='profit_and_loss_by_dimension')
+    report_timer.switch('fetch')
+    rows = aggregate_journal_lines(start_date, end_date, [section[0] for section in profit_and_loss_sections],
+                                   group_by)
+    report_timer.switch('render')
+    values = dimension_values(rows)
+    column_of_value = {value: index for index, value in enumerate(values)}
+    balances = {}
+    for account_type, account_code, value, amount in rows:
+        account_balances = balances.setdefault(account_type, {}).setdefault(account_code, [0.0] * len(values))
+        account_balances[column_of_value[value]] += amount or 0
+
+    def money(amounts):
+        return [{"value": f"{round(amount, 2)}"} for amount in amounts] + [{"value": f"{round(sum(amounts), 2)}"}]
+
+    def summary(group, title, amounts):
+        return {"type": "Section", "group": group, "Summary": {"ColData": [{"value": title}] + money(amounts)}}
+
+    totals = {}
+    sections = {}
+    for account_type, title, group, sign in profit_and_loss_sections:
+        data_rows = []
+        section_total = [0.0] * len(values)
+        for account_code, amounts in balances.get(account_type, {}).items():
+            amounts = [sign * amount for amount in amounts]
+            section_total = [total + amount for total, amount in zip(section_total, amounts)]
+            data_rows.append({"ColData": [{"id": account_code, "value": f"Account_code_{account_code}"}] +
+                              money(amounts), "type": "Data"})
+        totals[account_type] = section_total
+        sections[account_type] = {
+            "Header": {"ColData": [{"value": title}] + [{"value": ""}] * (len(values) + 1)},
+            "Rows": {"Row": data_rows},
+            "type": "Section",
+            "group": group,
+            "Summary": {"ColData": [{"value": f"Total {title}"}] + money(section_total)}
+        }
+
+    def combine(first, second, sign=-1):
+        return [a + sign * b for a, b in zip(totals[first], totals[second])]
+
+    gross_profit = combine('REVENUE', 'COGS')
+    net_operating_income = [a - b for a, b in zip(gross_profit, totals['EXPENSE'])]
+    net_other_income = combine('OTHER_INCOME', 'OTHER_EXPENSES')
+    net_income = [a + b for a, b in zip(net_operating_income, net_other_income)]
+    profit_and_loss = {
+        "Header": report_header("ProfitAndLoss", start_date, end_date, group_by),
+        "Rows": {
+            "Row": [
+                sections['REVENUE'],
+                sections['COGS'],
+                summary("Gross Profit", "Gross Profit", gross_profit),
+                sections['EXPENSE'],
+                summary("Net Operating Income", "Net Operating Income", net_operating_income),
+                sections['OTHER_INCOME'],
+                sections['OTHER_EXPENSES'],
+                summary("Net Other Income", "Net Other Income", net_other_income),
+                summary("Net Income", "Net Income", net_income),
+            ]
+        },
+        "Columns": {
+            "Column": [report_column("Account", "", "account")] +
+                      [report_column("Money", title, f"{group_by}:{title}")
+                       for title in (value if value is not None else "Not Specified" for value in values)] +
+                      [report_column("Money", "Total", "total")]
+        }
+    }
+    report_timer.observe()
+    return profit_and_loss
+
+
+def trial_balance_report(start_date: Optional[date] = None, end_date: Optional[date] = None,
+                         group_by: Optional[str] = None):
+    """
+        Build the trial balance of every account, with one section per value of the group_by line dimension:
+
+    """
+    report_timer = StageTimer(report_stage_seconds, report='trial_balance')
+    report_timer.switch('fetch')
+    rows = aggregate_journal_lines(start_date, end_date, group_by=group_by)
+    report_timer.switch('render')
+
+    def balance_row(account_type, account_code, amount):
+        debit, credit = (amount, 0.0) if amount >= 0 else (0.0, -amount)
+        return {"ColData": [{"id": account_code, "value": f"Account_code_{account_code}"},
+                            {"value": f"{round(debit, 2)}"}, {"value": f"{round(credit, 2)}"}],
+                "type": "Data", "account_type": account_type}
+
+    def total_row(title, data_rows):
+        debit = sum(float(row["ColData"][1]["value"]) for row in data_rows)
+        credit = sum(float(row["ColData"][2]["value"]) for row in data_rows)
+        return {"ColData": [{"value": title}, {"value": f"{round(debit, 2)}"}, {"value": f"{round(credit, 2)}"}]}
+
+    all_rows = [balance_row(account_type, account_code, amount or 0)
+                for account_type, account_code, value, amount in rows]
+    if group_by:
+        report_rows = []
+        for value in dimension_values(rows):
+            data_rows = [data_row for data_row, row in zip(all_rows, rows) if row[2] == value]
+            title = value if value is not None else "Not Specified"
+            report_rows.append({"Header": {"ColData": [{"value": title}, {"value": ""}, {"value": ""}]},
+                                "Rows": {"Row": data_rows}, "type": "Section", "group": f"{group_by}:{title}",
+                                "Summary": total_row(f"Total {title}", data_rows)})
+    else:
+        report_rows = all_rows
+    report_rows.append({"type": "Section", "group": "GrandTotal", "Summary": total_row("TOTAL", all_rows)})
+    trial_balance = {
+        "Header": report_header("TrialBalance", start_date, end_date, group_by or "Total"),
+        "Rows": {"Row": report_rows},
+        "Columns": {
+            "Column": [report_column("Account", "", "account"), report_column("Money", "Debit", "debit"),
+                       report_column("Money", "Credit", "credit")]
+        }
+    }
+    report_timer.observe()
+    return trial_balance
+
+
+@app.get("/reports/trial_balance", tags=["Reports"])
+async def get_trial_balance(start_date: Optional[date] = None, end_date: Optional[date] = None,
+                            group_by: Optional[str] = None):
+    """
+        Trial balance report, group_by names a line dimension (class, department, project) to get one section per
+        value, over capacity it answers 429 or 503 with Retry-After:
+
+    """
+    return await run_report('trial_balance', trial_balance_report, start_date=start_date, end_date=end_date,
+                            group_by=group_by)
+
+
+# background jobs: heavy reports run on a bounded worker pool, results are written to disk
+job_results_path = os.environ.get('JOB_RESULTS_PATH', 'job_results')
+job_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('JOB_WORKERS', '2')),
+                                  thread_name_prefix='job-worker')
+job_runners = {
+    'profit_and_loss': lambda parameters: profit_and_loss_report(**parameters),
+    'balance_sheet': lambda parameters: balance_sheet_report(**parameters),
+}
+# (tenant, job id) of the jobs waiting in or running on the worker pool, a reopened tenant must not queue them again
+submitted_jobs = set()
+submitted_jobs_lock = threading.Lock()
+
+
+def ensure_jobs():
+    """
+        Create the job table used to persist queued and finished jobs:
+
+    """
+    job_columns = {
+        'job_type': db.types.string,
+        'parameters': db.types.text,
+        'status': db.types.string,
+        'submitted_time': db.types.string,
+        'started_time': db.types.string,
+        'finished_time': db.types.string,
+        'result_path': db.types.string,
+        'error': db.types.text,
+    }
+    for column, column_type in job_columns.items():
+        job_table.create_column(column, column_type)
+    job_table.create_index(['status'])
+
+
+on_database_open(ensure_jobs)
+
+
+def run_job(job_id, tenant=None):
+    """
+        Run a queued job on a worker thread and persist its result file and final status:
+
+    """
+    try:
+        with tenant_databases.use(tenant):
+            run_tenant_job(job_id, tenant)
+    finally:
+        with submitted_jobs_lock:
+            submitted_jobs.discard((tenant, job_id))
+
+
+def run_tenant_job(job_id, tenant):
+    # claim the job with one conditional UPDATE, a second worker or process finds it no longer QUEUED
+    sqlalchemy_table = job_table.table
+    statement = sqlalchemy_table.update().where(sqlalchemy_table.c.id == job_id) \
+        .where(sqlalchemy_table.c.status == JobStatus.QUEUED.value) \
+        .values(status=JobStatus.RUNNING.value, started_time=datetime.now(timezone.utc).isoformat())
+    with db:
+        claimed = db.executable.execute(statement).rowcount
+    if claimed != 1:
+        return
+    job = job_table.find_one(id=job_id)
+    try:
+        result = job_runners[job['job_type']](json.loads(job['parameters']))
+        tenant_job_results_path = os.path.join(job_results_path, tenant) if tenant else job_results_path
+        os.makedirs(tenant_job_results_path, exist_ok=True)
+        result_path = os.path.join(tenant_job_results_path, f"{job_id}.json")
+        with open(f"{result_path}.tmp", 'w') as result_file:
+            json.dump(result, result_file, default=str)
+        os.replace(f"{result_path}.tmp", result_path)
+        job_table.update({'id': job_id, 'status': JobStatus.SUCCEEDED.value, 'result_path': result_path,
+                          'finished_time': datetime.now(timezone.utc).isoformat()}, ['id'])
+    except Exception as error:
+        detail = error.detail if isinstance(error, HTTPException) else repr(error)
+        print(f"job {job_id} failed: {detail}")
+        job_table.update({'id': job_id, 'status': JobStatus.FAILED.value, 'error': str(detail),
+                          'finished_time': datetime.now(timezone.utc).isoformat()}, ['id'])
+
+
+def submit_job(job_type, parameters):
+    """
+        Persist a job and hand it to the worker pool:
+
+    """
+    job_dict = {
+        'job_type': job_type,
+        'parameters': json.dumps(parameters, default=str),
+        'status': JobStatus.QUEUED.value,
+        'submitted_time': datetime.now(timezone.utc).isoformat(),
+    }
+    job_dict['id'] = job_table.insert(job_dict)
+    queue_job(job_dict['id'])
+    return job_dict
+
+
+def queue_job(job_id, requeue=False):
+    """
+        Hand a job of the current tenant to the worker pool unless it is already waiting or running there, requeue
+        first sets an interrupted job back to QUEUED:
+
+    """
+    tenant = current_tenant.get()
+    with submitted_jobs_lock:
+        if (tenant, job_id) in submitted_jobs:
+            return False
+        submitted_jobs.add((tenant, job_id))
+    try:
+        if requeue:
+            print(f"resuming job {job_id}")
+            job_table.update({'id': job_id, 'status': JobStatus.QUEUED.value, 'started_time': None}, ['id'])
+        job_executor.submit(run_job, job_id, tenant)
+    except Exception:
+        with submitted_jobs_lock:
+            submitted_jobs.discard((tenant, job_id))
+        raise
+    return True
+
+
+@app.on_event("startup")
+def resume_jobs():
+    """
+        Requeue the jobs that were queued or interrupted mid-run when the process last stopped:
+
+    """
+    for job in job_table.find(status=[JobStatus.QUEUED.value, JobStatus.RUNNING.value], order_by='id'):
+        queue_job(job['id'], requeue=True)
+
+
+# tenant databases requeue their own interrupted jobs when they are first opened
+database_open_functions.append(resume_jobs)
+
+
+@app.on_event("shutdown")
+def stop_jobs():
+    # queued jobs keep their QUEUED status and are picked up again by resume_jobs on the next start
+    job_executor.shutdown(wait=False, cancel_futures=True)
+
+
+@app.post("/jobs/reports/profit_and_loss", response_model=JobResponse, status_code=202, tags=["Jobs"])
+async def submit_profit_and_loss_job(start_date: Optional[date] = None, end_date: Optional[date] = None):
+    """
+        Queue a profit and loss report to run in the background:
+
+    """
+    return submit_job('profit_and_loss', {'start_date': start_date, 'end_date': end_date})
+
+
+@app.post("/jobs/reports/balance_sheet", response_model=JobResponse, status_code=202, tags=["Jobs"])
+async def submit_balance_sheet_job(start_date: Optional[date] = None, end_date: Optional[date] = None):
+    """
+        Queue a balance sheet report to run in the background:
+
+    """
+    return submit_job('balance_sheet', {'start_date': start_date, 'end_date': end_date})
+
+
+@app.get("/jobs/", response_model=List[JobResponse], tags=["Jobs"])
+async def list_jobs(status: Optional[JobStatus] = None, skip: int = 0, limit: int = 10):
+    """
+        List background jobs, newest first:
+
+    """
+    filters = {'status': status.value} if status else {}
+    return list(job_table.find(order_by='-id', _offset=skip, _limit=limit, **filters))
+
+
+@app.get("/jobs/{job_id}", response_model=JobResponse, tags=["Jobs"])
+async def read_job(job_id: int):
+    """
+        Poll the status of a background job:
+
+    """
+    job = job_table.find_one(id=job_id)
+    if job:
+        return job
+    else:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+
+@app.get("/jobs/{job_id}/result", tags=["Jobs"])
+async def read_job_result(job_id: int):
+    """
+        Download the result of a finished background job:
+
+    """
+    job = job_table.find_one(id=job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job['status'] == JobStatus.FAILED.value:
+        raise HTTPException(status_code=409, detail=f"Job failed: {job['error']}")
+    if job['status'] != JobStatus.SUCCEEDED.value:
+        raise HTTPException(status_code=409, detail=f"Job is {job['status']}")
+    if not os.path.exists(job['result_path']):
+        raise HTTPException(status_code=410, detail="Job result is no longer available")
+    return FileResponse(job['result_path'], media_type='application/json', filename=f"job_{job_id}.json")
+
+
+# columnar exports: column name and pyarrow type factory for each exported table
+export_datasets = {
+    'journal_entry': [
+        ('id', 'int64'), ('date', 'string'), ('description', 'string'), ('posted', 'bool_'),
+        ('journal_type', 'string'), ('last_updated_time', 'string'),
+    ],
+    'journal_line': [
+        ('id', 'int64'), ('journal_entry_id', 'int64'), ('line_number', 'int64'), ('date', 'string'),
+        ('account_code', 'string'), ('account_type', 'string'), ('amount', 'float64'), ('posting_type', 'string'),
+        ('reconciled', 'bool_'), ('last_updated_time', 'string'),
+    ],
+    'account': [
+        ('id', 'int64'), ('display_name', 'string'), ('account_code', 'string'), ('account_type', 'string'),
+        ('description', 'string'), ('tax_type', 'string'), ('inactive', 'bool_'), ('last_updated_time', 'string'),
+    ],
+}
+
+
+def ensure_export_columns():
+    """
+        Make sure every exported column exists so exports of empty or older tables still have a stable schema:
+
+    """
+    column_types = {'int64': db.types.bigint, 'string': db.types.text, 'float64': db.types.float,
+                    'bool_': db.types.boolean}
+    for table_name, columns in export_datasets.items():
+        for column, type_name in columns:
+            if column != 'id':
+                db[table_name].create_column(column, column_types[type_name])
+
+
+on_database_open(ensure_export_columns)
+
+
+class ExportSink:
+    """
+        Write-only file object that collects what the arrow writers produce so it can be streamed out in pieces:
+
+    """
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def export_until_id(table_name):
+    return fetch_rows(f"SELECT MAX(id) FROM {table_name}")[0][0] or 0
+
+
+def iter_export(table_name, file_format=ExportFormat.PARQUET, since_id=0, since=None, chunk_size=10000,
+                until_id=None):
+    """
+        Yield a Parquet or Arrow IPC stream of a table, reading and encoding chunk_size rows at a time:
+
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise HTTPException(status_code=501, detail="Columnar export requires pyarrow to be installed")
+
+    columns = export_datasets[table_name]
+    schema = pyarrow.schema([(column, getattr(pyarrow, type_name)()) for column, type_name in columns])
+    statement = f"SELECT {', '.join(column for column, type_name in columns)} FROM {table_name} WHERE id > :after_id"
+    if until_id is not None:
+        statement += " AND id <= :until_id"
+    if since:
+        statement += " AND last_updated_time >= :since"
+    statement += " ORDER BY id LIMIT :chunk_size"
+
+    sink = ExportSink()
+    if file_format == ExportFormat.PARQUET:
+        writer = pyarrow.parquet.ParquetWriter(sink, schema, compression='snappy')
+    else:
+        writer = pyarrow.ipc.new_stream(sink, schema)
+
+    after_id = since_id or 0
+    while True:
+        # keyset pagination on id keeps each round trip an index range scan and memory bounded by chunk_size
+        rows = fetch_rows(statement, after_id=after_id, until_id=until_id, since=since, chunk_size=chunk_size)
+        if not rows:
+            break
+        arrays = []
+        for (column, type_name), values in zip(columns, zip(*rows)):
+            if type_name == 'bool_':
+                values = [None if value is None else bool(value) for value in values]
+            arrays.append(pyarrow.array(values, type=schema.field(column).type))
+        writer.write_batch(pyarrow.record_batch(arrays, schema=schema))
+        after_id = rows[-1][0]
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def export_since_timestamp(since):
+    if since is None:
+        return None
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    return since.astimezone(timezone.utc).isoformat()
+
+
+@app.get("/export/{table_name}", tags=["Export"])
+def export_table(table_name: str,
+                 file_format: ExportFormat = ExportFormat.PARQUET,
+                 since_id: int = 0,
+                 since: Optional[datetime] = None,
+                 chunk_size: int = Query(10000, ge=100, le=100000)):
+    """
+        Stream journal entries, journal lines or accounts as Parquet or Arrow IPC, optionally only rows
+        after since_id or changed since a timestamp. X-Export-Until-Id is the since_id for the next sync:
+
+    """
+    if table_name not in export_datasets:
+        raise HTTPException(status_code=404, detail=f"Cannot export {table_name}, choose one of {list(export_datasets)}")
+    until_id = export_until_id(table_name)
+    chunks = iter_export(table_name, file_format, since_id, export_since_timestamp(since), chunk_size, until_id)
+    # pull the first chunk here so a missing pyarrow is reported as an error response, not a broken stream
+    first_chunk = next(chunks)
+    extension = 'parquet' if file_format == ExportFormat.PARQUET else 'arrows'
+    media_type = 'application/vnd.apache.parquet' if file_format == ExportFormat.PARQUET \
+        else 'application/vnd.apache.arrow.stream'
+
+    # route_tenant releases its hold once the response starts, keep the tenant database open until the body is sent
+    tenant = current_tenant.get()
+    tenant_databases.entry(tenant, acquire=True)
+
+    def stream():
+        try:
+            yield first_chunk
+            yield from chunks
+        finally:
+            tenant_databases.release(tenant)
+
+    return StreamingResponse(stream(), media_type=media_type,
+                             headers={'Content-Disposition': f'attachment; filename="{table_name}.{extension}"',
+                                      'X-Export-Until-Id': str(until_id)})
+
+
+def export_command(arguments):
+    """
+        Command line export, e.g. `python main.py export journal_line --output lines.parquet --since-id 1200`:
+
+    """
+    parser = argparse.ArgumentParser(prog='main.py export', description='Export ledger tables as Parquet or Arrow IPC')
+    parser.add_argument('table_name', choices=list(export_datasets))
+    parser.add_argument('--format', dest='file_format', type=str.upper, default='PARQUET',
+                        choices=[export_format.value for export_format in ExportFormat])
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--since-id', type=int, default=0)
+    parser.add_argument('--since', type=datetime.fromisoformat, default=None)
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    parser.add_argument('--tenant', default=None)
+    options = parser.parse_args(arguments)
+
+    with tenant_databases.use(options.tenant):
+        until_id = export_until_id(options.table_name)
+        with open(options.output, 'wb') as output_file:
+            for chunk in iter_export(options.table_name, ExportFormat(options.file_format), options.since_id,
+                                     export_since_timestamp(options.since), options.chunk_size, until_id):
+                output_file.write(chunk)
+    print(f"exported {options.table_name} to {options.output}, next --since-id is {until_id}")
+
+
+# inventory: perpetual costing with FIFO cost layers or a running weighted average per item
+def ensure_inventory():
+    """
+        Create the item, stock movement and cost layer tables:
+
+    """
+    item_columns = {
+        'display_name': db.types.text,
+        'item_code': db.types.string,
+        'description': db.types.text,
+        'costing_method': db.types.string,
+        'inventory_account_code': db.types.string,
+        'cogs_account_code': db.types.string,
+        'inactive': db.types.boolean,
+        'quantity_on_hand': db.types.float,
+        'inventory_value': db.types.float,
+    }
+    for column, column_type in item_columns.items():
+        item_table.create_column(column, column_type)
+    item_table.create_index(['item_code'])
+
+    stock_movement_columns = {
+        'item_id': db.types.integer,
+        'date': db.types.string,
+        'movement_type': db.types.string,
+        'quantity': db.types.float,
+        'unit_cost': db.types.float,
+        'total_cost': db.types.float,
+        'journal_entry_id': db.types.integer,
+        'description': db.types.text,
+    }
+    for column, column_type in stock_movement_columns.items():
+        stock_movement_table.create_column(column, column_type)
+    stock_movement_table.create_index(['item_id', 'date'])
+
+    cost_layer_columns = {
+        'item_id': db.types.integer,
+        'date': db.types.string,
+        'quantity': db.types.float,
+        'remaining_quantity': db.types.float,
+        'unit_cost': db.types.float,
+    }
+    for column, column_type in cost_layer_columns.items():
+        cost_layer_table.create_column(column, column_type)
+    with db:
+        # partial index: only open layers are indexed, so the queue head of an item is one seek away
+        db.query("CREATE INDEX IF NOT EXISTS ix_cost_layer_open ON cost_layer (item_id, id) "
+                 "WHERE remaining_quantity > 0")
+
+
+on_database_open(ensure_inventory)
+
+stock_quantity_tolerance = 1e-9
+
+
+def consume_cost_layers(item_id, quantity):
+    """
+        Take quantity off the oldest open cost layers, touching only the layers consumed:
+
+    """
+    open_layers = db.executable.execute(
+        text("SELECT id, remaining_quantity, unit_cost FROM cost_layer "
+             "WHERE item_id = :item_id AND remaining_quantity > 0 ORDER BY id"),
+        {'item_id': item_id})
+    remaining = quantity
+    total_cost = 0.0
+    consumed_layers = []
+    for layer_id, remaining_quantity, unit_cost in open_layers:
+        taken = min(remaining_quantity, remaining)
+        total_cost += taken * unit_cost
+        remaining -= taken
+        left = remaining_quantity - taken
+        consumed_layers.append((0.0 if left <= stock_quantity_tolerance else left, layer_id))
+        if remaining <= stock_quantity_tolerance:
+            break
+    open_layers.close()
+    execute_many("UPDATE cost_layer SET remaining_quantity = ? WHERE id = ?", consumed_layers)
+    return total_cost
+
+
+@app.post("/item/", tags=["Item"])
+async def create_item(item: Item):
+    """
+        Create an inventory item using required information:
+
+    """
+    item_dict = item.dict()
+    item_dict['quantity_on_hand'] = 0.0
+    item_dict['inventory_value'] = 0.0
+
+    db_insert = item_table.insert(item_dict)
+    print(f"db_insert is {db_insert}")
+    item_dict['id'] = db_insert
+    return item_dict
+
+
+@app.get("/item/query", tags=["Item"])
+async def query_item(query: Optional[str] = None, skip: int = 0, limit: int = 10):
+    """
+        Query an inventory item using a sql statement:
+
+    """
+    if query:
+        final_results = []
+        print(f"The query is {query}")
+        # result = db.query('select * from item')
+        result = db.query(query)
+        if result:
+            for row in result:
+                print(f"The row is {row}")
+                final_results.append(row)
+            print(f"final results are {final_results}")
+            return final_results[skip: skip + limit]
+        else:
+            raise HTTPException(status_code=404, detail="Item not found")
+
+
+@app.get("/item/{item_id}", tags=["Item"])
+async def read_item(item_id: int):
+    """
+        Read an inventory item using item_id:
+
+    """
+    item = item_table.find_one(id=item_id)
+    if item:
+        quantity_on_hand = item['quantity_on_hand'] or 0.0
+        item['average_cost'] = item['inventory_value'] / quantity_on_hand if quantity_on_hand else 0.0
+        return item
+    else:
+        raise HTTPException(status_code=404, detail="Item not found")
+
+
+@app.put("/item/{item_id}", tags=["Item"])
+async def update_item(item_id: int, item: UpdateItem):
+    """
+        Update an inventory item with new information:
+
+    """
+    item_to_update = item_table.find_one(id=item_id)
+    if item_to_update:
+        print(f"the item to update is: {item_to_update}")
+        item_dict = item.dict(exclude_unset=True)
+        item_dict['id'] = item_id
+        item_table.update(item_dict, ['id'])
+        return item_dict
+    else:
+        raise HTTPException(status_code=404, detail="Item not found")
+
+
+@app.delete("/item/{item_id}", tags=["Item"])
+async def delete_item(item_id: int):
+    """
+        Delete an inventory item that has no stock on hand:
+
+    """
+    item_to_delete = item_table.find_one(id=item_id)
+    if item_to_delete:
+        if (item_to_delete['quantity_on_hand'] or 0) > stock_quantity_tolerance:
+            raise HTTPException(status_code=409, detail="Cannot delete an Item with stock on hand")
+        print(f"the item to delete is: {item_to_delete}")
+        with db:
+            item_table.delete(id=item_id)
+            cost_layer_table.delete(item_id=item_id)
+        return {"message": f"Item with id {item_id} has been deleted"}
+    else:
+        raise HTTPException(status_code=404, detail="Item not found")
+
+
+@app.post("/item/{item_id}/receipt", tags=["Item"])
+async def receive_stock(item_id: int, stock_receipt: StockReceipt):
+    """
+        Receive stock into inventory, adding a cost layer and posting Inventory against the offset account:
+
+    """
+    item = item_table.find_one(id=item_id)
+    if not item:
+        raise HTTPException(status_code=404, detail="Item not found")
+    if stock_receipt.quantity <= 0 or stock_receipt.unit_cost < 0:
+        raise HTTPException(status_code=400, detail="Receipts need a positive quantity and a non-negative unit_cost")
+
+    receipt_date = stock_receipt.date or datetime.now(timezone.utc).astimezone().strftime('%Y-%m-%d')
+    total_cost = round(stock_receipt.quantity * stock_receipt.unit_cost, 2)
+    with db:
+        journal_entry_id = None
+        if stock_receipt.offset_account_code and total_cost:
+            journal_entry_id = insert_journal_entry({
+                'date': receipt_date,
+                'description': stock_receipt.description or f"Stock receipt of {item['item_code']}",
+                'posted': True,
+                'journal_type': JournalType.PURCHASE.value,
+                'validate_journal_type': False,
+                'journal_lines': [
+                    {'account_code': item['inventory_account_code'], 'account_type': AccountType.INVENTORY.value,
+                     'amount': total_cost, 'posting_type': 'Debit'},
+                    {'account_code': stock_receipt.offset_account_code,
+                     'account_type': stock_receipt.offset_account_type.value,
+                     'amount': -total_cost, 'posting_type': 'Credit'},
+                ],
+            })
+        if item['costing_method'] == CostingMethod.FIFO.value:
+            cost_layer_table.insert({'item_id': item_id, 'date': receipt_date, 'quantity': stock_receipt.quantity,
+                                     'remaining_quantity': stock_receipt.quantity,
+                                     'unit_cost': stock_receipt.unit_cost})
+        movement = {
+            'item_id': item_id,
+            'date': receipt_date,
+            'movement_type': StockMovementType.RECEIPT.value,
+            'quantity': stock_receipt.quantity,
+            'unit_cost': stock_receipt.unit_cost,
+            'total_cost': total_cost,
+            'journal_entry_id': journal_entry_id,
+            'description': stock_receipt.description,
+        }
+        movement['id'] = stock_movement_table.insert(movement)
+        item_table.update({'id': item_id,
+                           'quantity_on_hand': (item['quantity_on_hand'] or 0.0) + stock_receipt.quantity,
+                           'inventory_value': (item['inventory_value'] or 0.0) + total_cost}, ['id'])
+    return movement
+
+
+@app.post("/item/{item_id}/sale", tags=["Item"])
+async def sell_stock(item_id: int, stock_sale: StockSale):
+    """
+        Sell stock, costing it by FIFO layers or weighted average and posting COGS against Inventory:
+
+    """
+    item = item_table.find_one(id=item_id)
+    if not item:
+        raise HTTPException(status_code=404, detail="Item not found")
+    if stock_sale.quantity <= 0:
+        raise HTTPException(status_code=400, detail="Sales need a positive quantity")
+    quantity_on_hand = item['quantity_on_hand'] or 0.0
+    if stock_sale.quantity > quantity_on_hand + stock_quantity_tolerance:
+        raise HTTPException(status_code=409, detail=f"Only {quantity_on_hand} of {item['item_code']} on hand")
+
+    sale_date = stock_sale.date or datetime.now(timezone.utc).astimezone().strftime('%Y-%m-%d')
+    with db:
+        if item['costing_method'] == CostingMethod.FIFO.value:
+            cost = consume_cost_layers(item_id, stock_sale.quantity)
+        else:
+            cost = stock_sale.quantity * item['inventory_value'] / quantity_on_hand
+        remaining_quantity = quantity_on_hand - stock_sale.quantity
+        if remaining_quantity <= stock_quantity_tolerance:
+            # selling out clears the rounding left in the running value
+            cost = item['inventory_value']
+            remaining_quantity = 0.0
+        total_cost = round(cost, 2)
+
+        journal_lines = [
+            {'account_code': item['cogs_account_code'], 'account_type': AccountType.COGS.value,
+             'amount': total_cost, 'posting_type': 'Debit'},
+            {'account_code': item['inventory_account_code'], 'account_type': AccountType.INVENTORY.value,
+             'amount': -total_cost, 'posting_type': 'Credit'},
+        ]
+        if stock_sale.unit_price and stock_sale.revenue_account_code and stock_sale.receivable_account_code:
+            sale_amount = round(stock_sale.quantity * stock_sale.unit_price, 2)
+            journal_lines += [
+                {'account_code': stock_sale.receivable_account_code,
+                 'account_type': stock_sale.receivable_account_type.value,
+                 'amount': sale_amount, 'posting_type': 'Debit'},
+                {'account_code': stock_sale.revenue_account_code, 'account_type': AccountType.REVENUE.value,
+                 'amount': -sale_amount, 'posting_type': 'Credit'},
+            ]
+        journal_entry_id = insert_journal_entry({
+            'date': sale_date,
+            'description': stock_sale.description or f"Stock sale of {item['item_code']}",
+            'posted': True,
+            'journal_type': JournalType.SALES.value,
+            'validate_journal_type': False,
+            'journal_lines': journal_lines,
+        })
+        movement = {
+            'item_id': item_id,
+            'date': sale_date,
+            'movement_type': StockMovementType.SALE.value,
+            'quantity': -stock_sale.quantity,
+            'unit_cost': cost / stock_sale.quantity,
+            'total_cost': -total_cost,
+            'journal_entry_id': journal_entry_id,
+            'description': stock_sale.description,
+        }
+        movement['id'] = stock_movement_table.insert(movement)
+        item_table.update({'id': item_id, 'quantity_on_hand': remaining_quantity,
+                           'inventory_value': round((item['inventory_value'] or 0.0) - total_cost, 2)
+                           if remaining_quantity else 0.0}, ['id'])
+    return movement
+
+
+@app.get("/item/{item_id}/movements", tags=["Item"])
+async def read_stock_movements(item_id: int, skip: int = 0, limit: int = 100):
+    """
+        Read the stock movements of an inventory item, newest first:
+
+    """
+    return list(stock_movement_table.find(item_id=item_id, order_by=['-date', '-id'], _offset=skip, _limit=limit))
+
+
+@app.get("/item/{item_id}/cost_layers", tags=["Item"])
+async def read_cost_layers(item_id: int):
+    """
+        Read the open FIFO cost layers of an inventory item, oldest first:
+
+    """
+    return list(cost_layer_table.find(item_id=item_id, remaining_quantity={'>': 0}, order_by='id'))
+
+
+# quote -> sales order -> sales invoice and purchase order -> purchase invoice, converted in bulk
+document_statuses = {
+    'quote': QuoteStatus,
+    'sales_order': OrderStatus,
+    'purchase_order': OrderStatus,
+}
+# statuses only a conversion sets, together with the downstream document and journal entry it writes
+conversion_statuses = (QuoteStatus.CONVERTED.value, OrderStatus.INVOICED.value)
+
+
+def ensure_documents():
+    """
+        Create the quote, order and invoice tables with the indexes the bulk conversions use:
+
+    """
+    document_columns = {
+        'contact_id': db.types.integer,
+        'date': db.types.string,
+        'description': db.types.text,
+        'lines': db.types.text,
+        'total': db.types.float,
+        'status': db.types.string,
+        'last_updated_time': db.types.string,
+    }
+    source_columns = {
+        'quote': [],
+        'sales_order': ['quote_id'],
+        'purchase_order': [],
+        'sales_invoice': ['sales_order_id', 'journal_entry_id'],
+        'purchase_invoice': ['purchase_order_id', 'journal_entry_id'],
+    }
+    for table_name, source_column_names in source_columns.items():
+        table = db[table_name]
+        for column, column_type in document_columns.items():
+            table.create_column(column, column_type)
+        for column in source_column_names:
+            table.create_column(column, db.types.integer)
+            table.create_index([column])
+        table.create_index(['status', 'date'])
+    for table_name in ['sales_invoice', 'purchase_invoice']:
+        db[table_name].create_column('due_date', db.types.string)
+        db[table_name].create_column('balance_due', db.types.float)
+        db[table_name].create_column('account_code', db.types.string)
+        db[table_name].create_index(['contact_id', 'status', 'date'])
+
+
+on_database_open(ensure_documents)
+
+
+def document_total(lines):
+    return round(sum(round(line['quantity'] * line['unit_price'], 2) for line in lines), 2)
+
+
+def decode_document(document):
+    if document and document.get('lines'):
+        document['lines'] = load_json(document['lines'])
+    return document
+
+
+def create_document(table, document, status):
+    document_dict = document.dict()
+    lines = document_dict['lines']
+    if not lines:
+        raise HTTPException(status_code=400, detail="Cannot Record A Document Without Lines")
+    if not contact_table.find_one(id=document_dict['contact_id']):
+        raise HTTPException(status_code=404, detail="Contact not found")
+    document_dict['date'] = document_dict['date'] or datetime.now(timezone.utc).astimezone().strftime('%Y-%m-%d')
+    parse_iso_date(document_dict['date'], 'date')
+    document_dict['total'] = document_total(lines)
+    document_dict['status'] = status
+    document_dict['last_updated_time'] = datetime.now(timezone.utc).isoformat()
+    json_document_dict = dict(document_dict, lines=dump_json(lines))
+    document_dict['id'] = table.insert(json_document_dict)
+    return document_dict
+
+
+def update_document(table, table_name, document_id, document):
+    document_to_update = table.find_one(id=document_id)
+    if not document_to_update:
+        raise HTTPException(status_code=404, detail=f"{table_name} not found")
+    statuses = document_statuses[table_name]
+    if document_to_update['status'] in conversion_statuses:
+        raise HTTPException(status_code=409, detail=f"Cannot update a {document_to_update['status']} {table_name}")
+    document_dict = document.dict(exclude_unset=True)
+    if 'status' in document_dict and document_dict['status'] not in statuses.__members__:
+        raise HTTPException(status_code=400, detail=f"status must be one of {list(statuses.__members__)}")
+    if document_dict.get('status') in conversion_statuses:
+        raise HTTPException(status_code=409, detail=f"Only converting a {table_name} sets it {document_dict['status']}")
+    if document_dict.get('date') is not None:
+        parse_iso_date(document_dict['date'], 'date')
+    if document_dict.get('lines') is not None:
+        document_dict['total'] = document_total(document_dict['lines'])
+        document_dict['lines'] = dump_json(document_dict['lines'])
+    document_dict['id'] = document_id
+    document_dict['last_updated_time'] = datetime.now(timezone.utc).isoformat()
+    table.update(document_dict, ['id'])
+    return decode_document(table.find_one(id=document_id))
+
+
+def find_convertible_documents(table, status, ids):
+    """
+        Load every document to convert with one query, all documents in status or just the given ids:
+
+    """
+    if ids is None:
+        return list(table.find(status=status, order_by='id'))
+    documents = list(table.find(id=ids, order_by='id'))
+    not_convertible = sorted(set(ids) - {document['id'] for document in documents if document['status'] == status})
+    if not_convertible:
+        raise HTTPException(status_code=409, detail=f"Documents {not_convertible} are missing or not {status}")
+    return documents
+
+
+def convert_quotes(quote_ids, conversion):
+    """
+        Turn accepted quotes into open sales orders in a single transaction:
+
+    """
+    quotes = find_convertible_documents(quote_table, QuoteStatus.ACCEPTED.value, quote_ids)
+    if not quotes:
+        return []
+    order_date = conversion.date or datetime.now(timezone.utc).astimezone().strftime('%Y-%m-%d')
+    parse_iso_date(order_date, 'date')
+    last_updated_time = datetime.now(timezone.utc).isoformat()
+    sales_orders = [
+        {
+            'contact_id': quote['contact_id'],
+            'date': order_date,
+            'description': quote['description'],
+            'lines': quote['lines'],
+            'total': quote['total'],
+            'status': OrderStatus.OPEN.value,
+            'quote_id': quote['id'],
+            'last_updated_time': last_updated_time,
+        }
+        for quote in quotes
+    ]
+    quote_ids = [quote['id'] for quote in quotes]
+    with db:
+        sales_order_table.insert_many(sales_orders)
+        execute_many("UPDATE quote SET status = ?, last_updated_time = ? WHERE id = ?",
+                     [(QuoteStatus.CONVERTED.value, last_updated_time, quote_id) for quote_id in quote_ids])
+    return [decode_document(sales_order) for sales_order in sales_order_table.find(quote_id=quote_ids, order_by='id')]
+
+
+def invoice_orders(order_table, order_type, orders_ids, conversion):
+    """
+        Turn open sales or purchase orders into invoices and post their journal entries in a single transaction:
+
+    """
+    is_sale = order_type == 'sales_order'
+    invoice_table = sales_invoice_table if is_sale else purchase_invoice_table
+    source_column = 'sales_order_id' if is_sale else 'purchase_order_id'
+    if not conversion.account_code:
+        raise HTTPException(status_code=400, detail="account_code of the receivable or payable account is required")
+    orders = find_convertible_documents(order_table, OrderStatus.OPEN.value, orders_ids)
+    if not orders:
+        return []
+
+    invoice_date = conversion.date or datetime.now(timezone.utc).astimezone().strftime('%Y-%m-%d')
+    due_date = date.fromordinal(parse_iso_date(invoice_date, 'date').toordinal()
+                                + (conversion.due_days or 0)).isoformat()
+    control_account_type = AccountType.ACCOUNTS_RECEIVABLE if is_sale else AccountType.ACCOUNTS_PAYABLE
+    default_line_account_type = AccountType.REVENUE if is_sale else AccountType.EXPENSE
+    # sales credit the revenue lines and debit receivables, purchases the other way round
+    line_sign = -1 if is_sale else 1
+
+    journal_entries = []
+    for order in orders:
+        lines = load_json(order['lines'])
+        journal_lines = [
+            {'account_code': line['account_code'],
+             'account_type': line.get('account_type') or default_line_account_type.value,
+             'amount': line_sign * round(line['quantity'] * line['unit_price'], 2),
+             'posting_type': 'Credit' if is_sale else 'Debit'}
+            for line in lines
+        ]
+        journal_lines.append({'account_code': conversion.account_code, 'account_type': control_account_type.value,
+                              'amount': -line_sign * order['total'], 'posting_type': 'Debit' if is_sale else 'Credit'})
+        journal_entries.append({
+            'date': invoice_date,
+            'description': order['description'] or f"Invoice for {order_type} {order['id']}",
+            'posted': True,
+            'journal_type': (JournalType.SALES if is_sale else JournalType.PURCHASE).value,
+            'validate_journal_type': False,
+            'journal_lines': journal_lines,
+        })
+
+    last_updated_time = datetime.now(timezone.utc).isoformat()
+    order_ids = [order['id'] for order in orders]
+    with db:
+        journal_entry_ids = insert_journal_entries(journal_entries)
+        invoice_table.insert_many([
+            {
+                'contact_id': order['contact_id'],
+                'date': invoice_date,
+                'due_date': due_date,
+                'description': order['description'],
+                'lines': order['lines'],
+                'total': order['total'],
+                'balance_due': order['total'],
+                'status': InvoiceStatus.OPEN.value,
+                'account_code': conversion.account_code,
+                source_column: order['id'],
+                'journal_entry_id': journal_entry_id,
+                'last_updated_time': last_updated_time,
+            }
+            for order, journal_entry_id in zip(orders, journal_entry_ids)
+        ])
+        execute_many(f"UPDATE {order_type} SET status = ?, last_updated_time = ? WHERE id = ?",
+                     [(OrderStatus.INVOICED.value, last_updated_time, order_id) for order_id in order_ids])
+    print(f"invoiced {len(orders)} {order_type} documents")
+    return [decode_document(invoice) for invoice in invoice_table.find(**{source_column: order_ids}, order_by='id')]
+
+
+def read_document(table, table_name, document_id):
+    document = table.find_one(id=document_id)
+    if document:
+        return decode_document(document)
+    else:
+        raise HTTPException(status_code=404, detail=f"{table_name} not found")
+
+
+def query_documents(query, skip, limit, table_name):
+    if query:
+        final_results = []
+        print(f"The query is {query}")
+        result = db.query(query)
+        if result:
+            for row in result:
+                final_results.append(decode_document(row) if isinstance(row.get('lines'), str) else row)
+            return final_results[skip: skip + limit]
+        else:
+            raise HTTPException(status_code=404, detail=f"{table_name} not found")
+
+
+def delete_document(table, table_name, document_id):
+    document_to_delete = table.find_one(id=document_id)
+    if not document_to_delete:
+        raise HTTPException(status_code=404, detail=f"{table_name} not found")
+    if document_to_delete['status'] in (QuoteStatus.CONVERTED.value, OrderStatus.INVOICED.value):
+        raise HTTPException(status_code=409, detail=f"Cannot delete a {document_to_delete['status']} {table_name}")
+    table.delete(id=document_id)
+    return {"message": f"{table_name} with id {document_id} has been deleted"}
+
+
+@app.post("/quote/", tags=["Quote"])
+async def create_quote(quote: Document):
+    """
+        Create a draft quote for a contact:
+
+    """
+    return create_document(quote_table, quote, QuoteStatus.DRAFT.value)
+
+
+@app.get("/quote/query", tags=["Quote"])
+async def query_quote(query: Optional[str] = None, skip: int = 0, limit: int = 10):
+    """
+        Query quotes using a sql statement:
+
+    """
+    return query_documents(query, skip, limit, "Quote")
+
+
+@app.post("/quote/convert", tags=["Quote"])
+async def convert_accepted_quotes(conversion: DocumentConversion):
+    """
+        Convert accepted quotes (all of them, or just ids) into sales orders in one transaction:
+
+    """
+    return convert_quotes(conversion.ids, conversion)
+
+
+@app.get("/quote/{quote_id}", tags=["Quote"])
+async def read_quote(quote_id: int):
+    """
+        Read a quote using quote_id:
+
+    """
+    return read_document(quote_table, "Quote", quote_id)
+
+
+@app.put("/quote/{quote_id}", tags=["Quote"])
+async def update_quote(quote_id: int, quote: UpdateDocument):
+    """
+        Update a quote, e.g. mark it ACCEPTED:
+
+    """
+    return update_document(quote_table, 'quote', quote_id, quote)
+
+
+@app.delete("/quote/{quote_id}", tags=["Quote"])
+async def delete_quote(quote_id: int):
+    """
+        Delete a Quote that was not converted:
+
+    """
+    return delete_document(quote_table, "Quote", quote_id)
+
+
+@app.post("/quote/{quote_id}/convert", tags=["Quote"])
+async def convert_quote(quote_id: int, conversion: Optional[DocumentConversion] = None):
+    """
+        Convert one accepted quote into a sales order:
+
+    """
+    return convert_quotes([quote_id], conversion or DocumentConversion())[0]
+
+
+@app.post("/sales_order/", tags=["Sales Order"])
+async def create_sales_order(sales_order: Document):
+    """
+        Create an open sales order for a contact:
+
+    """
+    return create_document(sales_order_table, sales_order, OrderStatus.OPEN.value)
+
+
+@app.get("/sales_order/query", tags=["Sales Order"])
+async def query_sales_order(query: Optional[str] = None, skip: int = 0, limit: int = 10):
+    """
+        Query sales orders using a sql statement:
+
+    """
+    return query_documents(query, skip, limit, "Sales Order")
+
+
+@app.post("/sales_order/invoice", tags=["Sales Order"])
+async def invoice_open_sales_orders(conversion: DocumentConversion):
+    """
+        Invoice open sales orders (all of them, or just ids), posting receivables and revenue in one transaction:
+
+    """
+    return invoice_orders(sales_order_table, 'sales_order', conversion.ids, conversion)
+
+
+@app.get("/sales_order/{sales_order_id}", tags=["Sales Order"])
+async def read_sales_order(sales_order_id: int):
+    """
+        Read a sales order using sales_order_id:
+
+    """
+    return read_document(sales_order_table, "Sales Order", sales_order_id)
+
+
+@app.put("/sales_order/{sales_order_id}", tags=["Sales Order"])
+async def update_sales_order(sales_order_id: int, sales_order: UpdateDocument):
+    """
+        Update a sales order that was not invoiced:
+
+    """
+    return update_document(sales_order_table, 'sales_order', sales_order_id, sales_order)
+
+
+@app.delete("/sales_order/{sales_order_id}", tags=["Sales Order"])
+async def delete_sales_order(sales_order_id: int):
+    """
+        Delete a Sales Order that was not invoiced:
+
+    """
+    return delete_document(sales_order_table, "Sales Order", sales_order_id)
+
+
+@app.post("/sales_order/{sales_order_id}/invoice", tags=["Sales Order"])
+async def invoice_sales_order(sales_order_id: int, conversion: DocumentConversion):
+    """
+        Invoice one open sales order:
+
+    """
+    return invoice_orders(sales_order_table, 'sales_order', [sales_order_id], conversion)[0]
+
+
+@app.post("/purchase_order/", tags=["Purchase Order"])
+async def create_purchase_order(purchase_order: Document):
+    """
+        Create an open purchase order for a vendor contact:
+
+    """
+    return create_document(purchase_order_table, purchase_order, OrderStatus.OPEN.value)
+
+
+@app.get("/purchase_order/query", tags=["Purchase Order"])
+async def query_purchase_order(query: Optional[str] = None, skip: int = 0, limit: int = 10):
+    """
+        Query purchase orders using a sql statement:
+
+    """
+    return query_documents(query, skip, limit, "Purchase Order")
+
+
+@app.post("/purchase_order/invoice", tags=["Purchase Order"])
+async def invoice_open_purchase_orders(conversion: DocumentConversion):
+    """
+        Turn open purchase orders (all of them, or just ids) into bills, posting payables in one transaction:
+
+    """
+    return invoice_orders(purchase_order_table, 'purchase_order', conversion.ids, conversion)
+
+
+@app.get("/purchase_order/{purchase_order_id}", tags=["Purchase Order"])
+async def read_purchase_order(purchase_order_id: int):
+    """
+        Read a purchase order using purchase_order_id:
+
+    """
+    return read_document(purchase_order_table, "Purchase Order", purchase_order_id)
+
+
+@app.put("/purchase_order/{purchase_order_id}", tags=["Purchase Order"])
+async def update_purchase_order(purchase_order_id: int, purchase_order: UpdateDocument):
+    """
+        Update a purchase order that was not invoiced:
+
+    """
+    return update_document(purchase_order_table, 'purchase_order', purchase_order_id, purchase_order)
+
+
+@app.delete("/purchase_order/{purchase_order_id}", tags=["Purchase Order"])
+async def delete_purchase_order(purchase_order_id: int):
+    """
+        Delete a Purchase Order that was not invoiced:
+
+    """
+    return delete_document(purchase_order_table, "Purchase Order", purchase_order_id)
+
+
+@app.post("/purchase_order/{purchase_order_id}/invoice", tags=["Purchase Order"])
+async def invoice_purchase_order(purchase_order_id: int, conversion: DocumentConversion):
+    """
+        Turn one open purchase order into a bill:
+
+    """
+    return invoice_orders(purchase_order_table, 'purchase_order', [purchase_order_id], conversion)[0]
+
+
+@app.get("/sales_invoice/query", tags=["Sales Invoice"])
+async def query_sales_invoice(query: Optional[str] = None, skip: int = 0, limit: int = 10):
+    """
+        Query sales invoices using a sql statement:
+
+    """
+    return query_documents(query, skip, limit, "Sales Invoice")
+
+
+@app.get("/sales_invoice/{sales_invoice_id}", tags=["Sales Invoice"])
+async def read_sales_invoice(sales_invoice_id: int):
+    """
+        Read a sales invoice using sales_invoice_id:
+
+    """
+    return read_document(sales_invoice_table, "Sales Invoice", sales_invoice_id)
+
+
+@app.get("/purchase_invoice/query", tags=["Purchase Invoice"])
+async def query_purchase_invoice(query: Optional[str] = None, skip: int = 0, limit: int = 10):
+    """
+        Query purchase invoices using a sql statement:
+
+    """
+    return query_documents(query, skip, limit, "Purchase Invoice")
+
+
+@app.get("/purchase_invoice/{purchase_invoice_id}", tags=["Purchase Invoice"])
+async def read_purchase_invoice(purchase_invoice_id: int):
+    """
+        Read a purchase invoice using purchase_invoice_id:
+
+    """
+    return read_document(purchase_invoice_table, "Purchase Invoice", purchase_invoice_id)
+
+
+# credit memos and vendor credit memos, allocated across many open invoices per request
+credit_memo_kinds = {
+    'credit_memo': {
+        'table': credit_memo_table,
+        'invoice_table_name': 'sales_invoice',
+        'control_account_type': AccountType.ACCOUNTS_RECEIVABLE,
+        'line_account_type': AccountType.REVENUE,
+        'is_sale': True,
+    },
+    'vendor_credit_memo': {
+        'table': vendor_credit_memo_table,
+        'invoice_table_name': 'purchase_invoice',
+        'control_account_type': AccountType.ACCOUNTS_PAYABLE,
+        'line_account_type': AccountType.EXPENSE,
+        'is_sale': False,
+    },
+}
+credit_allocation_table = db['credit_allocation']
+money_tolerance = 0.005
+
+
+def ensure_credit_memos():
+    """
+        Create the credit memo and credit_allocation tables, plus the open-balance index the allocator reads:
+
+    """
+    for credit_memo_type in credit_memo_kinds:
+        table = db[credit_memo_type]
+        for column, column_type in [('contact_id', db.types.integer), ('date', db.types.string),
+                                    ('description', db.types.text), ('lines', db.types.text),
+                                    ('account_code', db.types.string), ('total', db.types.float),
+                                    ('remaining_credit', db.types.float), ('status', db.types.string),
+                                    ('journal_entry_id', db.types.integer),
+                                    ('last_updated_time', db.types.string)]:
+            table.create_column(column, column_type)
+        table.create_index(['contact_id', 'status'])
+    for column, column_type in [('credit_memo_type', db.types.string), ('credit_memo_id', db.types.integer),
+                                ('invoice_id', db.types.integer), ('amount', db.types.float),
+                                ('date', db.types.string), ('journal_entry_id', db.types.integer),
+                                ('last_updated_time', db.types.string)]:
+        credit_allocation_table.create_column(column, column_type)
+    credit_allocation_table.create_index(['credit_memo_type', 'credit_memo_id'])
+    with db:
+        for invoice_table_name in ['sales_invoice', 'purchase_invoice']:
+            db.query(f"CREATE INDEX IF NOT EXISTS ix_{invoice_table_name}_open_balance "
+                     f"ON {invoice_table_name} (contact_id, date, id) WHERE balance_due > 0")
+
+
+on_database_open(ensure_credit_memos)
+
+
+def create_credit_memo(credit_memo_type, credit_memo):
+    """
+        Record a credit memo and post it against the control account in one transaction:
+
+    """
+    kind = credit_memo_kinds[credit_memo_type]
+    credit_memo_dict = credit_memo.dict()
+    lines = credit_memo_dict['lines']
+    if not lines:
+        raise HTTPException(status_code=400, detail="Cannot Record A Credit Memo Without Lines")
+    if not contact_table.find_one(id=credit_memo_dict['contact_id']):
+        raise HTTPException(status_code=404, detail="Contact not found")
+    credit_memo_dict['date'] = credit_memo_dict['date'] or datetime.now(timezone.utc).astimezone().strftime('%Y-%m-%d')
+    total = document_total(lines)
+    # a credit memo reverses an invoice: debit revenue / credit receivables, or debit payables / credit expenses
+    line_sign = 1 if kind['is_sale'] else -1
+    journal_lines = [
+        {'account_code': line['account_code'],
+         'account_type': line['account_type'] or kind['line_account_type'].value,
+         'amount': line_sign * round(line['quantity'] * line['unit_price'], 2),
+         'posting_type': 'Debit' if kind['is_sale'] else 'Credit'}
+        for line in lines
+    ]
+    journal_lines.append({'account_code': credit_memo_dict['account_code'],
+                          'account_type': kind['control_account_type'].value,
+                          'amount': -line_sign * total, 'posting_type': 'Credit' if kind['is_sale'] else 'Debit'})
+    journal_entry_dict = {
+        'date': credit_memo_dict['date'],
+        'description': credit_memo_dict['description'] or credit_memo_type.replace('_', ' ').capitalize(),
+        'posted': True,
+        'journal_type': (JournalType.SALES if kind['is_sale'] else JournalType.PURCHASE).value,
+        'validate_journal_type': False,
+        'journal_lines': journal_lines,
+    }
+    credit_memo_dict['total'] = total
+    credit_memo_dict['remaining_credit'] = total
+    credit_memo_dict['status'] = InvoiceStatus.OPEN.value
+    credit_memo_dict['last_updated_time'] = datetime.now(timezone.utc).isoformat()
+    with db:
+        credit_memo_dict['journal_entry_id'] = insert_journal_entries([journal_entry_dict])[0]
+        credit_memo_dict['id'] = kind['table'].insert(dict(credit_memo_dict, lines=dump_json(lines)))
+    return credit_memo_dict
+
+
+def allocate_credit(remaining_credit, open_invoices):
+    """
+        Spread a credit over (id, balance_due, account_code) rows in the order given until the credit runs out:
+
+    """
+    allocations = []
+    for invoice_id, balance_due, account_code in open_invoices:
+        if remaining_credit <= money_tolerance:
+            break
+        amount = round(min(remaining_credit, balance_due), 2)
+        allocations.append((invoice_id, balance_due, account_code, amount))
+        remaining_credit = round(remaining_credit - amount, 2)
+    return allocations
+
+
+def apply_credit_memo(credit_memo_type, credit_memo_id, application):
+    """
+        Apply a credit memo across a contact's open invoices, writing every allocation in one transaction:
+
+    """
+    kind = credit_memo_kinds[credit_memo_type]
+    credit_memo = kind['table'].find_one(id=credit_memo_id)
+    if not credit_memo:
+        raise HTTPException(status_code=404, detail="Credit memo not found")
+    available_credit = credit_memo['remaining_credit'] or 0
+    if application.amount is not None:
+        if application.amount <= 0 or application.amount > available_credit + money_tolerance:
+            raise HTTPException(status_code=400, detail=f"amount must be between 0 and {available_credit}")
+        available_credit = application.amount
+    if available_credit <= money_tolerance:
+        raise HTTPException(status_code=409, detail="Credit memo has no remaining credit")
+
+    invoice_table_name = kind['invoice_table_name']
+    order_by = 'date, id' if application.strategy == AllocationStrategy.OLDEST_FIRST else 'balance_due DESC, id'
+    open_invoices = fetch_rows(f"SELECT id, balance_due, account_code FROM {invoice_table_name} "
+                               f"WHERE contact_id = :contact_id AND balance_due > 0 ORDER BY {order_by}",
+                               contact_id=credit_memo['contact_id'])
+    if application.invoice_ids is not None:
+        invoice_ids = set(application.invoice_ids)
+        open_invoices = [invoice for invoice in open_invoices if invoice[0] in invoice_ids]
+        missing_invoice_ids = sorted(invoice_ids - {invoice[0] for invoice in open_invoices})
+        if missing_invoice_ids:
+            raise HTTPException(status_code=409,
+                                detail=f"Invoices {missing_invoice_ids} are missing, paid or for another contact")
+    allocations = allocate_credit(available_credit, open_invoices)
+    if not allocations:
+        raise HTTPException(status_code=409, detail="No open invoices to apply the credit to")
+
+    application_date = application.date or datetime.now(timezone.utc).astimezone().strftime('%Y-%m-%d')
+    last_updated_time = datetime.now(timezone.utc).isoformat()
+    applied = round(sum(allocation[3] for allocation in allocations), 2)
+    remaining_credit = round(credit_memo['remaining_credit'] - applied, 2)
+
+    # the memo already moved its own control account; only invoices booked to another one need a transfer
+    transfers = {}
+    for invoice_id, balance_due, account_code, amount in allocations:
+        if account_code != credit_memo['account_code']:
+            transfers[account_code] = round(transfers.get(account_code, 0) + amount, 2)
+    transfer_sign = 1 if kind['is_sale'] else -1
+    journal_lines = []
+    for account_code, amount in transfers.items():
+        journal_lines.append({'account_code': credit_memo['account_code'],
+                              'account_type': kind['control_account_type'].value,
+                              'amount': transfer_sign * amount,
+                              'posting_type': 'Debit' if kind['is_sale'] else 'Credit'})
+        journal_lines.append({'account_code': account_code, 'account_type': kind['control_account_type'].value,
+                              'amount': -transfer_sign * amount,
+                              'posting_type': 'Credit' if kind['is_sale'] else 'Debit'})
+
+    with db:
+        journal_entry_id = None
+        if journal_lines:
+            journal_entry_id = insert_journal_entries([{
+                'date': application_date,
+                'description': f"Apply {credit_memo_type.replace('_', ' ')} {credit_memo_id}",
+                'posted': True,
+                'journal_type': None,
+                'validate_journal_type': False,
+                'journal_lines': journal_lines,
+            }])[0]
+        credit_allocation_table.insert_many([
+            {
+                'credit_memo_type': credit_memo_type,
+                'credit_memo_id': credit_memo_id,
+                'invoice_id': invoice_id,
+                'amount': amount,
+                'date': application_date,
+                'journal_entry_id': journal_entry_id,
+                'last_updated_time': last_updated_time,
+            }
+            for invoice_id, balance_due, account_code, amount in allocations
+        ])
+        invoice_updates = []
+        for invoice_id, balance_due, account_code, amount in allocations:
+            balance_due = round(balance_due - amount, 2)
+            status = InvoiceStatus.PAID.value if balance_due <= money_tolerance else InvoiceStatus.OPEN.value
+            invoice_updates.append((balance_due, status, last_updated_time, invoice_id))
+        execute_many(f"UPDATE {invoice_table_name} SET balance_due = ?, status = ?, last_updated_time = ? "
+                     f"WHERE id = ?", invoice_updates)
+        kind['table'].update({
+            'id': credit_memo_id,
+            'remaining_credit': remaining_credit,
+            'status': InvoiceStatus.PAID.value if remaining_credit <= money_tolerance else InvoiceStatus.OPEN.value,
+            'last_updated_time': last_updated_time,
+        }, ['id'])
+    print(f"applied {applied} of {credit_memo_type} {credit_memo_id} to {len(allocations)} invoices")
+    return {
+        'credit_memo': decode_document(kind['table'].find_one(id=credit_memo_id)),
+        'applied': applied,
+        'allocations': [{'invoice_id': invoice_id, 'amount': amount}
+                        for invoice_id, balance_due, account_code, amount in allocations],
+    }
+
+
+def delete_credit_memo(credit_memo_type, table_name, credit_memo_id):
+    kind = credit_memo_kinds[credit_memo_type]
+    credit_memo_to_delete = kind['table'].find_one(id=credit_memo_id)
+    if not credit_memo_to_delete:
+        raise HTTPException(status_code=404, detail=f"{table_name} not found")
+    if credit_allocation_table.find_one(credit_memo_type=credit_memo_type, credit_memo_id=credit_memo_id):
+        raise HTTPException(status_code=409, detail=f"Cannot delete a {table_name} that has been applied")
+    with db:
+        journal_entry_table.delete(id=credit_memo_to_delete['journal_entry_id'])
+        replace_journal_lines(credit_memo_to_delete['journal_entry_id'], None, [])
+        kind['table'].delete(id=credit_memo_id)
+    return {"message": f"{table_name} with id {credit_memo_id} has been deleted"}
+
+
+@app.post("/credit_memo/", tags=["Credit Memo"])
+async def create_sales_credit_memo(credit_memo: CreditMemo):
+    """
+        Create a credit memo for a customer, posting Dr revenue / Cr receivables:
+
+    """
+    return create_credit_memo('credit_memo', credit_memo)
+
+
+@app.get("/credit_memo/query", tags=["Credit Memo"])
+async def query_credit_memo(query: Optional[str] = None, skip: int = 0, limit: int = 10):
+    """
+        Query credit memos using a sql statement:
+
+    """
+    return query_documents(query, skip, limit, "Credit Memo")
+
+
+@app.get("/credit_memo/{credit_memo_id}", tags=["Credit Memo"])
+async def read_credit_memo(credit_memo_id: int):
+    """
+        Read a credit memo using credit_memo_id:
+
+    """
+    return read_document(credit_memo_table, "Credit Memo", credit_memo_id)
+
+
+@app.delete("/credit_memo/{credit_memo_id}", tags=["Credit Memo"])
+async def delete_sales_credit_memo(credit_memo_id: int):
+    """
+        Delete a credit memo that has not been applied, along with its journal entry:
+
+    """
+    return delete_credit_memo('credit_memo', "Credit Memo", credit_memo_id)
+
+
+@app.post("/credit_memo/{credit_memo_id}/apply", tags=["Credit Memo"])
+async def apply_sales_credit_memo(credit_memo_id: int, application: CreditApplication):
+    """
+        Apply a credit memo across the customer's open sales invoices (oldest first or largest first):
+
+    """
+    return apply_credit_memo('credit_memo', credit_memo_id, application)
+
+
+@app.get("/credit_memo/{credit_memo_id}/allocations", tags=["Credit Memo"])
+async def read_credit_memo_allocations(credit_memo_id: int):
+    """
+        List the invoices a credit memo has been applied to:
+
+    """
+    return list(credit_allocation_table.find(credit_memo_type='credit_memo', credit_memo_id=credit_memo_id,
+                                             order_by='id'))
+
+
+@app.post("/vendor_credit_memo/", tags=["Vendor Credit Memo"])
+async def create_vendor_credit_memo(vendor_credit_memo: CreditMemo):
+    """
+        Create a credit memo received from a vendor, posting Dr payables / Cr expenses:
+
+    """
+    return create_credit_memo('vendor_credit_memo', vendor_credit_memo)
+
+
+@app.get("/vendor_credit_memo/query", tags=["Vendor Credit Memo"])
+async def query_vendor_credit_memo(query: Optional[str] = None, skip: int = 0, limit: int = 10):
+    """
+        Query vendor credit memos using a sql statement:
+
+    """
+    return query_documents(query, skip, limit, "Vendor Credit Memo")
+
+
+@app.get("/vendor_credit_memo/{vendor_credit_memo_id}", tags=["Vendor Credit Memo"])
+async def read_vendor_credit_memo(vendor_credit_memo_id: int):
+    """
+        Read a vendor credit memo using vendor_credit_memo_id:
+
+    """
+    return read_document(vendor_credit_memo_table, "Vendor Credit Memo", vendor_credit_memo_id)
+
+
+@app.delete("/vendor_credit_memo/{vendor_credit_memo_id}", tags=["Vendor Credit Memo"])
+async def delete_vendor_credit_memo(vendor_credit_memo_id: int):
+    """
+        Delete a vendor credit memo that has not been applied, along with its journal entry:
+
+    """
+    return delete_credit_memo('vendor_credit_memo', "Vendor Credit Memo", vendor_credit_memo_id)
+
+
+@app.post("/vendor_credit_memo/{vendor_credit_memo_id}/apply", tags=["Vendor Credit Memo"])
+async def apply_vendor_credit_memo(vendor_credit_memo_id: int, application: CreditApplication):
+    """
+        Apply a vendor credit memo across the vendor's open purchase invoices (oldest first or largest first):
+
+    """
+    return apply_credit_memo('vendor_credit_memo', vendor_credit_memo_id, application)
+
+
+@app.get("/vendor_credit_memo/{vendor_credit_memo_id}/allocations", tags=["Vendor Credit Memo"])
+async def read_vendor_credit_memo_allocations(vendor_credit_memo_id: int):
+    """
+        List the purchase invoices a vendor credit memo has been applied to:
+
+    """
+    return list(credit_allocation_table.find(credit_memo_type='vendor_credit_memo',
+                                             credit_memo_id=vendor_credit_memo_id, order_by='id'))
+
+
+# payroll: gross-to-net for the whole roster, posted as one consolidated journal per run
+payroll_run_table = db['payroll_run']
+payslip_table = db['payslip']
+
+
+def ensure_payroll():
+    """
+        Create the typed employee, payroll_run and payslip tables:
+
+    """
+    for column, column_type in [('first_name', db.types.string), ('last_name', db.types.string),
+                                ('email_address', db.types.string), ('pay_type', db.types.string),
+                                ('annual_salary', db.types.float), ('hourly_rate', db.types.float),
+                                ('standard_hours', db.types.float), ('tax_rate', db.types.float),
+                                ('deduction_amount', db.types.float), ('inactive', db.types.boolean)]:
+        employee_table.create_column(column, column_type)
+    employee_table.create_index(['inactive'])
+    for column, column_type in [('period_start', db.types.string), ('period_end', db.types.string),
+                                ('pay_date', db.types.string), ('employee_count', db.types.integer),
+                                ('gross', db.types.float), ('tax', db.types.float),
+                                ('deductions', db.types.float), ('net', db.types.float),
+                                ('journal_entry_id', db.types.integer), ('last_updated_time', db.types.string)]:
+        payroll_run_table.create_column(column, column_type)
+    payroll_run_table.create_index(['period_start', 'period_end'])
+    for column, column_type in [('payroll_run_id', db.types.integer), ('employee_id', db.types.integer),
+                                ('hours', db.types.float), ('gross', db.types.float), ('tax', db.types.float),
+                                ('deductions', db.types.float), ('net', db.types.float)]:
+        payslip_table.create_column(column, column_type)
+    payslip_table.create_index(['payroll_run_id'])
+    payslip_table.create_index(['employee_id'])
+
+
+on_database_open(ensure_payroll)
+
+
+def compute_payslips(employees, pay_periods_per_year, hours):
+    """
+        Work out gross, tax, deductions and net pay for (id, pay_type, annual_salary, hourly_rate,
+        standard_hours, tax_rate, deduction_amount) rows:
+
+    """
+    payslips = []
+    for employee_id, pay_type, annual_salary, hourly_rate, standard_hours, tax_rate, deduction_amount in employees:
+        worked_hours = hours.get(employee_id, standard_hours or 0)
+        if pay_type == PayType.HOURLY.value:
+            gross = round((hourly_rate or 0) * worked_hours, 2)
+        else:
+            gross = round((annual_salary or 0) / pay_periods_per_year, 2)
+        tax = round(gross * (tax_rate or 0), 2)
+        deductions = round(min(deduction_amount or 0, gross - tax), 2)
+        payslips.append({
+            'employee_id': employee_id,
+            'hours': worked_hours,
+            'gross': gross,
+            'tax': tax,
+            'deductions': deductions,
+            'net': round(gross - tax - deductions, 2),
+        })
+    return payslips
+
+
+def payroll_journal_lines(payroll_run, payslips, employee_names, totals):
+    journal_lines = [{'account_code': payroll_run.wages_expense_account_code,
+                      'account_type': AccountType.EXPENSE.value,
+                      'amount': totals['gross'], 'posting_type': 'Debit'}]
+    if totals['tax']:
+        journal_lines.append({'account_code': payroll_run.tax_payable_account_code,
+                              'account_type': AccountType.CURRENT_LIABILITY.value,
+                              'amount': -totals['tax'], 'posting_type': 'Credit'})
+    if totals['deductions']:
+        journal_lines.append({'account_code': payroll_run.deductions_payable_account_code
+                              or payroll_run.tax_payable_account_code,
+                              'account_type': AccountType.CURRENT_LIABILITY.value,
+                              'amount': -totals['deductions'], 'posting_type': 'Credit'})
+    if payroll_run.per_employee_lines:
+        journal_lines.extend(
+            {'account_code': payroll_run.wages_payable_account_code,
+             'account_type': AccountType.WAGES_PAYABLE.value,
+             'amount': -payslip['net'], 'posting_type': 'Credit',
+             'description': f"Net pay {employee_names[payslip['employee_id']]}"}
+            for payslip in payslips if payslip['net']
+        )
+    elif totals['net']:
+        journal_lines.append({'account_code': payroll_run.wages_payable_account_code,
+                              'account_type': AccountType.WAGES_PAYABLE.value,
+                              'amount': -totals['net'], 'posting_type': 'Credit'})
+    return journal_lines
+
+
+@app.post("/employee/", tags=["Employee"])
+async def create_employee(employee: Employee):
+    """
+        Create an employee using required information:
+
+    """
+    employee_dict = employee.dict()
+
+    db_insert = employee_table.insert(employee_dict)
+    print(f"db_insert is {db_insert}")
+    employee_dict['id'] = db_insert
+    return employee_dict
+
+
+@app.get("/employee/query", tags=["Employee"])
+async def query_employee(query: Optional[str] = None, skip: int = 0, limit: int = 10):
+    """
+        Query employees using a sql statement:
+
+    """
+    if query:
+        final_results = []
+        print(f"The query is {query}")
+        result = db.query(query)
+        if result:
+            for row in result:
+                final_results.append(row)
+            return final_results[skip: skip + limit]
+        else:
+            raise HTTPException(status_code=404, detail="Employee not found")
+
+
+@app.get("/employee/{employee_id}", tags=["Employee"])
+async def read_employee(employee_id: int):
+    """
+        Read an employee using employee_id:
+
+    """
+    employee = employee_table.find_one(id=employee_id)
+    if employee:
+        return employee
+    else:
+        raise HTTPException(status_code=404, detail="Employee not found")
+
+
+@app.put("/employee/{employee_id}", tags=["Employee"])
+async def update_employee(employee_id: int, employee: UpdateEmployee):
+    """
+        Update an employee with new information:
+
+    """
+    employee_to_update = employee_table.find_one(id=employee_id)
+    if employee_to_update:
+        employee_dict = employee.dict(exclude_unset=True)
+        employee_dict['id'] = employee_id
+        employee_table.update(employee_dict, ['id'])
+        return employee_table.find_one(id=employee_id)
+    else:
+        raise HTTPException(status_code=404, detail="Employee not found")
+
+
+@app.delete("/employee/{employee_id}", tags=["Employee"])
+async def delete_employee(employee_id: int):
+    """
+        Delete an Employee that has never been paid, otherwise mark them inactive instead:
+
+    """
+    employee_to_delete = employee_table.find_one(id=employee_id)
+    if not employee_to_delete:
+        raise HTTPException(status_code=404, detail="Employee not found")
+    if payslip_table.find_one(employee_id=employee_id):
+        raise HTTPException(status_code=409, detail="Employee has payslips, set inactive instead")
+    employee_table.delete(id=employee_id)
+    return {"message": f"Employee with id {employee_id} has been deleted"}
+
+
+@app.post("/payroll/run", tags=["Payroll"])
+async def run_payroll(payroll_run: PayrollRun):
+    """
+        Pay every active employee for a period, posting one consolidated PAYROLL journal entry:
+
+    """
+    if payroll_run.pay_periods_per_year <= 0:
+        raise HTTPException(status_code=400, detail="pay_periods_per_year must be positive")
+    if payroll_run_table.find_one(period_start=payroll_run.period_start, period_end=payroll_run.period_end):
+        raise HTTPException(status_code=409, detail="Payroll has already been run for this period")
+    employees = fetch_rows("SELECT id, pay_type, annual_salary, hourly_rate, standard_hours, tax_rate, "
+                           "deduction_amount, first_name, last_name FROM employee "
+                           "WHERE inactive IS NOT 1 ORDER BY id")
+    if not employees:
+        raise HTTPException(status_code=404, detail="No active employees to pay")
+    employee_names = {employee[0]: f"{employee[7]} {employee[8]}" for employee in employees}
+    payslips = compute_payslips([employee[:7] for employee in employees], payroll_run.pay_periods_per_year,
+                                payroll_run.hours or {})
+    totals = {column: round(sum(payslip[column] for payslip in payslips), 2)
+              for column in ['gross', 'tax', 'deductions', 'net']}
+    totals['net'] = round(totals['gross'] - totals['tax'] - totals['deductions'], 2)
+
+    pay_date = payroll_run.pay_date or payroll_run.period_end
+    journal_entry_dict = {
+        'date': pay_date,
+        'description': f"Payroll {payroll_run.period_start} to {payroll_run.period_end}",
+        'posted': True,
+        'journal_type': JournalType.PAYROLL.value,
+        'validate_journal_type': False,
+        'journal_lines': payroll_journal_lines(payroll_run, payslips, employee_names, totals),
+    }
+    payroll_run_dict = {
+        'period_start': payroll_run.period_start,
+        'period_end': payroll_run.period_end,
+        'pay_date': pay_date,
+        'employee_count': len(payslips),
+        'last_updated_time': datetime.now(timezone.utc).isoformat(),
+    }
+    payroll_run_dict.update(totals)
+    with db:
+        payroll_run_dict['journal_entry_id'] = insert_journal_entries([journal_entry_dict])[0]
+        payroll_run_dict['id'] = payroll_run_table.insert(payroll_run_dict)
+        for payslip in payslips:
+            payslip['payroll_run_id'] = payroll_run_dict['id']
+        payslip_table.insert_many(payslips)
+    print(f"payroll run {payroll_run_dict['id']} paid {len(payslips)} employees")
+    return payroll_run_dict
+
+
+@app.get("/payroll/run/{payroll_run_id}", tags=["Payroll"])
+async def read_payroll_run(payroll_run_id: int):
+    """
+        Read a payroll run using payroll_run_id:
+
+    """
+    payroll_run = payroll_run_table.find_one(id=payroll_run_id)
+    if payroll_run:
+        return payroll_run
+    else:
+        raise HTTPException(status_code=404, detail="Payroll run not found")
+
+
+@app.get("/payroll/run/{payroll_run_id}/payslips", tags=["Payroll"])
+async def read_payslips(payroll_run_id: int, skip: int = 0, limit: int = 100):
+    """
+        List the payslips of a payroll run:
+
+    """
+    return list(payslip_table.find(payroll_run_id=payroll_run_id, order_by='employee_id',
+                                   _offset=skip, _limit=limit))
+
+
+# crypto wallet transactions, tax lots and realized gains
+crypto_transaction_table = db['crypto_transaction']
+crypto_tax_lot_table = db['crypto_tax_lot']
+crypto_lot_disposal_table = db['crypto_lot_disposal']
+crypto_quantity_tolerance = 1e-12
+
+
+def ensure_crypto_lots():
+    """
+        Create the crypto transaction, tax lot and lot disposal tables with their lookup indexes:
+
+    """
+    crypto_wallet_table.create_column('lot_method', db.types.string)
+    crypto_wallet_table.create_column('current_balance', db.types.float)
+    for column, column_type in [('crypto_wallet_id', db.types.integer), ('asset', db.types.string),
+                                ('date', db.types.string), ('timestamp', db.types.string),
+                                ('transaction_type', db.types.string), ('quantity', db.types.float),
+                                ('price', db.types.float), ('fee', db.types.float),
+                                ('reference', db.types.string), ('cost_basis', db.types.float),
+                                ('proceeds', db.types.float), ('realized_gain', db.types.float),
+                                ('journal_entry_id', db.types.integer)]:
+        crypto_transaction_table.create_column(column, column_type)
+    crypto_transaction_table.create_index(['crypto_wallet_id', 'asset', 'date'])
+    for column, column_type in [('crypto_wallet_id', db.types.integer), ('asset', db.types.string),
+                                ('acquired_date', db.types.string), ('quantity', db.types.float),
+                                ('remaining_quantity', db.types.float), ('unit_cost', db.types.float),
+                                ('crypto_transaction_id', db.types.integer)]:
+        crypto_tax_lot_table.create_column(column, column_type)
+    for column, column_type in [('crypto_wallet_id', db.types.integer), ('asset', db.types.string),
+                                ('crypto_transaction_id', db.types.integer), ('crypto_tax_lot_id', db.types.integer),
+                                ('date', db.types.string), ('acquired_date', db.types.string),
+                                ('quantity', db.types.float), ('cost_basis', db.types.float),
+                                ('proceeds', db.types.float), ('realized_gain', db.types.float)]:
+        crypto_lot_disposal_table.create_column(column, column_type)
+    crypto_lot_disposal_table.create_index(['crypto_wallet_id', 'date'])
+    crypto_lot_disposal_table.create_index(['crypto_transaction_id'])
+    with db:
+        db.query("CREATE INDEX IF NOT EXISTS ix_crypto_tax_lot_open "
+                 "ON crypto_tax_lot (crypto_wallet_id, asset, acquired_date, id) WHERE remaining_quantity > 0")
+
+
+on_database_open(ensure_crypto_lots)
+
+
+class TaxLotIndex:
+    """
+        Open tax lots of one asset, ordered so the next lot to dispose of is always at the head:
+
+    """
+
+    def __init__(self, lot_method):
+        self.lot_method = lot_method
+        self.lots = [] if lot_method != LotMethod.FIFO else deque()
+
+    def add(self, lot):
+        # lot is [id, remaining_quantity, unit_cost, acquired_date]
+        if self.lot_method == LotMethod.HIFO:
+            heapq.heappush(self.lots, (-lot[2], lot[0], lot))
+        else:
+            self.lots.append(lot)
+
+    def head(self):
+        if not self.lots:
+            return None
+        if self.lot_method == LotMethod.HIFO:
+            return self.lots[0][2]
+        return self.lots[0] if self.lot_method == LotMethod.FIFO else self.lots[-1]
+
+    def pop(self):
+        if self.lot_method == LotMethod.HIFO:
+            heapq.heappop(self.lots)
+        elif self.lot_method == LotMethod.FIFO:
+            self.lots.popleft()
+        else:
+            self.lots.pop()
+
+
+crypto_transaction_columns = {
+    'asset': ['asset', 'currency', 'symbol'],
+    'timestamp': ['timestamp', 'date', 'time'],
+    'transaction_type': ['type', 'transaction_type', 'side'],
+    'quantity': ['quantity', 'amount', 'size'],
+    'price': ['price', 'unit_price', 'rate'],
+    'fee': ['fee', 'fees'],
+    'reference': ['reference', 'id', 'txid', 'transaction_id'],
+}
+
+
+def parse_crypto_transactions(content, file_format, default_asset):
+    """
+        Parse a CSV or JSON wallet export into transaction dicts sorted by time:
+
+    """
+    if file_format == CryptoImportFormat.JSON:
+        rows = json.loads(content)
+        if isinstance(rows, dict):
+            rows = rows.get('transactions', [])
+    else:
+        rows = list(csv.DictReader(io.StringIO(content)))
+    if not rows:
+        return []
+    # resolve the export's column names once instead of probing every alias on every row
+    keys = {str(key).strip().lower(): key for key in rows[0] if key}
+    columns = {
+        field: next((keys[alias] for alias in aliases if alias in keys), None)
+        for field, aliases in crypto_transaction_columns.items()
+    }
+    for field in ['timestamp', 'transaction_type', 'quantity']:
+        if columns[field] is None:
+            raise HTTPException(status_code=400, detail=f"Wallet export has no {field} column")
+    parsed_dates = {}
+    transactions = []
+    for row_number, row in enumerate(rows):
+        transaction_type = str(row.get(columns['transaction_type']) or '').strip().upper()
+        if transaction_type not in CryptoTransactionType.__members__:
+            raise HTTPException(status_code=400,
+                                detail=f"Row {row_number + 1}: transaction type must be BUY or SELL")
+        timestamp = str(row.get(columns['timestamp']) or '').strip()
+        day = timestamp[:10] if len(timestamp) > 10 and timestamp[10] in 'T ' else timestamp
+        if day not in parsed_dates:
+            parsed_dates[day] = parse_statement_date(day)
+        quantity = abs(parse_statement_amount(row.get(columns['quantity'])))
+        if quantity <= crypto_quantity_tolerance:
+            raise HTTPException(status_code=400, detail=f"Row {row_number + 1}: quantity must be positive")
+        transactions.append({
+            'asset': str(row.get(columns['asset']) or default_asset).strip().upper(),
+            'date': parsed_dates[day],
+            'timestamp': timestamp,
+            'transaction_type': transaction_type,
+            'quantity': quantity,
+            'price': abs(parse_statement_amount(row.get(columns['price']))),
+            'fee': abs(parse_statement_amount(row.get(columns['fee']))),
+            'reference': row.get(columns['reference']),
+        })
+    # sort on the parsed date first so exports with non-ISO dates still come out in order
+    transactions.sort(key=lambda transaction: (transaction['date'], transaction['timestamp']))
+    return transactions
+
+
+def load_open_tax_lots(crypto_wallet_id, lot_method):
+    lot_indexes = {}
+    for lot_id, asset, remaining_quantity, unit_cost, acquired_date in fetch_rows(
+            "SELECT id, asset, remaining_quantity, unit_cost, acquired_date FROM crypto_tax_lot "
+            "WHERE crypto_wallet_id = :crypto_wallet_id AND remaining_quantity > 0 "
+            "ORDER BY asset, acquired_date, id", crypto_wallet_id=crypto_wallet_id):
+        if asset not in lot_indexes:
+            lot_indexes[asset] = TaxLotIndex(lot_method)
+        lot_indexes[asset].add([lot_id, remaining_quantity, unit_cost, acquired_date])
+    return lot_indexes
+
+
+def match_tax_lots(crypto_wallet_id, transactions, lot_indexes, lot_method, next_transaction_id, next_lot_id):
+    """
+        Open a lot for every buy and dispose of lots for every sell, returning the rows to write:
+
+    """
+    new_lots = []
+    touched_lots = {}
+    disposals = []
+    for transaction in transactions:
+        transaction['id'] = next_transaction_id
+        next_transaction_id += 1
+        asset = transaction['asset']
+        if asset not in lot_indexes:
+            lot_indexes[asset] = TaxLotIndex(lot_method)
+        if transaction['transaction_type'] == CryptoTransactionType.BUY.value:
+            cost_basis = round(transaction['quantity'] * transaction['price'] + transaction['fee'], 2)
+            lot = [next_lot_id, transaction['quantity'], cost_basis / transaction['quantity'], transaction['date']]
+            next_lot_id += 1
+            lot_indexes[asset].add(lot)
+            new_lots.append((lot, asset, transaction['quantity'], transaction['id']))
+            transaction['cost_basis'] = cost_basis
+            transaction['proceeds'] = None
+            transaction['realized_gain'] = None
+            continue
+
+        proceeds = round(transaction['quantity'] * transaction['price'] - transaction['fee'], 2)
+        remaining_quantity = transaction['quantity']
+        cost_basis = 0.0
+        while remaining_quantity > crypto_quantity_tolerance:
+            lot = lot_indexes[asset].head()
+            if lot is None:
+                raise HTTPException(status_code=409, detail=f"Sell of {transaction['quantity']} {asset} on "
+                                                            f"{transaction['timestamp']} exceeds the open tax lots")
+            quantity = min(lot[1], remaining_quantity)
+            lot_cost = round(quantity * lot[2], 2)
+            lot_proceeds = round(proceeds * quantity / transaction['quantity'], 2)
+            disposals.append((crypto_wallet_id, asset, transaction['id'], lot[0], transaction['date'], lot[3],
+                              quantity, lot_cost, lot_proceeds, round(lot_proceeds - lot_cost, 2)))
+            cost_basis += lot_cost
+            lot[1] -= quantity
+            remaining_quantity -= quantity
+            if lot[1] <= crypto_quantity_tolerance:
+                lot[1] = 0.0
+                lot_indexes[asset].pop()
+            touched_lots[lot[0]] = lot
+        transaction['cost_basis'] = round(cost_basis, 2)
+        transaction['proceeds'] = proceeds
+        transaction['realized_gain'] = round(proceeds - cost_basis, 2)
+    return new_lots, touched_lots, disposals
+
+
+def crypto_journal_entries(transactions, asset_account_code, cash_account_code, gain_account_code,
+                           loss_account_code):
+    """
+        Summarise the imported trades into one balanced journal entry per trade date:
+
+    """
+    daily_totals = {}
+    for transaction in transactions:
+        totals = daily_totals.setdefault(transaction['date'], {'asset': 0.0, 'cash': 0.0, 'gain': 0.0, 'loss': 0.0})
+        if transaction['transaction_type'] == CryptoTransactionType.BUY.value:
+            totals['asset'] += transaction['cost_basis']
+            totals['cash'] -= transaction['cost_basis']
+        else:
+            totals['asset'] -= transaction['cost_basis']
+            totals['cash'] += transaction['proceeds']
+            if transaction['realized_gain'] >= 0:
+                totals['gain'] += transaction['realized_gain']
+            else:
+                totals['loss'] -= transaction['realized_gain']
+    journal_entries = {}
+    for transaction_date, totals in daily_totals.items():
+        journal_lines = []
+        for account_code, account_type, amount in [
+                (asset_account_code, AccountType.CURRENT_ASSET.value, totals['asset']),
+                (cash_account_code, AccountType.BANK.value, totals['cash']),
+                (gain_account_code, AccountType.OTHER_INCOME.value, -totals['gain']),
+                (loss_account_code, AccountType.OTHER_EXPENSES.value, totals['loss'])]:
+            amount = round(amount, 2)
+            if amount:
+                journal_lines.append({'account_code': account_code, 'account_type': account_type, 'amount': amount,
+                                      'posting_type': 'Debit' if amount > 0 else 'Credit'})
+        if journal_lines:
+            journal_entries[transaction_date] = {
+                'date': transaction_date,
+                'description': "Crypto trades and realized gains",
+                'posted': True,
+                'journal_type': None,
+                'validate_journal_type': False,
+                'journal_lines': journal_lines,
+            }
+    return journal_entries
+
+
+@app.post("/crypto_wallet/{crypto_wallet_id}/transactions/import", tags=["Crypto Wallet"])
+async def import_crypto_transactions(request: Request,
+                                     crypto_wallet_id: int,
+                                     asset_account_code: str,
+                                     cash_account_code: str,
+                                     gain_account_code: str,
+                                     loss_account_code: Optional[str] = None,
+                                     file_format: CryptoImportFormat = CryptoImportFormat.CSV,
+                                     lot_method: Optional[LotMethod] = None):
+    """
+        Import a CSV or JSON wallet export, match sells to tax lots and post realized gains:
+
+    """
+    crypto_wallet = crypto_wallet_table.find_one(id=crypto_wallet_id)
+    if not crypto_wallet:
+        raise HTTPException(status_code=404, detail="Crypto Wallet not found")
+    wallet_lot_method = crypto_wallet.get('lot_method')
+    if lot_method and wallet_lot_method and lot_method.value != wallet_lot_method:
+        raise HTTPException(status_code=409, detail=f"Crypto Wallet already uses {wallet_lot_method} tax lots")
+    lot_method = LotMethod(wallet_lot_method or (lot_method or LotMethod.FIFO).value)
+
+    content = (await request.body()).decode('utf-8-sig')
+    transactions = parse_crypto_transactions(content, file_format, crypto_wallet.get('crypto_wallet_type') or '')
+    if not transactions:
+        raise HTTPException(status_code=400, detail="Wallet export contains no transactions")
+
+    lot_indexes = load_open_tax_lots(crypto_wallet_id, lot_method)
+    with db:
+        next_transaction_id = fetch_rows("SELECT COALESCE(MAX(id), 0) + 1 FROM crypto_transaction")[0][0]
+        next_lot_id = fetch_rows("SELECT COALESCE(MAX(id), 0) + 1 FROM crypto_tax_lot")[0][0]
+        new_lots, touched_lots, disposals = match_tax_lots(crypto_wallet_id, transactions, lot_indexes, lot_method,
+                                                           next_transaction_id, next_lot_id)
+        journal_entries = crypto_journal_entries(transactions, asset_account_code, cash_account_code,
+                                                 gain_account_code, loss_account_code or gain_account_code)
+        journal_entry_ids = dict(zip(journal_entries, insert_journal_entries(list(journal_entries.values()))))
+        execute_many("INSERT INTO crypto_transaction (id, crypto_wallet_id, asset, date, timestamp, transaction_type, "
+                     "quantity, price, fee, reference, cost_basis, proceeds, realized_gain, journal_entry_id) "
+                     "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                     [(transaction['id'], crypto_wallet_id, transaction['asset'], transaction['date'],
+                       transaction['timestamp'], transaction['transaction_type'], transaction['quantity'],
+                       transaction['price'], transaction['fee'], transaction['reference'],
+                       transaction['cost_basis'], transaction['proceeds'], transaction['realized_gain'],
+                       journal_entry_ids.get(transaction['date'])) for transaction in transactions])
+        execute_many("INSERT INTO crypto_tax_lot (id, crypto_wallet_id, asset, acquired_date, quantity, "
+                     "remaining_quantity, unit_cost, crypto_transaction_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                     [(lot[0], crypto_wallet_id, asset, lot[3], quantity, lot[1], lot[2], transaction_id)
+                      for lot, asset, quantity, transaction_id in new_lots])
+        execute_many("UPDATE crypto_tax_lot SET remaining_quantity = ? WHERE id = ?",
+                     [(lot[1], lot_id) for lot_id, lot in touched_lots.items() if lot_id < next_lot_id])
+        execute_many("INSERT INTO crypto_lot_disposal (crypto_wallet_id, asset, crypto_transaction_id, "
+                     "crypto_tax_lot_id, date, acquired_date, quantity, cost_basis, proceeds, realized_gain) "
+                     "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", disposals)
+        current_balance = fetch_rows("SELECT COALESCE(SUM(remaining_quantity), 0) FROM crypto_tax_lot "
+                                     "WHERE crypto_wallet_id = :crypto_wallet_id AND asset = :asset "
+                                     "AND remaining_quantity > 0", crypto_wallet_id=crypto_wallet_id,
+                                     asset=str(crypto_wallet.get('crypto_wallet_type') or '').upper())[0][0]
+        update_versioned_row(crypto_wallet_table, crypto_wallet_id,
+                             {'lot_method': lot_method.value, 'current_balance': current_balance})
+    realized_gain = round(sum(disposal[-1] for disposal in disposals), 2)
+    print(f"imported {len(transactions)} crypto transactions into crypto_wallet {crypto_wallet_id}")
+    return {
+        'crypto_wallet_id': crypto_wallet_id,
+        'lot_method': lot_method.value,
+        'transactions': len(transactions),
+        'lots_opened': len(new_lots),
+        'lots_disposed': len(disposals),
+        'realized_gain': realized_gain,
+        'journal_entry_ids': list(journal_entry_ids.values()),
+        'current_balance': current_balance,
+    }
+
+
+@app.get("/crypto_wallet/{crypto_wallet_id}/tax_lots", tags=["Crypto Wallet"])
+async def read_crypto_tax_lots(crypto_wallet_id: int, asset: Optional[str] = None, open_only: bool = True,
+                               skip: int = 0, limit: int = 100):
+    """
+        List the tax lots of a crypto wallet, open lots only by default:
+
+    """
+    filters = {'crypto_wallet_id': crypto_wallet_id}
+    if asset:
+        filters['asset'] = asset.upper()
+    if open_only:
+        filters['remaining_quantity'] = {'>': 0}
+    return list(crypto_tax_lot_table.find(**filters, order_by=['asset', 'acquired_date', 'id'],
+                                          _offset=skip, _limit=limit))
+
+
+@app.get("/crypto_wallet/{crypto_wallet_id}/realized_gains", tags=["Crypto Wallet"])
+async def read_crypto_realized_gains(crypto_wallet_id: int, start_date: Optional[str] = None,
+                                     end_date: Optional[str] = None):
+    """
+        Sum realized gains and losses of a crypto wallet per asset over a date range:
+
+    """
+    rows = fetch_rows("SELECT asset, SUM(quantity), SUM(cost_basis), SUM(proceeds), SUM(realized_gain) "
+                      "FROM crypto_lot_disposal WHERE crypto_wallet_id = :crypto_wallet_id "
+                      "AND date >= :start_date AND date <= :end_date GROUP BY asset ORDER BY asset",
+                      crypto_wallet_id=crypto_wallet_id, start_date=start_date or '0000-01-01',
+                      end_date=end_date or '9999-12-31')
+    return [
+        {'asset': asset, 'quantity': quantity, 'cost_basis': round(cost_basis, 2), 'proceeds': round(proceeds, 2),
+         'realized_gain': round(realized_gain, 2)}
+        for asset, quantity, cost_basis, proceeds, realized_gain in rows
+    ]
+
+
+# FX rates and period-end revaluation of foreign currency balances
+fx_revaluation_table = db['fx_revaluation']
+monetary_account_types = [
+    AccountType.BANK.value,
+    AccountType.ACCOUNTS_RECEIVABLE.value,
+    AccountType.CURRENT_ASSET.value,
+    AccountType.ACCOUNTS_PAYABLE.value,
+    AccountType.CURRENT_LIABILITY.value,
+    AccountType.NON_CURRENT_LIABILITY.value,
+]
+
+
+def ensure_fx_revaluations():
+    for column, column_type in [('as_of', db.types.string), ('journal_entry_id', db.types.integer),
+                                ('reversal_journal_entry_id', db.types.integer),
+                                ('adjustment_count', db.types.integer), ('net_adjustment', db.types.float),
+                                ('last_updated_time', db.types.string)]:
+        fx_revaluation_table.create_column(column, column_type)
+    fx_revaluation_table.create_index(['as_of'])
+    journal_line_table.create_index(['currency', 'account_type', 'date'])
+
+
+on_database_open(ensure_fx_revaluations)
+
+
+def revalue_foreign_balances(as_of, gain_account_code, loss_account_code=None, reverse=True):
+    """
+        Restate every foreign currency balance of a monetary account at the as_of rate, posting the
+        unrealized gain or loss (and its reversal on the next day) in one transaction:
+
+    """
+    as_of = parse_iso_date(as_of, 'as_of').isoformat()
+    if fx_revaluation_table.find_one(as_of=as_of):
+        raise HTTPException(status_code=409, detail=f"Balances have already been revalued as of {as_of}")
+    placeholders = ', '.join(f":account_type_{index}" for index in range(len(monetary_account_types)))
+    totals = {}
+    for schema in journal_sources(None, as_of):
+        rows = fetch_rows(f"SELECT account_code, account_type, currency, SUM(amount), SUM(base_amount) "
+                          f"FROM {schema}.journal_line WHERE currency != :base_currency AND date <= :as_of "
+                          f"AND account_type IN ({placeholders}) "
+                          f"GROUP BY account_code, account_type, currency",
+                          base_currency=base_currency, as_of=as_of,
+                          **{f"account_type_{index}": account_type
+                             for index, account_type in enumerate(monetary_account_types)})
+        for account_code, account_type, currency, foreign_balance, booked_balance in rows:
+            total = totals.setdefault((account_code, account_type, currency), [0.0, 0.0])
+            total[0] += foreign_balance or 0
+            total[1] += booked_balance or 0
+    balances = [(*key, *total) for key, total in sorted(totals.items(), key=lambda item: (item[0][0], item[0][2]))]
+    journal_lines = []
+    missing_rates = set()
+    for account_code, account_type, currency, foreign_balance, booked_balance in balances:
+        exchange_rate = fx_rate_for(currency, as_of)
+        if exchange_rate is None:
+            missing_rates.add(currency)
+            continue
+        adjustment = round(foreign_balance * exchange_rate - booked_balance, 2)
+        if adjustment:
+            # kept in the foreign currency with no foreign amount, so the adjustment counts in the booked balance
+            # of the next revaluation and an unreversed one is not posted again
+            journal_lines.append({'account_code': account_code, 'account_type': account_type, 'amount': 0.0,
+                                  'currency': currency, 'exchange_rate': exchange_rate, 'base_amount': adjustment,
+                                  'posting_type': 'Debit' if adjustment > 0 else 'Credit',
+                                  'description': f"Revalue {currency} balance at {exchange_rate}"})
+    if missing_rates:
+        raise HTTPException(status_code=400, detail=f"No exchange rate as of {as_of} for {sorted(missing_rates)}")
+    net_adjustment = round(sum(line['base_amount'] for line in journal_lines), 2)
+    if net_adjustment > 0:
+        journal_lines.append({'account_code': gain_account_code, 'account_type': AccountType.OTHER_INCOME.value,
+                              'amount': -net_adjustment, 'posting_type': 'Credit'})
+    elif net_adjustment < 0:
+        journal_lines.append({'account_code': loss_account_code or gain_account_code,
+                              'account_type': AccountType.OTHER_EXPENSES.value,
+                              'amount': -net_adjustment, 'posting_type': 'Debit'})
+
+    revaluation_dict = {
+        'as_of': as_of,
+        'journal_entry_id': None,
+        'reversal_journal_entry_id': None,
+        'adjustment_count': len([line for line in journal_lines if line.get('description')]),
+        'net_adjustment': net_adjustment,
+        'last_updated_time': datetime.now(timezone.utc).isoformat(),
+    }
+    journal_entries = []
+    if journal_lines:
+        journal_entries.append({'date': as_of, 'description': f"Unrealized FX revaluation as of {as_of}",
+                                'posted': True, 'journal_type': None, 'validate_journal_type': False,
+                                'journal_lines': journal_lines})
+        if reverse:
+            reversal_date = date.fromordinal(date.fromisoformat(as_of).toordinal() + 1).isoformat()
+            journal_entries.append({
+                'date': reversal_date, 'description': f"Reverse unrealized FX revaluation as of {as_of}",
+                'posted': True, 'journal_type': None, 'validate_journal_type': False,
+                'journal_lines': [dict(line, amount=-line['amount'] or 0.0,
+                                       posting_type='Credit' if line['posting_type'] == 'Debit' else 'Debit',
+                                       **({'base_amount': -line['base_amount']} if 'base_amount' in line else {}))
+                                  for line in journal_lines],
+            })
+    with db:
+        journal_entry_ids = insert_journal_entries(journal_entries) + [None, None]
+        revaluation_dict['journal_entry_id'], revaluation_dict['reversal_journal_entry_id'] = journal_entry_ids[:2]
+        revaluation_dict['id'] = fx_revaluation_table.insert(revaluation_dict)
+    print(f"revalued {revaluation_dict['adjustment_count']} foreign balances as of {as_of}")
+    return revaluation_dict
+
+
+job_runners['fx_revaluation'] = lambda parameters: revalue_foreign_balances(**parameters)
+
+
+@app.post("/fx_rate/", tags=["FX Rate"])
+async def create_fx_rates(fx_rates_to_save: List[FxRate]):
+    """
+        Add or replace exchange rates, quoted as units of the base currency per unit of currency:
+
+    """
+    fx_rate_rows = [(fx_rate.currency.upper(), parse_iso_date(fx_rate.date, 'date').isoformat(), fx_rate.rate)
+                    for fx_rate in fx_rates_to_save]
+    save_fx_rates(fx_rate_rows)
+    return {'saved': len(fx_rate_rows), 'base_currency': base_currency}
+
+
+@app.post("/fx_rate/import", tags=["FX Rate"])
+async def import_fx_rates(request: Request):
+    """
+        Import a date,currency,rate CSV sent as the request body:
+
+    """
+    fx_rate_rows = parse_fx_rates_csv((await request.body()).decode('utf-8-sig'))
+    save_fx_rates(fx_rate_rows)
+    return {'saved': len(fx_rate_rows), 'base_currency': base_currency}
+
+
+@app.get("/fx_rate/query", tags=["FX Rate"])
+async def query_fx_rate(query: Optional[str] = None, skip: int = 0, limit: int = 10):
+    """
+        Query exchange rates using a sql statement:
+
+    """
+    if query:
+        print(f"The query is {query}")
+        result = list(db.query(query))
+        if result:
+            return result[skip: skip + limit]
+        else:
+            raise HTTPException(status_code=404, detail="FX Rate not found")
+
+
+@app.get("/fx_rate/{currency}", tags=["FX Rate"])
+async def read_fx_rate(currency: str, on_date: Optional[date] = None):
+    """
+        Read the rate of a currency in effect on a date (today by default):
+
+    """
+    on_date = on_date or datetime.now(timezone.utc).astimezone().date()
+    rate = fx_rate_for(currency.upper(), on_date.isoformat())
+    if rate is None:
+        raise HTTPException(status_code=404, detail="FX Rate not found")
+    return {'currency': currency.upper(), 'date': on_date.isoformat(), 'rate': rate, 'base_currency': base_currency}
+
+
+@app.post("/jobs/fx_revaluation", response_model=JobResponse, status_code=202, tags=["Jobs"])
+async def submit_fx_revaluation_job(fx_revaluation: FxRevaluation):
+    """
+        Queue a period-end revaluation of foreign currency balances to run in the background:
+
+    """
+    fx_revaluation_dict = fx_revaluation.dict()
+    fx_revaluation_dict['as_of'] = parse_iso_date(fx_revaluation_dict['as_of'], 'as_of').isoformat()
+    return submit_job('fx_revaluation', fx_revaluation_dict)
+
+
+# recurring journal entries: templates on cron-like day schedules, materialized in batches by an in-process scheduler
+recurring_journal_entry_table = db['recurring_journal_entry']
+recurring_schedule_aliases = {
+    '@daily': '* * *',
+    '@weekly': '* * 0',
+    '@monthly': '1 * *',
+    '@month_end': 'L * *',
+    '@quarterly': '1 1,4,7,10 *',
+    '@yearly': '1 1 *',
+    '@annually': '1 1 *',
+}
+# RECURRING_INTERVAL_SECONDS=0 turns the in-process scheduler off, POST /recurring_journal_entry/run still works
+recurring_interval_seconds = float(os.environ.get('RECURRING_INTERVAL_SECONDS', '3600'))
+recurring_lock = threading.Lock()
+recurring_scheduler_stop = threading.Event()
+
+
+def ensure_recurring_entries():
+    """
+        Create the recurring_journal_entry table and the columns tying generated journal entries to their template:
+
+    """
+    for column, column_type in [('description', db.types.text), ('journal_lines', db.types.text),
+                                ('journal_type', db.types.string), ('schedule', db.types.string),
+                                ('start_date', db.types.string), ('end_date', db.types.string),
+                                ('active', db.types.boolean), ('last_run_date', db.types.string),
+                                ('next_run_date', db.types.string), ('last_updated_time', db.types.string)]:
+        recurring_journal_entry_table.create_column(column, column_type)
+    recurring_journal_entry_table.create_index(['active', 'next_run_date'])
+    journal_entry_table.create_column('recurring_journal_entry_id', db.types.integer)
+    journal_entry_table.create_column('recurring_date', db.types.string)
+    with db:
+        # one journal entry per template and date, however often the scheduler or a catch-up run goes over it
+        db.query("CREATE UNIQUE INDEX IF NOT EXISTS ux_journal_entry_recurring "
+                 "ON journal_entry (recurring_date, recurring_journal_entry_id)")
+    schedule_recurring_entries()
+
+
+def schedule_recurring_entries():
+    """
+        Schedule the current tenant for the scheduler at the earliest next run date of its active templates:
+
+    """
+    next_run_date = fetch_rows("SELECT MIN(next_run_date) FROM recurring_journal_entry "
+                               "WHERE active AND next_run_date IS NOT NULL")[0][0]
+    schedule_tenant_work('recurring', next_run_date)
+
+
+on_database_open(ensure_recurring_entries)
+
+
+def parse_schedule_field(field, low, high, allow_last=False):
+    values = set()
+    for part in field.split(','):
+        if allow_last and part == 'L':
+            values.add('L')
+            continue
+        step = 1
+        if '/' in part:
+            part, step = part.split('/', 1)
+            step = int(step)
+        if part == '*':
+            start, stop = low, high
+        elif '-' in part:
+            start, stop = (int(bound) for bound in part.split('-', 1))
+        else:
+            start = int(part)
+            stop = high if step > 1 else start
+        if start < low or stop > high or start > stop or step < 1:
+            raise ValueError(field)
+        values.update(range(start, stop + 1, step))
+    return values
+
+
+def parse_schedule(schedule):
+    """
+        Parse a cron-like day schedule into (days of month, months, days of week, day of month restricted,
+        day of week restricted):
+
+    """
+    fields = recurring_schedule_aliases.get(schedule.strip().lower(), schedule).split()
+    if len(fields) == 5:
+        # minute and hour do not matter for journal entries, they are dated by day
+        fields = fields[2:]
+    try:
+        if len(fields) != 3:
+            raise ValueError(schedule)
+        days = parse_schedule_field(fields[0].upper(), 1, 31, allow_last=True)
+        months = parse_schedule_field(fields[1], 1, 12)
+        weekdays = {weekday % 7 for weekday in parse_schedule_field(fields[2], 0, 7)}
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid schedule {schedule}")
+    return days, months, weekdays, fields[0] != '*', fields[2] != '*'
+
+
+def schedule_matches(parsed_schedule, day):
+    days, months, weekdays, days_restricted, weekdays_restricted = parsed_schedule
+    if day.month not in months:
+        return False
+    day_matches = day.day in days or ('L' in days and date.fromordinal(day.toordinal() + 1).month != day.month)
+    weekday_matches = day.isoweekday() % 7 in weekdays
+    if days_restricted and weekdays_restricted:
+        # like cron, a day matches either restriction when both are given
+        return day_matches or weekday_matches
+    return day_matches and weekday_matches
+
+
+def schedule_occurrences(schedule, first, last):
+    """
+        Dates between first and last, both included, on which a schedule falls:
+
+    """
+    parsed_schedule = parse_schedule(schedule)
+    return [date.fromordinal(day) for day in range(first.toordinal(), last.toordinal() + 1)
+            if schedule_matches(parsed_schedule, date.fromordinal(day))]
+
+
+def next_occurrence(schedule, after, end_date=None):
+    """
+        First date after a given one on which a schedule falls, None past end_date:
+
+    """
+    parsed_schedule = parse_schedule(schedule)
+    # four years covers every valid schedule, 29 February included
+    last = after.toordinal() + 1461
+    if end_date:
+        last = min(last, date.fromisoformat(end_date).toordinal())
+    for day in range(after.toordinal() + 1, last + 1):
+        if schedule_matches(parsed_schedule, date.fromordinal(day)):
+            return date.fromordinal(day).isoformat()
+    return None
+
+
+def parse_iso_date(value, field):
+    try:
+        return date.fromisoformat(str(value))
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{field} must be a YYYY-MM-DD date, not {value}")
+
+
+def decode_recurring_entry(row):
+    row['journal_lines'] = load_json(row['journal_lines'])
+    return row
+
+
+def recurring_entry_dates(template, as_of, catch_up):
+    """
+        Occurrences of a template due by as_of, only the latest one unless catching up on missed periods:
+
+    """
+    if template['last_run_date']:
+        first = date.fromordinal(date.fromisoformat(template['last_run_date']).toordinal() + 1)
+    else:
+        first = date.fromisoformat(template['start_date'])
+    last = min(as_of, date.fromisoformat(template['end_date'])) if template['end_date'] else as_of
+    occurrences = schedule_occurrences(template['schedule'], first, last)
+    return occurrences if catch_up else occurrences[-1:]
+
+
+def generate_recurring_entries(as_of, catch_up=True, recurring_journal_entry_id=None):
+    """
+        Post every due occurrence of the active recurring entries up to as_of as one batch of journal entries:
+
+    """
+    with recurring_lock:
+        statement = ("SELECT * FROM recurring_journal_entry WHERE active "
+                     "AND next_run_date IS NOT NULL AND next_run_date <= :as_of")
+        params = {'as_of': as_of.isoformat()}
+        if recurring_journal_entry_id is not None:
+            statement += " AND id = :id"
+            params['id'] = recurring_journal_entry_id
+        due = [(template, recurring_entry_dates(template, as_of, catch_up))
+               for template in db.query(statement, **params)]
+        due = [(template, dates) for template, dates in due if dates]
+        existing = set()
+        closed_years = set()
+        if due:
+            first = min(dates[0] for template, dates in due).isoformat()
+            existing = set(fetch_rows("SELECT recurring_journal_entry_id, recurring_date FROM journal_entry "
+                                      "WHERE recurring_date BETWEEN :first AND :as_of "
+                                      "AND recurring_journal_entry_id IS NOT NULL", first=first, as_of=params['as_of']))
+            # one template catching up into an archived year must not fail the batch of every other template
+            closed_years = {row[0] for row in fetch_rows("SELECT year FROM journal_archive")}
+
+        journal_entry_dicts = []
+        template_updates = []
+        errors = []
+        for template, dates in due:
+            template_lines = load_json(template['journal_lines'])
+            template_entries = []
+            closed_dates = []
+            try:
+                for day in dates:
+                    if (template['id'], day.isoformat()) in existing:
+                        continue
+                    if fiscal_year_of(day) in closed_years:
+                        closed_dates.append(day.isoformat())
+                        continue
+                    journal_lines = [dict(line) for line in template_lines]
+                    validate_journal_lines(journal_lines, day.isoformat())
+                    template_entries.append({
+                        'date': day.isoformat(),
+                        'description': template['description'],
+                        'journal_lines': journal_lines,
+                        'posted': True,
+                        'journal_type': template['journal_type'],
+                        'validate_journal_type': False,
+                        'recurring_journal_entry_id': template['id'],
+                        'recurring_date': day.isoformat(),
+                    })
+            except HTTPException as error:
+                errors.append({'recurring_journal_entry_id': template['id'], 'detail': error.detail})
+                continue
+            if closed_dates:
+                errors.append({'recurring_journal_entry_id': template['id'],
+                               'detail': f"Skipped {closed_dates}, their fiscal years are closed and archived"})
+            journal_entry_dicts.extend(template_entries)
+            template_updates.append((dates[-1].isoformat(),
+                                     next_occurrence(template['schedule'], dates[-1], template['end_date']),
+                                     template['id']))
+
+        with db:
+            journal_entry_ids = insert_journal_entries(journal_entry_dicts) if journal_entry_dicts else []
+            execute_many("UPDATE recurring_journal_entry SET last_run_date = ?, next_run_date = ? WHERE id = ?",
+                         template_updates)
+        schedule_recurring_entries()
+    print(f"posted {len(journal_entry_ids)} recurring journal entries for {len(template_updates)} templates")
+    return {
+        'as_of': as_of.isoformat(),
+        'catch_up': catch_up,
+        'templates': len(template_updates),
+        'journal_entries': len(journal_entry_ids),
+        'first_journal_entry_id': journal_entry_ids[0] if journal_entry_ids else None,
+        'last_journal_entry_id': journal_entry_ids[-1] if journal_entry_ids else None,
+        'errors': errors,
+    }
+
+
+def today():
+    return datetime.now(timezone.utc).astimezone().date()
+
+
+def run_recurring_scheduler(stop):
+    """
+        Generate the due recurring entries of the default database and every tenant with a template due, opening
+        tenants evicted from the cache, then sleep an interval:
+
+    """
+    while True:
+        for tenant in tenants_with_work('recurring', today().isoformat()):
+            try:
+                with tenant_databases.use(tenant):
+                    generate_recurring_entries(today())
+            except Exception as error:
+                print(f"recurring journal entries of tenant {tenant} failed: {error}")
+        if stop.wait(recurring_interval_seconds):
+            return
+
+
+@app.on_event("startup")
+def start_recurring_scheduler():
+    global recurring_scheduler_stop
+    if recurring_interval_seconds <= 0:
+        return
+    # every start gets its own stop event, a scheduler still finishing a batch from a previous start then exits
+    recurring_scheduler_stop = threading.Event()
+    threading.Thread(target=run_recurring_scheduler, args=(recurring_scheduler_stop,), name='recurring-scheduler',
+                     daemon=True).start()
+
+
+@app.on_event("shutdown")
+def stop_recurring_scheduler():
+    recurring_scheduler_stop.set()
+
+
+@app.post("/recurring_journal_entry/", tags=["Recurring Journal Entry"])
+async def create_recurring_journal_entry(recurring_journal_entry: RecurringJournalEntry):
+    """
+        Create a recurring journal entry template, its lines are checked like a journal entry on the start date:
+
+    """
+    recurring_dict = recurring_journal_entry.dict()
+    recurring_dict['start_date'] = recurring_dict['start_date'] or today().isoformat()
+    start_date = parse_iso_date(recurring_dict['start_date'], 'start_date')
+    if recurring_dict['end_date']:
+        parse_iso_date(recurring_dict['end_date'], 'end_date')
+    validate_journal_lines([dict(line) for line in recurring_dict['journal_lines']], recurring_dict['start_date'])
+    recurring_dict['journal_type'] = recurring_journal_entry.journal_type.value \
+        if recurring_journal_entry.journal_type else None
+    recurring_dict['last_run_date'] = None
+    recurring_dict['next_run_date'] = next_occurrence(recurring_dict['schedule'],
+                                                      date.fromordinal(start_date.toordinal() - 1),
+                                                      recurring_dict['end_date'])
+    recurring_dict['last_updated_time'] = datetime.now(timezone.utc).isoformat()
+    json_recurring_dict = dict(recurring_dict, journal_lines=dump_json(recurring_dict['journal_lines']))
+    recurring_dict['id'] = recurring_journal_entry_table.insert(json_recurring_dict)
+    schedule_recurring_entries()
+    return recurring_dict
+
+
+@app.get("/recurring_journal_entry/query", tags=["Recurring Journal Entry"])
+async def query_recurring_journal_entry(query: Optional[str] = None, skip: int = 0, limit: int = 10):
+    """
+        Query recurring journal entry templates using a sql statement:
+
+    """
+    if query:
+        final_results = [decode_recurring_entry(row) for row in db.query(query)]
+        if final_results:
+            return final_results[skip: skip + limit]
+        raise HTTPException(status_code=404, detail="Recurring Journal Entry not found")
+
+
+@app.post("/recurring_journal_entry/run", tags=["Recurring Journal Entry"])
+def run_recurring_journal_entries(as_of: Optional[date] = None, catch_up: bool = True):
+    """
+        Post the recurring journal entries due by as_of (default today) in one batch, catch_up also posts the
+        periods missed since the last run, already posted dates are skipped:
+
+    """
+    return generate_recurring_entries(as_of or today(), catch_up)
+
+
+@app.get("/recurring_journal_entry/{recurring_journal_entry_id}", tags=["Recurring Journal Entry"])
+async def read_recurring_journal_entry(recurring_journal_entry_id: int):
+    """
+        Read a recurring journal entry template:
+
+    """
+    recurring_journal_entry = recurring_journal_entry_table.find_one(id=recurring_journal_entry_id)
+    if recurring_journal_entry:
+        return decode_recurring_entry(recurring_journal_entry)
+    else:
+        raise HTTPException(status_code=404, detail="Recurring Journal Entry not found")
+
+
+@app.put("/recurring_journal_entry/{recurring_journal_entry_id}", tags=["Recurring Journal Entry"])
+async def update_recurring_journal_entry(recurring_journal_entry_id: int,
+                                         recurring_journal_entry: UpdateRecurringJournalEntry):
+    """
+        Update a recurring journal entry template, dates already posted are never posted again:
+
+    """
+    template = recurring_journal_entry_table.find_one(id=recurring_journal_entry_id)
+    if not template:
+        raise HTTPException(status_code=404, detail="Recurring Journal Entry not found")
+    recurring_dict = recurring_journal_entry.dict(exclude_unset=True)
+    if recurring_dict.get('journal_lines'):
+        validate_journal_lines([dict(line) for line in recurring_dict['journal_lines']],
+                               template['last_run_date'] or template['start_date'])
+        recurring_dict['journal_lines'] = dump_json(recurring_dict['journal_lines'])
+    if recurring_dict.get('end_date'):
+        parse_iso_date(recurring_dict['end_date'], 'end_date')
+    if 'journal_type' in recurring_dict:
+        recurring_dict['journal_type'] = recurring_journal_entry.journal_type.value \
+            if recurring_journal_entry.journal_type else None
+    template.update(recurring_dict)
+    after = date.fromisoformat(template['last_run_date']) if template['last_run_date'] else \
+        date.fromordinal(date.fromisoformat(template['start_date']).toordinal() - 1)
+    template['next_run_date'] = next_occurrence(template['schedule'], after, template['end_date'])
+    template['last_updated_time'] = datetime.now(timezone.utc).isoformat()
+    recurring_journal_entry_table.update(template, ['id'])
+    schedule_recurring_entries()
+    return decode_recurring_entry(template)
+
+
+@app.delete("/recurring_journal_entry/{recurring_journal_entry_id}", tags=["Recurring Journal Entry"])
+async def delete_recurring_journal_entry(recurring_journal_entry_id: int):
+    """
+        Delete a recurring journal entry template, the journal entries it posted stay:
+
+    """
+    if recurring_journal_entry_table.find_one(id=recurring_journal_entry_id):
+        recurring_journal_entry_table.delete(id=recurring_journal_entry_id)
+        schedule_recurring_entries()
+        return {"message": f"Recurring Journal Entry with id {recurring_journal_entry_id} has been deleted"}
+    else:
+        raise HTTPException(status_code=404, detail="Recurring Journal Entry not found")
+
+
+@app.post("/recurring_journal_entry/{recurring_journal_entry_id}/run", tags=["Recurring Journal Entry"])
+def run_recurring_journal_entry(recurring_journal_entry_id: int, as_of: Optional[date] = None,
+                                catch_up: bool = True):
+    """
+        Post the due occurrences of one recurring journal entry template:
+
+    """
+    if not recurring_journal_entry_table.find_one(id=recurring_journal_entry_id):
+        raise HTTPException(status_code=404, detail="Recurring Journal Entry not found")
+    return generate_recurring_entries(as_of or today(), catch_up, recurring_journal_entry_id)
+
+
+# cold storage: the journal of a closed fiscal year moves to its own SQLite file, attached only by reads that reach it
+fiscal_year_start_month = int(os.environ.get('FISCAL_YEAR_START_MONTH', '1'))
+# SQLite attaches at most 10 databases per connection, older archives are detached past this many
+archive_max_attached = int(os.environ.get('ARCHIVE_MAX_ATTACHED', '8'))
+journal_archive_table = db['journal_archive']
+archived_tables = ['journal_entry', 'journal_line', 'journal_line_dimension', 'journal_tax_line']
+archive_indexes = {
+    'journal_entry': [['date']],
+    'journal_line': [['journal_entry_id'], ['account_type', 'date'], ['currency', 'account_type', 'date']],
+    'journal_line_dimension': [['journal_entry_id', 'line_number', 'dimension'], ['dimension', 'value']],
+    'journal_tax_line': [['journal_entry_id'], ['tax_code', 'date'], ['date']],
+}
+archive_lock = threading.Lock()
+# journal_archive column with the highest id moved out of each archived table
+archived_id_columns = {'journal_entry': 'max_id', 'journal_line': 'max_line_id',
+                       'journal_line_dimension': 'max_line_dimension_id', 'journal_tax_line': 'max_tax_line_id'}
+
+
+class ArchiveStatus(str, Enum):
+    COPYING = "COPYING"
+    ARCHIVED = "ARCHIVED"
+
+
+def ensure_journal_archives():
+    """
+        Create the journal_archive table listing the archived fiscal years and the rows moved out of each:
+
+    """
+    journal_archive_columns = {
+        'year': db.types.integer,
+        'start_date': db.types.string,
+        'end_date': db.types.string,
+        'status': db.types.string,
+        'entry_count': db.types.integer,
+        'line_count': db.types.integer,
+        'min_id': db.types.integer,
+        'max_id': db.types.integer,
+        'max_line_id': db.types.integer,
+        'max_line_dimension_id': db.types.integer,
+        'max_tax_line_id': db.types.integer,
+        'archived_time': db.types.string,
+    }
+    for column, column_type in journal_archive_columns.items():
+        journal_archive_table.create_column(column, column_type)
+    journal_archive_table.create_index(['year'])
+
+
+on_database_open(ensure_journal_archives)
+
+
+def fiscal_year_dates(year):
+    """
+        First and last day of a fiscal year, named after the calendar year it ends in:
+
+    """
+    if fiscal_year_start_month == 1:
+        return date(year, 1, 1), date(year, 12, 31)
+    return date(year - 1, fiscal_year_start_month, 1), \
+        date.fromordinal(date(year, fiscal_year_start_month, 1).toordinal() - 1)
+
+
+def fiscal_year_of(value):
+    on_date = parse_iso_date(str(value)[:10], 'date')
+    if fiscal_year_start_month == 1 or on_date.month < fiscal_year_start_month:
+        return on_date.year
+    return on_date.year + 1
+
+
+def archive_file(year):
+    """
+        Archive file of a fiscal year, next to the primary database of the tenant:
+
+    """
+    primary_path = tenant_databases.entry(current_tenant.get())['database'].engine.url.database
+    return os.path.join(f"{primary_path}.archive", f"journal_{year}.db")
+
+
+def attach_archive(year):
+    """
+        Attach the archive of a fiscal year to the current connection, unless it already is, before any write of
+        the transaction:
+
+    """
+    schema = f"archive_{int(year)}"
+    connection = db.executable
+    attached = [row[1] for row in connection.exec_driver_sql("PRAGMA database_list").fetchall()
+                if row[1].startswith('archive_')]
+    if schema in attached:
+        return schema
+    for stale_schema in attached[:max(len(attached) - archive_max_attached + 1, 0)]:
+        connection.exec_driver_sql(f"DETACH DATABASE {stale_schema}")
+    connection.exec_driver_sql(f"ATTACH DATABASE ? AS {schema}", (archive_file(year),))
+    return schema
+
+
+def archive_max_ids(schema):
+    """
+        Highest id of each journal table in an attached archive, as journal_archive columns:
+
+    """
+    tables = {row[0] for row in fetch_rows(f"SELECT name FROM {schema}.sqlite_master WHERE type = 'table'")}
+    return {column: (fetch_rows(f"SELECT MAX(id) FROM {schema}.{table_name}")[0][0] if table_name in tables else 0) or 0
+            for table_name, column in archived_id_columns.items()}
+
+
+def backfill_archive_max_ids():
+    """
+        Record the highest archived ids of the fiscal years archived before journal_archive kept them per table:
+
+    """
+    for archive_row in list(journal_archive_table.find(status=ArchiveStatus.ARCHIVED.value, max_line_id=None)):
+        with db:
+            max_ids = archive_max_ids(attach_archive(archive_row['year']))
+            journal_archive_table.update(dict(max_ids, year=archive_row['year']), ['year'])
+
+
+on_database_open(backfill_archive_max_ids)
+
+
+def keep_archived_ids(table_name, rows):
+    """
+        Start the new rows of a journal table above the ids moved to archives, without AUTOINCREMENT SQLite hands
+        out the ids above the hot maximum again and bank statement matches and export keysets would point at them:
+
+    """
+    new_rows = [row for row in rows if not row.get('id')]
+    if not new_rows:
+        return
+    archived_max_id = fetch_rows(f"SELECT MAX({archived_id_columns[table_name]}) FROM journal_archive")[0][0]
+    if archived_max_id and archived_max_id >= (fetch_rows(f"SELECT MAX(id) FROM {table_name}")[0][0] or 0):
+        new_rows[0]['id'] = archived_max_id + 1
+
+
+def journal_sources(start_date=None, end_date=None):
+    """
+        Schemas holding the journal rows of a date range: main, then the archived fiscal years the range reaches
+        into, each attached just before it is read, so current-period reads never open an archive file:
+
+    """
+    yield 'main'
+    conditions = ["status = :status"]
+    params = {'status': ArchiveStatus.ARCHIVED.value}
+    if start_date:
+        conditions.append("end_date >= :start_date")
+        params['start_date'] = str(start_date)
+    if end_date:
+        conditions.append("start_date <= :end_date")
+        params['end_date'] = str(end_date)
+    years = fetch_rows(f"SELECT year FROM journal_archive WHERE {' AND '.join(conditions)} ORDER BY year", **params)
+    for (year,) in years:
+        yield attach_archive(year)
+
+
+def journal_entries_between(start_date, end_date):
+    """
+        Journal entry rows dated between start_date and end_date, the hot database first, then the archives:
+
+    """
+    for schema in journal_sources(start_date, end_date):
+        if schema == 'main':
+            yield from journal_entry_table.find(date={'between': [start_date, end_date]})
+        else:
+            yield from db.query(f"SELECT * FROM {schema}.journal_entry WHERE date BETWEEN :start_date AND :end_date",
+                                start_date=None if start_date is None else str(start_date),
+                                end_date=None if end_date is None else str(end_date))
+
+
+def read_archived_journal_entry(journal_entry_id):
+    """
+        Find a journal entry in the archive whose id range holds it:
+
+    """
+    years = fetch_rows("SELECT year FROM journal_archive WHERE status = :status AND min_id <= :id AND max_id >= :id",
+                       status=ArchiveStatus.ARCHIVED.value, id=journal_entry_id)
+    for (year,) in years:
+        schema = attach_archive(year)
+        for row in db.query(f"SELECT * FROM {schema}.journal_entry WHERE id = :id", id=journal_entry_id):
+            return row
+    return None
+
+
+def read_archived_journal_entries(journal_entry_ids):
+    """
+        Find many journal entries in the archives whose id ranges hold them, one query per archive:
+
+    """
+    found = {}
+    archives = fetch_rows("SELECT year, min_id, max_id FROM journal_archive WHERE status = :status",
+                          status=ArchiveStatus.ARCHIVED.value)
+    for year, min_id, max_id in archives:
+        ids = [journal_entry_id for journal_entry_id in journal_entry_ids
+               if min_id is not None and min_id <= journal_entry_id <= max_id and journal_entry_id not in found]
+        if not ids:
+            continue
+        schema = attach_archive(year)
+        params = {f"id_{index}": journal_entry_id for index, journal_entry_id in enumerate(ids)}
+        for row in db.query(f"SELECT * FROM {schema}.journal_entry WHERE id IN "
+                            f"({', '.join(f':{name}' for name in params)})", **params):
+            found[row['id']] = row
+    return found
+
+
+def check_open_fiscal_years(dates):
+    """
+        Refuse writes dated in a fiscal year that is archived or being archived:
+
+    """
+    years = sorted({fiscal_year_of(on_date) for on_date in dates if on_date})
+    if not years:
+        return
+    params = {f"year_{index}": year for index, year in enumerate(years)}
+    closed_years = fetch_rows(f"SELECT year FROM journal_archive WHERE year IN "
+                              f"({', '.join(f':{name}' for name in params)})", **params)
+    if closed_years:
+        raise HTTPException(status_code=409,
+                            detail=f"Fiscal year {closed_years[0][0]} is closed and archived, it cannot be changed")
+
+
+def prepare_archive_tables(year):
+    """
+        Create the archive tables like the hot ones, adding the columns the hot tables gained since:
+
+    """
+    with db:
+        schema = attach_archive(year)
+        for table_name in archived_tables:
+            db.query(f"CREATE TABLE IF NOT EXISTS {schema}.{table_name} AS SELECT * FROM main.{table_name} WHERE 0")
+            archived_columns = {row[1] for row in fetch_rows(f"PRAGMA {schema}.table_info({table_name})")}
+            for row in fetch_rows(f"PRAGMA main.table_info({table_name})"):
+                if row[1] not in archived_columns:
+                    db.query(f'ALTER TABLE {schema}.{table_name} ADD COLUMN "{row[1]}" {row[2]}')
+            db.query(f"CREATE UNIQUE INDEX IF NOT EXISTS {schema}.ux_{table_name}_id ON {table_name} (id)")
+            for columns in archive_indexes[table_name]:
+                db.query(f"CREATE INDEX IF NOT EXISTS {schema}.ix_{table_name}_{'_'.join(columns)} "
+                         f"ON {table_name} ({', '.join(columns)})")
+
+
+def archive_fiscal_year(year, vacuum=False):
+    """
+        Move the journal of a closed fiscal year into its archive file. Rows are copied and committed to the archive
+        first and deleted from the hot database second, so an interruption leaves them readable in the hot database
+        and a rerun finishes the move:
+
+    """
+    year = int(year)
+    start_date, end_date = fiscal_year_dates(year)
+    if end_date >= today():
+        raise HTTPException(status_code=409, detail=f"Fiscal year {year} ends on {end_date} and is not closed yet")
+    with archive_lock:
+        archive_row = journal_archive_table.find_one(year=year)
+        if archive_row and archive_row['status'] == ArchiveStatus.ARCHIVED.value:
+            raise HTTPException(status_code=409, detail=f"Fiscal year {year} is already archived")
+        if archive_row is None:
+            # from here on postings dated in the year are refused, the copy cannot miss them
+            journal_archive_table.insert({'year': year, 'start_date': str(start_date), 'end_date': str(end_date),
+                                          'status': ArchiveStatus.COPYING.value})
+        os.makedirs(os.path.dirname(archive_file(year)), exist_ok=True)
+        prepare_archive_tables(year)
+        entry_ids = "SELECT id FROM main.journal_entry WHERE date BETWEEN :start_date AND :end_date"
+        params = {'start_date': str(start_date), 'end_date': str(end_date)}
+        # a commit hands the connection back to the pool, attach again on whichever one each transaction gets
+        with db:
+            schema = attach_archive(year)
+            for table_name in archived_tables:
+                column_list = ', '.join(f'"{row[1]}"' for row in fetch_rows(f"PRAGMA main.table_info({table_name})"))
+                condition = "date BETWEEN :start_date AND :end_date" if table_name == 'journal_entry' \
+                    else f"journal_entry_id IN ({entry_ids})"
+                db.query(f"INSERT OR REPLACE INTO {schema}.{table_name} ({column_list}) "
+                         f"SELECT {column_list} FROM main.{table_name} WHERE {condition}", **params)
+        with db:
+            schema = attach_archive(year)
+            for table_name in reversed(archived_tables):
+                key = 'id' if table_name == 'journal_entry' else 'journal_entry_id'
+                db.query(f"DELETE FROM main.{table_name} WHERE {key} IN (SELECT id FROM {schema}.journal_entry)")
+            entry_count, min_id = fetch_rows(f"SELECT COUNT(*), MIN(id) FROM {schema}.journal_entry")[0]
+            line_count = fetch_rows(f"SELECT COUNT(*) FROM {schema}.journal_line")[0][0]
+            journal_archive_table.update(dict(archive_max_ids(schema), year=year,
+                                              status=ArchiveStatus.ARCHIVED.value, entry_count=entry_count,
+                                              line_count=line_count, min_id=min_id,
+                                              archived_time=datetime.now(timezone.utc).isoformat()), ['year'])
+        if vacuum:
+            # hand the freed pages back to the file system, this rewrites the whole hot database
+            db.executable.exec_driver_sql("VACUUM")
+    print(f"archived {entry_count} journal entries of fiscal year {year} to {archive_file(year)}")
+    return dict(journal_archive_table.find_one(year=year), path=archive_file(year))
+
+
+job_runners['archive'] = lambda parameters: archive_fiscal_year(**parameters)
+
+
+@app.post("/jobs/archive/{year}", response_model=JobResponse, status_code=202, tags=["Jobs"])
+async def submit_archive_job(year: int, vacuum: bool = False):
+    """
+        Queue the move of a closed fiscal year into its archive file:
+
+    """
+    start_date, end_date = fiscal_year_dates(year)
+    if end_date >= today():
+        raise HTTPException(status_code=409, detail=f"Fiscal year {year} ends on {end_date} and is not closed yet")
+    if journal_archive_table.find_one(year=year, status=ArchiveStatus.ARCHIVED.value):
+        raise HTTPException(status_code=409, detail=f"Fiscal year {year} is already archived")
+    return submit_job('archive', {'year': year, 'vacuum': vacuum})
+
+
+@app.get("/admin/archives", tags=["Admin"])
+async def read_journal_archives():
+    """
+        List the archived fiscal years, with the rows moved out of the hot database:
+
+    """
+    return [dict(row, path=archive_file(row['year'])) for row in journal_archive_table.find(order_by='year')]
+
+
+def archive_command(arguments):
+    """
+        Command line archive of closed fiscal years, e.g. `python main.py archive 2019 2020 --vacuum`:
+
+    """
+    parser = argparse.ArgumentParser(prog='main.py archive',
+                                     description='Move the journal of closed fiscal years into archive files')
+    parser.add_argument('years', type=int, nargs='+')
+    parser.add_argument('--vacuum', action='store_true')
+    parser.add_argument('--tenant', default=None)
+    options = parser.parse_args(arguments)
+
+    with tenant_databases.use(options.tenant):
+        for year in sorted(options.years):
+            try:
+                archive_fiscal_year(year, vacuum=options.vacuum and year == max(options.years))
+            except HTTPException as error:
+                print(f"fiscal year {year} not archived: {error.detail}")
+
+
+# sales tax (GST/VAT): tax codes with rates, tax lines added on posting and a summary of tax per code and period
+tax_report_periods = {
+    TaxPeriod.MONTH: "substr(t.date, 1, 7)",
+    TaxPeriod.QUARTER: "substr(t.date, 1, 4) || '-Q' || ((CAST(substr(t.date, 6, 2) AS INTEGER) + 2) / 3)",
+    TaxPeriod.YEAR: "substr(t.date, 1, 4)",
+}
+# tax codes of these types are tax paid on purchases and imports, the others tax collected on sales
+claimable_tax_types = {TaxType.INPUT.value, TaxType.GSTONIMPORTS.value}
+
+
+def tax_codes():
+    """
+        Tax codes of the current tenant by code, cached in memory until one is written:
+
+    """
+    cache = tenant_cache('tax_codes')
+    if 'codes' not in cache:
+        cache['codes'] = {row['code']: row for row in tax_code_table.find()}
+    return cache['codes']
+
+
+def apply_tax_codes(journal_lines, line_amount_types=None):
+    """
+        Compute the tax of every line with a tax code, or whose account has a tax type that is a tax code, and add
+        a SALES_TAX line after it, replacing the tax lines of an earlier posting. Amounts are net of tax unless
+        line_amount_types is INCLUSIVE, then the tax is taken out of the line amount. A line that already carries a
+        tax_amount was posted before and is net, its gross amount is the two added up:
+
+    """
+    lines = [line for line in journal_lines if not line.get('tax_line')]
+    for line in lines:
+        if line_amount_types == LineAmountTypes.INCLUSIVE and line.get('tax_amount') is not None:
+            line['amount'] = round(line['amount'] + line['tax_amount'], 2)
+        line.update(tax_rate=None, tax_amount=None)
+    journal_lines[:] = lines
+    codes = tax_codes()
+    if not codes or line_amount_types == LineAmountTypes.NO_TAX:
+        for line in lines:
+            line['tax_code'] = None
+        return
+    untagged_accounts = sorted({str(line['account_code']) for line in lines if not line.get('tax_code')})
+    account_tax_types = {}
+    if untagged_accounts:
+        params = {f"account_code_{index}": code for index, code in enumerate(untagged_accounts)}
+        account_tax_types = dict(fetch_rows(f"SELECT account_code, tax_type FROM account WHERE account_code IN "
+                                            f"({', '.join(f':{name}' for name in params)})", **params))
+    taxed_lines = []
+    for line in lines:
+        taxed_lines.append(line)
+        code = line.get('tax_code') or account_tax_types.get(str(line['account_code']))
+        if not code or (not line.get('tax_code') and code not in codes):
+            continue
+        tax_code = codes.get(code)
+        if tax_code is None or not tax_code['active']:
+            raise HTTPException(status_code=400, detail=f"Unknown or inactive tax code {code}")
+        rate = tax_code['rate'] or 0.0
+        if line_amount_types == LineAmountTypes.INCLUSIVE:
+            tax = round(line['amount'] * rate / (100 + rate), 2)
+            line['amount'] = round(line['amount'] - tax, 2)
+        else:
+            tax = round(line['amount'] * rate / 100, 2)
+        line.update(tax_code=code, tax_rate=rate, tax_amount=tax)
+        if tax:
+            taxed_lines.append({'account_code': tax_code['tax_account_code'],
+                                'account_type': AccountType.SALES_TAX.value, 'amount': tax,
+                                'posting_type': 'Debit' if tax > 0 else 'Credit',
+                                'currency': line.get('currency'), 'exchange_rate': line.get('exchange_rate'),
+                                'dimensions': line.get('dimensions'), 'tax_code': code, 'tax_rate': rate,
+                                'tax_amount': None, 'tax_line': True})
+    journal_lines[:] = taxed_lines
+
+
+def check_tax_code(tax_code_dict):
+    if tax_code_dict.get('rate') is not None and tax_code_dict['rate'] < 0:
+        raise HTTPException(status_code=400, detail="rate must not be negative")
+    if tax_code_dict.get('rate') and not tax_code_dict.get('tax_account_code'):
+        raise HTTPException(status_code=400, detail="A tax code with a rate needs the tax_account_code to post to")
+
+
+@app.post("/tax_code/", tags=["Tax Code"])
+async def create_tax_code(tax_code: TaxCode):
+    """
+        Create a tax code, a code named like an account tax_type (OUTPUT, INPUT, GSTONIMPORTS) is applied to the
+        lines of those accounts that carry no tax_code:
+
+    """
+    tax_code_dict = tax_code.dict()
+    if tax_code_dict['code'] in tax_codes():
+        raise HTTPException(status_code=409, detail=f"Tax code {tax_code_dict['code']} already exists")
+    if tax_code_dict['tax_type'] is None:
+        if tax_code_dict['code'] not in [tax_type.value for tax_type in TaxType]:
+            raise HTTPException(status_code=400, detail="tax_type is required for a custom tax code")
+        tax_code_dict['tax_type'] = TaxType(tax_code_dict['code'])
+    check_tax_code(tax_code_dict)
+    tax_code_dict['tax_type'] = tax_code_dict['tax_type'].value
+    tax_code_dict['last_updated_time'] = datetime.now(timezone.utc).isoformat()
+    tax_code_dict['id'] = tax_code_table.insert(tax_code_dict)
+    tenant_cache('tax_codes').clear()
+    return tax_code_dict
+
+
+@app.get("/tax_code/query", tags=["Tax Code"])
+async def query_tax_code(query: Optional[str] = None, skip: int = 0, limit: int = 10):
+    """
+        Query tax codes using a sql statement:
+
+    """
+    if query:
+        final_results = list(db.query(query))
+        if final_results:
+            return final_results[skip: skip + limit]
+        raise HTTPException(status_code=404, detail="Tax Code not found")
+
+
+@app.get("/tax_code/{code}", tags=["Tax Code"])
+async def read_tax_code(code: str):
+    """
+        Read a tax code:
+
+    """
+    tax_code = tax_code_table.find_one(code=code)
+    if tax_code:
+        return tax_code
+    else:
+        raise HTTPException(status_code=404, detail="Tax Code not found")
+
+
+@app.put("/tax_code/{code}", tags=["Tax Code"])
+async def update_tax_code(code: str, tax_code: UpdateTaxCode):
+    """
+        Update a tax code, entries already posted keep the tax computed at the old rate:
+
+    """
+    stored_tax_code = tax_code_table.find_one(code=code)
+    if not stored_tax_code:
+        raise HTTPException(status_code=404, detail="Tax Code not found")
+    stored_tax_code.update(tax_code.dict(exclude_unset=True))
+    check_tax_code(stored_tax_code)
+    if isinstance(stored_tax_code['tax_type'], TaxType):
+        stored_tax_code['tax_type'] = stored_tax_code['tax_type'].value
+    stored_tax_code['last_updated_time'] = datetime.now(timezone.utc).isoformat()
+    tax_code_table.update(stored_tax_code, ['id'])
+    tenant_cache('tax_codes').clear()
+    return stored_tax_code
+
+
+@app.delete("/tax_code/{code}", tags=["Tax Code"])
+async def delete_tax_code(code: str):
+    """
+        Delete a tax code, the tax lines already posted with it stay in the tax summary:
+
+    """
+    if tax_code_table.find_one(code=code):
+        tax_code_table.delete(code=code)
+        tenant_cache('tax_codes').clear()
+        return {"message": f"Tax Code {code} has been deleted"}
+    else:
+        raise HTTPException(status_code=404, detail="Tax Code not found")
+
+
+def aggregate_tax_lines(start_date, end_date, period=None):
+    """
+        Sum the taxable amounts and tax of the tax lines per period and tax code, in SQL on each journal source:
+
+    """
+    conditions = []
+    params = {}
+    if start_date:
+        conditions.append("t.date >= :start_date")
+        params['start_date'] = str(start_date)
+    if end_date:
+        conditions.append("t.date <= :end_date")
+        params['end_date'] = str(end_date)
+    where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+    period_expression = tax_report_periods.get(period, "NULL")
+    totals = {}
+    for schema in journal_sources(start_date, end_date):
+        if schema != 'main' and not fetch_rows(f"SELECT 1 FROM {schema}.sqlite_master "
+                                               f"WHERE type = 'table' AND name = 'journal_tax_line'"):
+            # archived before tax lines were recorded
+            continue
+        rows = fetch_rows(f"SELECT {period_expression} AS period, t.tax_code, SUM(t.taxable_amount), "
+                          f"SUM(t.tax_amount), COUNT(*) FROM {schema}.journal_tax_line t {where}"
+                          f"GROUP BY period, t.tax_code", **params)
+        for row_period, code, taxable_amount, tax_amount, line_count in rows:
+            total = totals.setdefault((row_period, code), [0.0, 0.0, 0])
+            total[0] += taxable_amount or 0
+            total[1] += tax_amount or 0
+            total[2] += line_count
+    return sorted(((*key, *total) for key, total in totals.items()), key=lambda row: (row[0] or '', row[1]))
+
+
+def tax_summary_report(start_date: Optional[date] = None, end_date: Optional[date] = None,
+                       period: Optional[TaxPeriod] = None):
+    """
+        Build the tax summary: taxable amount and tax per tax code, one section per period, tax collected on sales
+        and tax paid on purchases shown as positive amounts:
+
+    """
+    report_timer = StageTimer(report_stage_seconds, report='tax_summary')
+    report_timer.switch('fetch')
+    rows = aggregate_tax_lines(start_date, end_date, period)
+    report_timer.switch('render')
+    codes = tax_codes()
+
+    def tax_row(code, taxable_amount, tax_amount, line_count):
+        tax_code = codes.get(code) or {}
+        claimable = tax_code.get('tax_type') in claimable_tax_types
+        # tax collected is posted as a credit, flip it so both directions read as positive amounts
+        sign = 1 if claimable else -1
+        return {"ColData": [{"id": code, "value": tax_code.get('name') or code},
+                            {"value": f"{tax_code.get('rate')}"},
+                            {"value": f"{round(sign * taxable_amount, 2)}"},
+                            {"value": f"{round(sign * tax_amount, 2)}"}],
+                "type": "Data", "tax_type": tax_code.get('tax_type'), "line_count": line_count,
+                "direction": "paid" if claimable else "collected"}
+
+    def total_row(title, data_rows):
+        collected = sum(float(row["ColData"][3]["value"]) for row in data_rows if row["direction"] == "collected")
+        paid = sum(float(row["ColData"][3]["value"]) for row in data_rows if row["direction"] == "paid")
+        return {"ColData": [{"value": title}, {"value": ""}, {"value": ""}, {"value": f"{round(collected - paid, 2)}"}],
+                "tax_collected": round(collected, 2), "tax_paid": round(paid, 2),
+                "net_tax_payable": round(collected - paid, 2)}
+
+    all_rows = [tax_row(code, taxable_amount, tax_amount, line_count)
+                for row_period, code, taxable_amount, tax_amount, line_count in rows]
+    report_rows = []
+    if period:
+        for row_period in sorted({row[0] for row in rows}, key=lambda value: value or ''):
+            data_rows = [data_row for data_row, row in zip(all_rows, rows) if row[0] == row_period]
+            report_rows.append({"Header": {"ColData": [{"value": row_period}, {"value": ""}, {"value": ""},
+                                                       {"value": ""}]},
+                                "Rows": {"Row": data_rows}, "type": "Section", "group": f"period:{row_period}",
+                                "Summary": total_row(f"Net Tax {row_period}", data_rows)})
+    else:
+        report_rows.extend(all_rows)
+    report_rows.append({"type": "Section", "group": "GrandTotal", "Summary": total_row("Net Tax Payable", all_rows)})
+    tax_summary = {
+        "Header": report_header("TaxSummary", start_date, end_date, period.value if period else "Total"),
+        "Rows": {"Row": report_rows},
+        "Columns": {
+            "Column": [report_column("Account", "Tax Code", "tax_code"), report_column("Rate", "Rate", "rate"),
+                       report_column("Money", "Taxable Amount", "taxable_amount"),
+                       report_column("Money", "Tax", "tax_amount")]
         }
     }
-    expense_group['Rows']['Row'] = expense_rows
-    expense_group['Summary']['ColData'] = [
-        {"value": "Total Expenses"},
-        {"value": f"{total_expenses}"}
-    ]
-    print(f"DYNAMIC EXPENSE GROUP is {expense_group}")
+    report_timer.observe()
+    return tax_summary
 
-    net_operating_income_group = {
-        "type": "Section",
-        "group": "Net Operating Income",
-        "Summary": {
-            "ColData": []
-        }
-    }
-    net_operating_income_group['Summary']['ColData'] = [
-        {"value": "Net Operating Income"},
-        {"value": f"{net_operating_income}"}
-    ]
-    print(f"NET OPERATING INCOME GROUP is {net_operating_income_group}")
 
-    net_income_group = {
-        "type": "Section",
-        "group": "Net Income",
-        "Summary": {
-            "ColData": []
-        }
-    }
-    net_income_group['Summary']['ColData'] = [
-        {"value": "Net Income"},
-        {"value": f"{net_income}"}
-    ]
-    print(f"NET INCOME GROUP is {net_income_group}")
+@app.get("/reports/tax_summary", tags=["Reports"])
+async def get_tax_summary(start_date: Optional[date] = None, end_date: Optional[date] = None,
+                          period: Optional[TaxPeriod] = None):
+    """
+        Tax summary report for a GST/VAT return, period splits it by MONTH, QUARTER or YEAR, over capacity it
+        answers 429 or 503 with Retry-After:
 
-    net_other_income_group = {
-        "type": "Section",
-        "group": "Net Other Income",
-        "Summary": {
-            "ColData": []
-        }
+    """
+    return await run_report('tax_summary', tax_summary_report, start_date=start_date, end_date=end_date,
+                            period=period)
+
+
+def check_journal_roundtrip_command(arguments):
+    """
+        Post taxed journal entries to a throwaway tenant, PUT each one back as it was read and as it was posted and
+        check that neither the entry nor its journal_line and journal_tax_line rows change, and that an unbalanced
+        PUT is refused,
+        e.g. `python main.py check-journal-roundtrip`:
+
+    """
+    parser = argparse.ArgumentParser(prog='main.py check-journal-roundtrip',
+                                     description='Check that a journal entry PUT of what was read changes nothing')
+    parser.parse_args(arguments)
+    if httpx is None:
+        print("httpx is not installed, the check needs it for the test client")
+        sys.exit(1)
+    from fastapi.testclient import TestClient
+    entries = {
+        'exclusive taxed sale': {'date': '2022-02-05', 'journal_lines': [
+            {'account_code': '090', 'account_type': 'BANK', 'amount': 107, 'posting_type': 'Debit'},
+            {'account_code': '200', 'account_type': 'REVENUE', 'amount': 100, 'posting_type': 'Credit',
+             'tax_code': 'OUTPUT'}]},
+        'inclusive taxed sale': {'date': '2022-02-05', 'line_amount_types': 'INCLUSIVE', 'journal_lines': [
+            {'account_code': '090', 'account_type': 'BANK', 'amount': 100, 'posting_type': 'Debit'},
+            {'account_code': '200', 'account_type': 'REVENUE', 'amount': 100, 'posting_type': 'Credit',
+             'tax_code': 'OUTPUT'}]},
     }
-    net_other_income_group['Summary']['ColData'] = [
-        {"value": "Net Other Income"},
-        {"value": f"{net_other_income}"}
-    ]
-    print(f"NET OTHER INCOME GROUP is {net_other_income_group}")
 
-    other_income_group = {
-        "Header": {
-            "ColData": [
-                {
-                    "value": "Other Income"
-                },
-                {
-                    "value": ""
-                }
-            ]
-        },
-        "Rows": {
-            "Row": []
+    def stored_rows(journal_entry_id):
+        return (fetch_rows("SELECT line_number, account_code, amount, base_amount FROM journal_line "
+                           "WHERE journal_entry_id = :id ORDER BY line_number", id=journal_entry_id),
+                fetch_rows("SELECT line_number, tax_code, taxable_amount, tax_amount FROM journal_tax_line "
+                           "WHERE journal_entry_id = :id ORDER BY line_number", id=journal_entry_id))
+
+    checks = {}
+    with scratch_tenant('journal-check') as tenant:
+        client = TestClient(app, headers={'X-Tenant-ID': tenant})
+        client.post('/tax_code/', json={'code': 'OUTPUT', 'name': 'Tax on sales', 'rate': 7,
+                                        'tax_account_code': '820'})
+        for name, entry in entries.items():
+            posted = client.post('/journalentry/', json=entry).json()
+            rows = stored_rows(posted['id'])
+            read = client.get(f"/journalentry/{posted['id']}").json()
+            updated = client.put(f"/journalentry/{posted['id']}", json=dict(entry, journal_lines=read['journal_lines']))
+            reread = client.get(f"/journalentry/{posted['id']}").json()
+            checks[f"{name}: PUT of what was read changes nothing"] = \
+                updated.status_code == 200 and reread['journal_lines'] == posted['journal_lines'] == \
+                read['journal_lines'] and stored_rows(posted['id']) == rows
+            resent = client.put(f"/journalentry/{posted['id']}", json=entry)
+            checks[f"{name}: PUT of the posted body stores what POST stored"] = \
+                resent.status_code == 200 and stored_rows(posted['id']) == rows and \
+                client.get(f"/journalentry/{posted['id']}").json()['journal_lines'] == posted['journal_lines']
+            unbalanced = client.put(f"/journalentry/{posted['id']}",
+                                    json=dict(entry, journal_lines=entry['journal_lines'][:1]))
+            checks[f"{name}: unbalanced PUT refused"] = unbalanced.status_code >= 400 and \
+                stored_rows(posted['id']) == rows
+    for name, passed in checks.items():
+        print(f"{'ok' if passed else 'FAILED'}: {name}")
+    if not all(checks.values()):
+        sys.exit(1)
+
+
+# outbound webhooks: ledger events are queued in a persistent outbox in the writing transaction, an asyncio
+# dispatcher posts them in batches to each connection, retrying with exponential backoff
+webhook_outbox_table = db['webhook_outbox']
+webhook_concurrency = int(os.environ.get('WEBHOOK_CONCURRENCY', '8'))
+webhook_connections_per_endpoint = int(os.environ.get('WEBHOOK_CONNECTIONS_PER_ENDPOINT', '4'))
+webhook_batch_size = int(os.environ.get('WEBHOOK_BATCH_SIZE', '100'))
+# events written within this window of each other go out in one POST
+webhook_batch_window_seconds = float(os.environ.get('WEBHOOK_BATCH_WINDOW_SECONDS', '0.2'))
+webhook_poll_seconds = float(os.environ.get('WEBHOOK_POLL_SECONDS', '5'))
+webhook_timeout_seconds = float(os.environ.get('WEBHOOK_TIMEOUT_SECONDS', '10'))
+webhook_backoff_seconds = float(os.environ.get('WEBHOOK_BACKOFF_SECONDS', '2'))
+webhook_max_backoff_seconds = float(os.environ.get('WEBHOOK_MAX_BACKOFF_SECONDS', '3600'))
+webhook_max_attempts = int(os.environ.get('WEBHOOK_MAX_ATTEMPTS', '12'))
+webhook_retention_seconds = float(os.environ.get('WEBHOOK_RETENTION_DAYS', '7')) * 86400
+
+
+def ensure_webhooks():
+    """
+        Create the connection table of the webhook endpoints and the webhook_outbox queue of their events:
 
-        },
-        "type": "Section",
-        "group": "Other Income",
-        "Summary": {
-            "ColData": []
-        }
+    """
+    connection_columns = {
+        'display_name': db.types.string,
+        'url': db.types.text,
+        'event_types': db.types.text,
+        'secret': db.types.string,
+        'batch_size': db.types.integer,
+        'active': db.types.boolean,
+        'last_updated_time': db.types.string,
     }
+    for column, column_type in connection_columns.items():
+        connection_table.create_column(column, column_type)
+    webhook_outbox_columns = {
+        'connection_id': db.types.integer,
+        'event_type': db.types.string,
+        'payload': db.types.text,
+        'status': db.types.string,
+        'attempts': db.types.integer,
+        'next_attempt_at': db.types.float,
+        'last_error': db.types.text,
+        'created_time': db.types.string,
+        'delivered_at': db.types.float,
+    }
+    for column, column_type in webhook_outbox_columns.items():
+        webhook_outbox_table.create_column(column, column_type)
+    # the dispatcher looks for due connections, then takes the oldest pending events of one connection
+    webhook_outbox_table.create_index(['status', 'connection_id', 'next_attempt_at'])
+    webhook_outbox_table.create_index(['connection_id', 'status', 'id'])
 
-    other_income_group['Rows']['Row'] = other_income_rows
-    other_income_group['Summary']['ColData'] = [
-        {"value": "Total Other Income"},
-        {"value": f"{total_other_income}"}
-    ]
-    print(f"OTHER INCOME GROUP is {other_income_group}")
 
-    other_expenses_group = {
-        "Header": {
-            "ColData": [
-                {
-                    "value": "Other Expenses"
-                },
-                {
-                    "value": ""
-                }
-            ]
-        },
-        "Rows": {
-            "Row": []
+on_database_open(ensure_webhooks)
 
-        },
-        "type": "Section",
-        "group": "Other Expenses",
-        "Summary": {
-            "ColData": []
-        }
-    }
-    other_expenses_group['Rows']['Row'] = other_expenses_rows
-    other_expenses_group['Summary']['ColData'] = [
-        {"value": "Total Other Expenses"},
-        {"value": f"{total_other_expenses}"}
-    ]
-    print(f"OTHER EXPENSE GROUP is {other_expenses_group}")
 
-    profit_and_loss = {
-        "Header": {
-            "ReportName": "ProfitAndLoss",
-            "Option": [
-                {
-                    "Name": "AccountingStandard",
-                    "Value": "GAAP"
-                },
-                {
-                    "Name": "NoReportData",
-                    "Value": "false"
-                }
-            ],
-            "ReportBasis": "Accrual",
-            "StartPeriod": f'{start_date}',
-            "Currency": "USD",
-            "EndPeriod": f'{end_date}',
-            "Time": f'{datetime.now()}',
-            "SummarizeColumnsBy": "Total"
-        },
-        "Rows": {
-            "Row": [income_group, cogs_group, gross_profit_group, expense_group, net_operating_income_group,
-                    other_income_group, other_expenses_group, net_other_income_group, net_income_group]
-        },
-        "Columns": {
-            "Column": [
-                {
-                    "ColType": "Account",
-                    "ColTitle": "",
-                    "MetaData": [
-                        {
-                            "Name": "ColKey",
-                            "Value": "account"
-                        }
-                    ]
-                },
-                {
-                    "ColType": "Money",
-                    "ColTitle": "Total",
-                    "MetaData": [
-                        {
-                            "Name": "ColKey",
-                            "Value": "total"
-                        }
-                    ]
-                }
-            ]
-        }
-    }
+def decode_connection(row):
+    row = dict(row)
+    row['event_types'] = load_json(row['event_types']) if row.get('event_types') else None
+    # the signing secret is write-only
+    row['secret'] = '********' if row.get('secret') else None
+    return row
 
-    return profit_and_loss
 
+def webhook_connections():
+    """
+        Active connections of the current tenant, cached in memory until one is written:
 
-@app.get("/reports/balance_sheet", tags=["Reports"])
-async def get_balance_sheet(start_date: Optional[date] = None, end_date: Optional[date] = None):
     """
-        Query a journal entry using a sql statement:
+    cache = tenant_cache('webhook_connections')
+    if 'connections' not in cache:
+        cache['connections'] = [decode_connection(row) for row in connection_table.find(active=True)]
+    return cache['connections']
+
 
+def subscribed(connection, event_type):
+    event_types = connection['event_types']
+    return not event_types or event_type in event_types or f"{event_type.split('.')[0]}.*" in event_types
+
+
+def enqueue_events(events, connection_id=None):
     """
+        Queue (event_type, payload) pairs for every subscribed connection, call inside the transaction that writes
+        what the events describe so they are queued if and only if it commits:
 
-    result = journal_entry_table.find(date={'between': [start_date, end_date]})
-    print(f"The result is {result}")
-    accounts_by_type = {'asset': {}, 'liability': {}, 'equity': {}, 'revenue': {}, 'expense': {}}
-    retained_earnings = 0
-    if result:
-        for row in result:
-            print(f"The row is {row['journal_lines']}")
-            journal_lines = json.loads(row['journal_lines'])
-            for each in journal_lines:
-                print(f"each in journal_lines is {each}")
+    """
+    connections = [connection for connection in webhook_connections()
+                   if connection_id is None or connection['id'] == connection_id]
+    if not connections:
+        return
+    created_time = datetime.now(timezone.utc).isoformat()
+    webhook_outbox_table.insert_many([
+        {'connection_id': connection['id'], 'event_type': event_type, 'payload': dump_json(payload),
+         'status': OutboxStatus.PENDING.value, 'attempts': 0, 'next_attempt_at': 0.0, 'last_error': None,
+         'created_time': created_time, 'delivered_at': None}
+        for event_type, payload in events
+        for connection in connections if subscribed(connection, event_type)
+    ])
+    webhook_dispatcher.wake()
+
+
+class WebhookDispatcher:
+    """
+        Asyncio task posting the outbox of every open tenant: one batch in flight per connection so events arrive
+        in order, at most webhook_concurrency batches in flight overall, one pooled HTTP client per endpoint:
 
-                if str(each['account_type']).lower() in ["asset", "liability", "equity", "revenue", "expense"]:
-                    key = str(each['account_type']).lower()
-                    print(f"Key is {key}")
-                    try:
-                        accounts_by_type[f"{key}"][f"account_code_{each['account_code']}"].append(each['amount'])
-                    except KeyError:
-                        accounts_by_type[f"{key}"][f"account_code_{each['account_code']}"] = []
-                        accounts_by_type[f"{key}"][
-                            f"account_code_{each['account_code']}"].append(each['amount'])
+    """
+    def __init__(self):
+        self.loop = None
+        self.wakeup = None
+        self.task = None
+        self.clients = {}
+        self.in_flight = set()
+        self.deliveries = set()
+        self.purged_at = 0.0
+
+    def wake(self):
+        # the current tenant has events to send now, the next collect opens it even after it was evicted
+        schedule_tenant_work('webhook', webhook_due(time.time()))
+        loop = self.loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self.wakeup.set)
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        self.task = self.loop.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, *self.deliveries, return_exceptions=True)
+        for client in self.clients.values():
+            await client.aclose()
+        self.loop, self.task = None, None
+        self.clients = {}
+        self.in_flight = set()
+
+    def client(self, url):
+        origin = httpx.URL(url).copy_with(path='/', query=None, fragment=None)
+        client = self.clients.get(str(origin))
+        if client is None:
+            limits = httpx.Limits(max_connections=webhook_connections_per_endpoint,
+                                  max_keepalive_connections=webhook_connections_per_endpoint)
+            client = self.clients[str(origin)] = httpx.AsyncClient(limits=limits, timeout=webhook_timeout_seconds)
+        return client
+
+    async def run(self):
+        semaphore = asyncio.Semaphore(webhook_concurrency)
+        while True:
+            self.wakeup.clear()
+            try:
+                batches, next_due = await self.loop.run_in_executor(None, collect_webhook_batches,
+                                                                    frozenset(self.in_flight))
+            except Exception as error:
+                print(f"webhook dispatcher could not read the outbox: {error}")
+                batches, next_due = [], None
+            for tenant, connection, events in batches:
+                self.in_flight.add((tenant, connection['id']))
+                delivery = self.loop.create_task(self.deliver(semaphore, tenant, connection, events))
+                self.deliveries.add(delivery)
+                delivery.add_done_callback(self.deliveries.discard)
+            timeout = webhook_poll_seconds if next_due is None else min(max(next_due - time.time(), 0),
+                                                                          webhook_poll_seconds)
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+                # let the rest of a burst of writes commit so it goes out in the same POST
+                await asyncio.sleep(webhook_batch_window_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    async def deliver(self, semaphore, tenant, connection, events):
+        body = dump_json({'events': [
+            {'id': event_id, 'type': event_type, 'created_time': created_time, 'tenant': tenant,
+             'data': load_json(payload)}
+            for event_id, event_type, payload, created_time in events
+        ]}).encode()
+        headers = {'Content-Type': 'application/json'}
+        if connection['secret']:
+            digest = hmac.new(connection['secret'].encode(), body, hashlib.sha256).hexdigest()
+            headers['X-Webhook-Signature'] = f"sha256={digest}"
+        event_ids = [event[0] for event in events]
+        try:
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    response = await self.client(connection['url']).post(connection['url'], content=body,
+                                                                         headers=headers)
+                    error = None if response.is_success else f"HTTP {response.status_code}"
+                except httpx.HTTPError as http_error:
+                    error = repr(http_error)
+                webhook_delivery_seconds.observe(time.perf_counter() - start,
+                                                 outcome='delivered' if error is None else 'failed')
+            await self.loop.run_in_executor(None, record_webhook_delivery, tenant, connection['id'], event_ids,
+                                            error)
+        except Exception as error:
+            print(f"webhook delivery to connection {connection['id']} of tenant {tenant} failed: {error}")
+        finally:
+            self.in_flight.discard((tenant, connection['id']))
+            self.wakeup.set()
+
+
+webhook_dispatcher = WebhookDispatcher()
+
+
+def webhook_due(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat(timespec='seconds')
+
+
+def collect_webhook_batches(in_flight):
+    """
+        Oldest pending events of each due connection of every tenant with events due, and the time the next one
+        falls due:
+
+    """
+    now = time.time()
+    batches = []
+    next_due = None
+    for tenant in tenants_with_work('webhook', webhook_due(now)):
+        with tenant_databases.use(tenant):
+            # a failed batch pushes back every pending event of its connection, so the latest retry time rules
+            due_connections = fetch_rows("SELECT connection_id, MAX(next_attempt_at) FROM webhook_outbox "
+                                         "WHERE status = :status GROUP BY connection_id",
+                                         status=OutboxStatus.PENDING.value)
+            tenant_due = None
+            for connection_id, due_at in due_connections:
+                if (tenant, connection_id) in in_flight:
+                    tenant_due = now
+                    continue
+                if due_at > now:
+                    next_due = due_at if next_due is None else min(next_due, due_at)
+                    tenant_due = due_at if tenant_due is None else min(tenant_due, due_at)
+                    continue
+                connection = connection_table.find_one(id=connection_id, active=True)
+                if connection is None:
+                    # reactivating the connection wakes the dispatcher for this tenant again
+                    continue
+                tenant_due = now
+                events = fetch_rows("SELECT id, event_type, payload, created_time FROM webhook_outbox "
+                                    "WHERE connection_id = :connection_id AND status = :status "
+                                    "ORDER BY id LIMIT :limit",
+                                    connection_id=connection_id, status=OutboxStatus.PENDING.value,
+                                    limit=connection['batch_size'] or webhook_batch_size)
+                batches.append((tenant, {'id': connection_id, 'url': connection['url'],
+                                         'secret': connection['secret']}, events))
+            schedule_tenant_work('webhook', None if tenant_due is None else webhook_due(tenant_due))
+            if now - webhook_dispatcher.purged_at > 60:
+                with db:
+                    db.query("DELETE FROM webhook_outbox WHERE status = :status AND delivered_at < :before",
+                             status=OutboxStatus.DELIVERED.value, before=now - webhook_retention_seconds)
+    if now - webhook_dispatcher.purged_at > 60:
+        webhook_dispatcher.purged_at = now
+    return batches, next_due
+
+
+def record_webhook_delivery(tenant, connection_id, event_ids, error):
+    """
+        Mark a posted batch delivered, or count the failed attempt, give up on events past webhook_max_attempts and
+        back off the whole connection exponentially:
+
+    """
+    params = {f"id_{index}": event_id for index, event_id in enumerate(event_ids)}
+    id_list = ', '.join(f":{name}" for name in params)
+    with tenant_databases.use(tenant), db:
+        if error is None:
+            db.query(f"UPDATE webhook_outbox SET status = :status, attempts = attempts + 1, delivered_at = :now, "
+                     f"last_error = NULL WHERE id IN ({id_list})",
+                     status=OutboxStatus.DELIVERED.value, now=time.time(), **params)
+            return
+        db.query(f"UPDATE webhook_outbox SET attempts = attempts + 1, last_error = :error WHERE id IN ({id_list})",
+                 error=error, **params)
+        db.query(f"UPDATE webhook_outbox SET status = :dead WHERE id IN ({id_list}) AND attempts >= :max_attempts",
+                 dead=OutboxStatus.DEAD.value, max_attempts=webhook_max_attempts, **params)
+        attempts = fetch_rows(f"SELECT MAX(attempts) FROM webhook_outbox WHERE id IN ({id_list})", **params)[0][0]
+        delay = min(webhook_backoff_seconds * 2 ** (attempts - 1), webhook_max_backoff_seconds)
+        db.query("UPDATE webhook_outbox SET next_attempt_at = :next_attempt_at "
+                 "WHERE connection_id = :connection_id AND status = :status",
+                 next_attempt_at=time.time() + delay * random.uniform(0.5, 1.0), connection_id=connection_id,
+                 status=OutboxStatus.PENDING.value)
+    print(f"webhook delivery to connection {connection_id} failed ({error}), attempt {attempts}")
+
+
+@app.on_event("startup")
+async def start_webhook_dispatcher():
+    if httpx is None:
+        print("httpx is not installed, webhook events are queued but not delivered")
+        return
+    webhook_dispatcher.start()
+
+
+@app.on_event("shutdown")
+async def stop_webhook_dispatcher():
+    # undelivered events stay PENDING in the outbox and go out after the next start
+    await webhook_dispatcher.stop()
+
+
+def connection_record(connection_dict):
+    record = dict(connection_dict)
+    if 'event_types' in record:
+        record['event_types'] = dump_json(record['event_types']) if record['event_types'] else None
+    if record.get('url') is not None and not re.match(r'^https?://', record['url']):
+        raise HTTPException(status_code=400, detail="url must be an http or https URL")
+    if record.get('batch_size') is not None and record['batch_size'] < 1:
+        raise HTTPException(status_code=400, detail="batch_size must be at least 1")
+    record['last_updated_time'] = datetime.now(timezone.utc).isoformat()
+    return record
+
+
+@app.post("/connection/", tags=["Connection"])
+async def create_connection(connection: Connection):
+    """
+        Register a webhook endpoint for ledger events (journal_entry.created, .updated, .deleted), event_types
+        takes exact names or `journal_entry.*`, all events when empty:
+
+    """
+    connection_id = connection_table.insert(connection_record(connection.dict()))
+    tenant_cache('webhook_connections').clear()
+    return decode_connection(connection_table.find_one(id=connection_id))
+
+
+@app.get("/connection/query", tags=["Connection"])
+async def query_connection(query: Optional[str] = None, skip: int = 0, limit: int = 10):
+    """
+        Query connections or their webhook_outbox using a sql statement:
+
+    """
+    if query:
+        final_results = list(db.query(query))
+        if final_results:
+            return final_results[skip: skip + limit]
+        raise HTTPException(status_code=404, detail="Connection not found")
 
+
+@app.get("/connection/{connection_id}", tags=["Connection"])
+async def read_connection(connection_id: int):
+    """
+        Read a connection with the count of its queued, delivered and dead events:
+
+    """
+    connection = connection_table.find_one(id=connection_id)
+    if connection:
+        connection = decode_connection(connection)
+        connection['outbox'] = dict(fetch_rows("SELECT status, COUNT(*) FROM webhook_outbox "
+                                               "WHERE connection_id = :connection_id GROUP BY status",
+                                               connection_id=connection_id))
+        return connection
     else:
-        raise HTTPException(status_code=404, detail="Journal Entry not found")
+        raise HTTPException(status_code=404, detail="Connection not found")
 
-    print(f"accounts by type are {accounts_by_type}")
 
-    for account in accounts_by_type['asset']:
-        print(f"account in ACCOUNTS BY TYPE is {account}")
-        accounts_by_type['asset'][f'{account}'] = sum(accounts_by_type['asset'][f'{account}'])
+@app.put("/connection/{connection_id}", tags=["Connection"])
+async def update_connection(connection_id: int, connection: UpdateConnection):
+    """
+        Update a connection, deactivating it holds its events in the outbox until it is active again:
 
-    for account in accounts_by_type['liability']:
-        print(f"account in ACCOUNTS BY TYPE is {account}")
-        accounts_by_type['liability'][f'{account}'] = sum(accounts_by_type['liability'][f'{account}'])
+    """
+    if not connection_table.find_one(id=connection_id):
+        raise HTTPException(status_code=404, detail="Connection not found")
+    connection_table.update(dict(connection_record(connection.dict(exclude_unset=True)), id=connection_id), ['id'])
+    tenant_cache('webhook_connections').clear()
+    webhook_dispatcher.wake()
+    return decode_connection(connection_table.find_one(id=connection_id))
 
-    for account in accounts_by_type['equity']:
-        print(f"account in ACCOUNTS BY TYPE is {account}")
-        accounts_by_type['equity'][f'{account}'] = sum(accounts_by_type['equity'][f'{account}'])
 
-    for account in accounts_by_type['revenue']:
-        print(f"account in ACCOUNTS BY TYPE is {account}")
-        accounts_by_type['revenue'][f'{account}'] = sum(accounts_by_type['revenue'][f'{account}'])
-        retained_earnings -= accounts_by_type['revenue'][f'{account}']
+@app.delete("/connection/{connection_id}", tags=["Connection"])
+async def delete_connection(connection_id: int):
+    """
+        Delete a connection and drop its undelivered events:
 
-    for account in accounts_by_type['expense']:
-        print(f"account in ACCOUNTS BY TYPE is {account}")
-        accounts_by_type['expense'][f'{account}'] = sum(accounts_by_type['expense'][f'{account}'])
-        retained_earnings -= accounts_by_type['expense'][f'{account}']
+    """
+    if connection_table.find_one(id=connection_id):
+        with db:
+            connection_table.delete(id=connection_id)
+            webhook_outbox_table.delete(connection_id=connection_id)
+        tenant_cache('webhook_connections').clear()
+        return {"message": f"Connection with id {connection_id} has been deleted"}
+    else:
+        raise HTTPException(status_code=404, detail="Connection not found")
 
-    print(f"UPDATED accounts by type are {accounts_by_type}")
-    print(f"RETAINED_EARNINGS is {retained_earnings}")
 
-    balance_sheet = {}
-    return balance_sheet
+@app.get("/connection/{connection_id}/events", tags=["Connection"])
+async def read_connection_events(connection_id: int, status: Optional[OutboxStatus] = None, skip: int = 0,
+                                 limit: int = 20):
+    """
+        List the outbox events of a connection, newest first:
+
+    """
+    filters = {'connection_id': connection_id}
+    if status:
+        filters['status'] = status.value
+    return [dict(row, payload=load_json(row['payload']))
+            for row in webhook_outbox_table.find(**filters, order_by='-id', _offset=skip, _limit=limit)]
+
+
+@app.post("/connection/{connection_id}/events/retry", tags=["Connection"])
+async def retry_connection_events(connection_id: int):
+    """
+        Queue the dead events of a connection again and retry its pending ones now:
+
+    """
+    if not connection_table.find_one(id=connection_id):
+        raise HTTPException(status_code=404, detail="Connection not found")
+    with db:
+        db.query("UPDATE webhook_outbox SET status = :pending, attempts = 0, next_attempt_at = 0 "
+                 "WHERE connection_id = :connection_id AND status IN (:pending, :dead)",
+                 pending=OutboxStatus.PENDING.value, dead=OutboxStatus.DEAD.value, connection_id=connection_id)
+    webhook_dispatcher.wake()
+    return dict(fetch_rows("SELECT status, COUNT(*) FROM webhook_outbox WHERE connection_id = :connection_id "
+                           "GROUP BY status", connection_id=connection_id))
+
+
+@app.post("/connection/{connection_id}/ping", tags=["Connection"])
+async def ping_connection(connection_id: int):
+    """
+        Queue a ping event to a connection, to check its endpoint and signature:
+
+    """
+    connection = connection_table.find_one(id=connection_id)
+    if not connection:
+        raise HTTPException(status_code=404, detail="Connection not found")
+    with db:
+        if connection['active']:
+            enqueue_events([('ping', {'connection_id': connection_id})], connection_id)
+    return {"message": f"Ping queued for connection {connection_id}"}
+
+
+def check_webhooks_command(arguments):
+    """
+        Deliver events of a throwaway tenant to a local stub endpoint that fails the first posts, and check that
+        every event arrives once, in order, in batches of at most batch_size and correctly signed, e.g.
+        `python main.py check-webhooks --events 120 --batch-size 50 --failures 2`:
+
+    """
+    global webhook_backoff_seconds
+    parser = argparse.ArgumentParser(prog='main.py check-webhooks',
+                                     description='Check webhook retries, ordering and batching against a stub endpoint')
+    parser.add_argument('--events', type=int, default=120)
+    parser.add_argument('--batch-size', type=int, default=50)
+    parser.add_argument('--failures', type=int, default=2)
+    parser.add_argument('--backoff', type=float, default=0.2)
+    parser.add_argument('--timeout', type=float, default=30.0)
+    options = parser.parse_args(arguments)
+    if httpx is None:
+        print("httpx is not installed, webhook events cannot be delivered")
+        sys.exit(1)
+    webhook_backoff_seconds = options.backoff
+    secret = 'check-secret'
+    posts = []
+    failures = [options.failures]
+
+    class StubEndpoint(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            if failures[0] > 0:
+                failures[0] -= 1
+                self.send_response(500)
+            else:
+                posts.append((body, self.headers.get('X-Webhook-Signature')))
+                self.send_response(204)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubEndpoint)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        with scratch_tenant('webhook-check'):
+            connection = Connection(url=f"http://127.0.0.1:{server.server_address[1]}/events", secret=secret,
+                                    batch_size=options.batch_size)
+            connection_table.insert(connection_record(connection.dict()))
+            with db:
+                enqueue_events([('check.event', {'sequence': sequence}) for sequence in range(options.events)])
+
+            async def deliver():
+                webhook_dispatcher.start()
+                deadline = time.time() + options.timeout
+                try:
+                    while sum(len(load_json(body)['events']) for body, signature in posts) < options.events \
+                            and time.time() < deadline:
+                        await asyncio.sleep(0.1)
+                finally:
+                    await webhook_dispatcher.stop()
+
+            asyncio.run(deliver())
+    finally:
+        server.shutdown()
+    batches = [load_json(body)['events'] for body, signature in posts]
+    sequences = [event['data']['sequence'] for batch in batches for event in batch]
+    checks = {
+        'retried past the failed posts': failures[0] == 0,
+        'every event delivered once, in order': sequences == list(range(options.events)),
+        f"batches of at most {options.batch_size}": all(len(batch) <= options.batch_size for batch in batches),
+        'fewest posts': len(batches) == math.ceil(options.events / options.batch_size),
+        'signed': all(signature == f"sha256={hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()}"
+                      for body, signature in posts),
+    }
+    print(f"{options.events} events in {len(batches)} posts after {options.failures} failed posts")
+    for name, passed in checks.items():
+        print(f"{'ok' if passed else 'FAILED'}: {name}")
+    if not all(checks.values()):
+        sys.exit(1)
+
+
+def bench_serialization_command(arguments):
+    """
+        Microbenchmark of journal entry response encoding, e.g. `python main.py bench-serialization --lines 2 100`:
 
+    """
+    parser = argparse.ArgumentParser(prog='main.py bench-serialization',
+                                     description='Time journal entry encoding per entry size')
+    parser.add_argument('--lines', type=int, nargs='+', default=[2, 10, 100, 1000])
+    parser.add_argument('--repeat', type=int, default=200)
+    options = parser.parse_args(arguments)
+
+    def double_dump_path(journal_entry):
+        # the previous path: two model dumps, json.dumps of the lines, jsonable_encoder and JSONResponse
+        journal_entry_dict = journal_entry.dict()
+        json_journal_entry_dict = journal_entry.dict()
+        json_journal_entry_dict['journal_lines'] = json.dumps(json_journal_entry_dict['journal_lines'])
+        return JSONResponse(jsonable_encoder(journal_entry_dict)).body
 
+    def single_dump_path(journal_entry):
+        # one model dump serves both the stored journal_lines column and the response
+        journal_entry_dict = journal_entry.dict()
+        stored_journal_lines = dump_json(journal_entry_dict['journal_lines'])
+        return stored_journal_lines, fast_json_response(journal_entry_dict).body
+
+    print(f"encoder: {'orjson' if orjson else 'json'}, repeat: {options.repeat}")
+    print(f"{'lines':>6} {'before us/entry':>16} {'after us/entry':>15} {'speedup':>8}")
+    for line_count in options.lines:
+        journal_entry = JournalEntry(
+            date='2022-06-22', description='Benchmark entry', journal_type=JournalType.SALES,
+            journal_lines=[
+                JournalLineItems(account_code=str(400 + index % 50), account_type='REVENUE', amount=12.5,
+                                 posting_type='Credit', currency=base_currency, exchange_rate=1.0)
+                for index in range(line_count)
+            ])
+        timings = []
+        for encode in (double_dump_path, single_dump_path):
+            start = time.perf_counter()
+            for _ in range(options.repeat):
+                encode(journal_entry)
+            timings.append((time.perf_counter() - start) / options.repeat * 1e6)
+        print(f"{line_count:>6} {timings[0]:>16.1f} {timings[1]:>15.1f} {timings[0] / timings[1]:>7.1f}x")
+
+
+if __name__ == "__main__":
+    commands = {'export': export_command, 'archive': archive_command, 'check-webhooks': check_webhooks_command,
+                'check-journal-roundtrip': check_journal_roundtrip_command,
+                'bench-serialization': bench_serialization_command}
+    if len(sys.argv) < 2 or sys.argv[1] not in commands:
+        print(f"usage: python main.py {{{','.join(commands)}}} ...")
+        sys.exit(2)
+    commands[sys.argv[1]](sys.argv[2:])